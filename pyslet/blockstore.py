@@ -1,13 +1,21 @@
 #! /usr/bin/env python
 
 import binascii
+import collections
 import hashlib
 import io
 import logging
+import mmap
 import os
 import random
 import threading
 import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
 from .http import params
 from .iso8601 import TimePoint
@@ -15,6 +23,8 @@ from .odata2 import core
 from .odata2 import csdl as edm
 from .py2 import (
     byte,
+    dict_items,
+    dict_values,
     join_bytes,
     range3)
 from .vfs import OSFilePath as FilePath
@@ -23,6 +33,15 @@ from .vfs import OSFilePath as FilePath
 MAX_BLOCK_SIZE = 65536
 """The default maximum block size for block stores: 64K"""
 
+CODECS = {'zlib': (zlib.compress, zlib.decompress)}
+"""The compression codecs available for storing blocks
+
+A dictionary mapping codec name on to a tuple of (compress, decompress)
+functions.  'lzma' is only available if the lzma module is present."""
+
+if lzma is not None:
+    CODECS['lzma'] = (lzma.compress, lzma.decompress)
+
 
 def _magic():
     """Calculate a magic string used to identify an object."""
@@ -52,6 +71,13 @@ class BlockMissing(Exception):
     pass
 
 
+class BlockCorrupt(Exception):
+
+    """Raised when a block retrieved with verification does not match
+    its hash key."""
+    pass
+
+
 class LockError(Exception):
 
     """Raised when a timeout occurs during by
@@ -69,14 +95,57 @@ class BlockStore(object):
 
     hash_class
         The hashing object to use when calculating block keys. Defaults
-        to hashlib.sha256."""
+        to hashlib.sha256.
+
+    codec
+        The name of the compression codec to use when storing new
+        blocks, one of the keys of :py:data:`CODECS`.  Defaults to None,
+        blocks are stored uncompressed.
+
+    The codec used is recorded with each block so blocks stored with
+    different (or no) codecs can be mixed in the same store.  Block
+    keys are always calculated from the uncompressed data.  Blocks
+    that do not compress well are stored uncompressed, see
+    :py:meth:`encode`."""
 
     def __init__(
             self,
             max_block_size=MAX_BLOCK_SIZE,
-            hash_class=hashlib.sha256):
+            hash_class=hashlib.sha256,
+            codec=None):
         self.hash_class = hash_class
         self.max_block_size = max_block_size
+        if codec is not None and codec not in CODECS:
+            raise ValueError("unknown codec: %s" % codec)
+        self.codec = codec
+
+    def encode(self, data):
+        """Encodes a block of data for storage
+
+        Returns a tuple of (codec, data) where codec is the name of the
+        codec used to compress the data or None if the data is not
+        compressed.  The data is only compressed if it saves at least
+        one eighth of the original size."""
+        if self.codec is not None and data:
+            cdata = CODECS[self.codec][0](bytes(data))
+            if len(cdata) <= len(data) - len(data) // 8:
+                return self.codec, cdata
+        return None, data
+
+    def decode(self, codec, data):
+        """Decodes a block of data returned from storage
+
+        codec
+            The name of the codec used to encode the data or None if it
+            was stored uncompressed.
+
+        Returns the original data."""
+        if codec is None:
+            return data
+        try:
+            return CODECS[codec][1](data)
+        except KeyError:
+            raise ValueError("unknown codec: %s" % codec)
 
     def key(self, data):
         if isinstance(data, bytearray):
@@ -103,6 +172,24 @@ class BlockStore(object):
         raised."""
         raise BlockMissing(key)
 
+    def retrieve_buffer(self, key):
+        """Returns the block of data referenced by key as a buffer
+
+        key
+            A hex string previously returned by :py:meth:`store`.
+
+        The result is an object that supports the buffer protocol and
+        can be sliced, such as a memoryview.  Stores that can provide
+        access to the data without copying it override this method, by
+        default the result of :py:meth:`retrieve` is returned.
+
+        The result may hold resources, such as a memory-mapped file,
+        that are only freed when the buffer (and any views derived from
+        it) are released so callers should not keep references to the
+        result longer than necessary.  In Python 3 the release method
+        of a memoryview can be used to release it explicitly."""
+        return self.retrieve(key)
+
     def delete(self, key):
         """Deletes the block of data referenced by key
 
@@ -110,6 +197,30 @@ class BlockStore(object):
             A hex string previously returned by :py:meth:`store`."""
         raise NotImplementedError
 
+    def iter_blocks(self):
+        """Iterates over all the blocks in the store
+
+        Yields (key, size) tuples where size is the number of bytes used
+        to store the block, which may be less than the length of the
+        data if the block is compressed, or None if the size is not
+        known without reading the block.  Used by
+        :py:meth:`StreamStore.collect_garbage`, the order is
+        undefined."""
+        raise NotImplementedError
+
+    def modified(self, key):
+        """Returns the time at which a block was last stored
+
+        key
+            A hex string previously returned by :py:meth:`store`.
+
+        The result is a Unix time (as returned by time.time()) or None
+        if the time is not known.  Storing a block that already exists
+        updates the time so that :py:meth:`StreamStore.collect_garbage`
+        can avoid removing blocks that are in the process of being
+        added to a stream.  By default, None is returned."""
+        return None
+
 
 class FileBlockStore(BlockStore):
 
@@ -125,7 +236,9 @@ class FileBlockStore(BlockStore):
     Each block is saved as a single file but the hash key is decomposed
     into 3 components to reduce the number of files in a single
     directory.  For example, if the hash key is 'ABCDEF123' then the
-    file would be stored at the path: 'AB/CD/EF123'"""
+    file would be stored at the path: 'AB/CD/EF123'.  Compressed blocks
+    have the name of the codec added as an extension, e.g.,
+    'AB/CD/EF123.zlib'."""
 
     def __init__(self, dpath=None, **kwargs):
         super(FileBlockStore, self).__init__(**kwargs)
@@ -143,16 +256,42 @@ class FileBlockStore(BlockStore):
                 pass
         self.magic = _magic()
 
+    def _paths(self, key):
+        # yields (codec, path) for all the places key could be stored,
+        # starting with the path used for new blocks
+        parent = self.dpath.join(key[0:2], key[2:4])
+        codecs = sorted(CODECS)
+        if self.codec is not None:
+            codecs.remove(self.codec)
+            codecs[0:0] = [self.codec, None]
+        else:
+            codecs.insert(0, None)
+        for codec in codecs:
+            if codec is None:
+                yield codec, parent.join(key[4:])
+            else:
+                yield codec, parent.join("%s.%s" % (key[4:], codec))
+
     def store(self, data):
         # calculate the key
         key = self.key(data)
-        parent = self.dpath.join(key[0:2], key[2:4])
-        path = parent.join(key[4:])
-        if path.exists():
-            return key
-        elif len(data) > self.max_block_size:
+        for codec, path in self._paths(key):
+            if path.exists():
+                try:
+                    # touch the existing block
+                    os.utime(path.path, None)
+                    return key
+                except OSError:
+                    # removed since we tested it, store it again
+                    break
+        if len(data) > self.max_block_size:
             raise BlockSize
         else:
+            parent = self.dpath.join(key[0:2], key[2:4])
+            codec, data = self.encode(data)
+            for path_codec, path in self._paths(key):
+                if path_codec == codec:
+                    break
             tmp_path = self.tmpdir.join(
                 "%s_%i_%s" %
                 (self.magic, threading.current_thread().ident, key[
@@ -169,22 +308,337 @@ class FileBlockStore(BlockStore):
             return key
 
     def retrieve(self, key):
+        for codec, path in self._paths(key):
+            if path.exists():
+                with path.open('rb') as f:
+                    data = f.read()
+                return self.decode(codec, data)
+        raise BlockMissing
+
+    def retrieve_buffer(self, key):
+        """Returns a memoryview of the memory-mapped block file
+
+        The file is mapped read-only so no data is copied until the view
+        is read.  On platforms where mmap objects do not support the
+        memoryview interface (e.g., Python 2) the data is read in the
+        normal way.  Compressed blocks are always read and
+        decompressed.
+
+        The file remains mapped until the view, and every view derived
+        from it, has been released.  There is no way to unmap the file
+        while a view exists so the mmap object is not closed explicitly,
+        it is closed automatically when the last view is released and
+        the mmap object is garbage collected."""
         path = self.dpath.join(key[0:2], key[2:4], key[4:])
-        if path.exists():
-            with path.open('rb') as f:
-                data = f.read()
-            return data
+        if not path.exists():
+            return self.retrieve(key)
         else:
-            raise BlockMissing
+            with path.open('rb') as f:
+                try:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # empty files cannot be mapped
+                    return f.read()
+                try:
+                    return memoryview(m)
+                except TypeError:
+                    m.close()
+                    return f.read()
 
     def delete(self, key):
-        path = self.dpath.join(key[0:2], key[2:4], key[4:])
-        if path.exists():
+        for codec, path in self._paths(key):
+            if path.exists():
+                try:
+                    path.remove()
+                except OSError:
+                    # catch race condition where path is gone already
+                    pass
+
+    def iter_blocks(self):
+        for d1 in self.dpath.listdir():
+            d1_name = str(d1)
+            if len(d1_name) != 2:
+                # skips the tmp directory
+                continue
+            d1 = self.dpath.join(d1)
+            if not d1.isdir():
+                continue
+            for d2 in d1.listdir():
+                d2_name = str(d2)
+                d2 = d1.join(d2)
+                if not d2.isdir():
+                    continue
+                # a block may be stored more than once with different
+                # codecs, the size is the total size of all copies as
+                # they are all removed by delete
+                sizes = {}
+                for f in d2.listdir():
+                    key = d1_name + d2_name + str(f).split('.')[0]
+                    try:
+                        size = d2.join(f).stat().st_size
+                    except OSError:
+                        # deleted since we listed the directory
+                        continue
+                    sizes[key] = sizes.get(key, 0) + size
+                for key, size in dict_items(sizes):
+                    yield key, size
+
+    def modified(self, key):
+        for codec, path in self._paths(key):
             try:
-                path.remove()
+                return path.stat().st_mtime
             except OSError:
-                # catch race condition where path is gone already
-                pass
+                continue
+        return None
+
+
+class PackBlockStore(BlockStore):
+
+    """Class for storing blocks of data in large pack files.
+
+    Additional keyword arguments:
+
+    dpath
+        A :py:class:`FilePath` instance pointing to a directory in which
+        to store the pack files and index.  If this argument is omitted
+        then a temporary directory is created using the builtin mkdtemp.
+
+    max_pack_size
+        The size at which a pack file is considered full and a new pack
+        file is started, defaults to 1GB.
+
+    Blocks are appended to the current pack file (pack-000000.dat,
+    pack-000001.dat, etc.) and their locations (and codecs) are
+    recorded in an append-only index file (pack.idx) that is read when
+    the store is created.  This avoids creating a file for every block
+    at the cost of keeping the index in memory.  Deleting a block
+    simply removes it from the index, the space it occupied is only
+    reclaimed when :py:meth:`compact` is called.
+
+    Instances are thread safe but, unlike :py:class:`FileBlockStore`,
+    a directory must only be used by one PackBlockStore instance at a
+    time."""
+
+    def __init__(self, dpath=None, max_pack_size=1 << 30, **kwargs):
+        super(PackBlockStore, self).__init__(**kwargs)
+        if dpath is None:
+            # create a temporary directory
+            self.dpath = FilePath.mkdtemp('.d', 'pyslet_packstore-')
+        else:
+            self.dpath = dpath
+        self.max_pack_size = max_pack_size
+        self.lock = threading.RLock()
+        # maps hash key on to a (pack number, offset, length, codec)
+        # tuple
+        self.index = {}
+        # maps pack number on to the number of bytes in use
+        self.pack_live = {}
+        # maps hash key on to the time it was last stored by this
+        # instance
+        self.stored = {}
+        self._readers = {}
+        self._writer = None
+        self.index_path = self.dpath.join('pack.idx')
+        self.pack_num = 0
+        if self.index_path.exists():
+            self._load_index()
+        self.pack_size = self._get_pack_size(self.pack_num)
+        self._index_file = self.index_path.open('ab')
+
+    def _pack_path(self, pack_num):
+        return self.dpath.join("pack-%06i.dat" % pack_num)
+
+    def _get_pack_size(self, pack_num):
+        path = self._pack_path(pack_num)
+        if path.exists():
+            return path.stat().st_size
+        else:
+            return 0
+
+    def _load_index(self):
+        with self.index_path.open('rb') as f:
+            for line in f:
+                fields = line.split()
+                try:
+                    key = fields[0].decode('ascii')
+                    if len(fields) == 2 and fields[1] == b'-':
+                        self._remove_entry(key)
+                        continue
+                    pack_num, offset, length = [int(x) for x in fields[1:4]]
+                    if len(fields) == 5:
+                        codec = fields[4].decode('ascii')
+                    elif len(fields) == 4:
+                        codec = None
+                    else:
+                        raise ValueError
+                except (IndexError, ValueError):
+                    # incomplete record, e.g., from an interrupted write
+                    logging.warning("PackBlockStore: ignoring bad index "
+                                    "record %s", repr(line))
+                    continue
+                self._add_entry(key, pack_num, offset, length, codec)
+                if pack_num > self.pack_num:
+                    self.pack_num = pack_num
+
+    def _add_entry(self, key, pack_num, offset, length, codec):
+        self._remove_entry(key)
+        self.index[key] = (pack_num, offset, length, codec)
+        self.pack_live[pack_num] = self.pack_live.get(pack_num, 0) + length
+
+    def _remove_entry(self, key):
+        entry = self.index.pop(key, None)
+        if entry is not None:
+            self.pack_live[entry[0]] -= entry[2]
+        return entry
+
+    def _write_index(self, record):
+        self._index_file.write(record.encode('ascii'))
+        self._index_file.flush()
+
+    def _append(self, key, data, codec):
+        if self.pack_size and self.pack_size + len(data) > \
+                self.max_pack_size:
+            # start a new pack file
+            self._close_writer()
+            self.pack_num += 1
+            self.pack_size = self._get_pack_size(self.pack_num)
+        if self._writer is None:
+            self._writer = self._pack_path(self.pack_num).open('ab')
+        self._writer.write(data)
+        self._writer.flush()
+        offset = self.pack_size
+        self.pack_size += len(data)
+        self._add_entry(key, self.pack_num, offset, len(data), codec)
+        self._write_index(self._index_record(key, self.index[key]))
+
+    def _index_record(self, key, entry):
+        pack_num, offset, length, codec = entry
+        if codec is None:
+            return "%s %i %i %i\n" % (key, pack_num, offset, length)
+        else:
+            return "%s %i %i %i %s\n" % (
+                key, pack_num, offset, length, codec)
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _read(self, pack_num, offset, length):
+        f = self._readers.get(pack_num, None)
+        if f is None:
+            f = self._pack_path(pack_num).open('rb')
+            self._readers[pack_num] = f
+        f.seek(offset)
+        return f.read(length)
+
+    def store(self, data):
+        key = self.key(data)
+        with self.lock:
+            if key in self.index:
+                self.stored[key] = time.time()
+                return key
+            elif len(data) > self.max_block_size:
+                raise BlockSize
+            codec, data = self.encode(data)
+            if isinstance(data, bytearray):
+                data = bytes(data)
+            self._append(key, data, codec)
+            self.stored[key] = time.time()
+        return key
+
+    def retrieve(self, key):
+        with self.lock:
+            entry = self.index.get(key, None)
+            if entry is None:
+                raise BlockMissing(key)
+            data = self._read(*entry[:3])
+        return self.decode(entry[3], data)
+
+    def delete(self, key):
+        with self.lock:
+            self.stored.pop(key, None)
+            if self._remove_entry(key) is not None:
+                self._write_index("%s -\n" % key)
+
+    def iter_blocks(self):
+        with self.lock:
+            blocks = [(key, entry[2]) for key, entry in
+                      dict_items(self.index)]
+        for block in blocks:
+            yield block
+
+    def modified(self, key):
+        with self.lock:
+            return self.stored.get(key, None)
+
+    def compact(self, threshold=0.5):
+        """Reclaims the space used by deleted blocks
+
+        threshold
+            The fraction of a pack file that must be occupied by deleted
+            blocks before it is compacted.  Defaults to 0.5, use 0 to
+            compact all pack files containing deleted blocks.
+
+        The remaining blocks in each pack file selected for compaction
+        are copied to a new pack file and the old pack file is removed.
+        Finally the index file is rewritten.  The store is locked for
+        the duration of the operation.  Returns the number of bytes
+        reclaimed, if there is nothing to reclaim the store is left
+        unchanged."""
+        reclaimed = 0
+        with self.lock:
+            old_packs = []
+            for pack_num in range3(self.pack_num + 1):
+                size = self._get_pack_size(pack_num)
+                if not size:
+                    continue
+                dead = size - self.pack_live.get(pack_num, 0)
+                if dead and dead >= threshold * size:
+                    old_packs.append((pack_num, dead))
+            if not old_packs:
+                return reclaimed
+            # always write to a new pack so we don't compact into a
+            # pack we're compacting
+            self._close_writer()
+            self.pack_num += 1
+            self.pack_size = self._get_pack_size(self.pack_num)
+            pack_keys = {}
+            for key, entry in dict_items(self.index):
+                pack_keys.setdefault(entry[0], []).append(key)
+            for pack_num, dead in old_packs:
+                for key in pack_keys.get(pack_num, ()):
+                    entry = self.index[key]
+                    self._append(key, self._read(*entry[:3]), entry[3])
+                f = self._readers.pop(pack_num, None)
+                if f is not None:
+                    f.close()
+                self._pack_path(pack_num).remove()
+                self.pack_live.pop(pack_num, None)
+                reclaimed += dead
+            # now rewrite the index
+            tmp_path = self.dpath.join('pack.idx.tmp')
+            with tmp_path.open('wb') as f:
+                for key, entry in dict_items(self.index):
+                    f.write(self._index_record(key, entry).encode('ascii'))
+            self._index_file.close()
+            if self.index_path.exists():
+                # rename does not replace existing files on Windows
+                self.index_path.remove()
+            tmp_path.move(self.index_path)
+            self._index_file = self.index_path.open('ab')
+        return reclaimed
+
+    def close(self):
+        """Closes the open pack and index files
+
+        The store must not be used after it has been closed."""
+        with self.lock:
+            self._close_writer()
+            for f in dict_values(self._readers):
+                f.close()
+            self._readers = {}
+            self._index_file.close()
 
 
 class EDMBlockStore(BlockStore):
@@ -200,23 +654,55 @@ class EDMBlockStore(BlockStore):
     The entity must have a string key property named *hash* large enough
     to hold the hex strings generated by the selected hashing module.
     It must also have a Binary *data* property capable of holding
-    max_block_size bytes."""
+    max_block_size bytes.
+
+    To store compressed blocks the entity must also have a nullable
+    string property named *codec* in which the name of the codec is
+    recorded.
+
+    If the entity has a DateTime property named *modified* it is set to
+    the UTC time at which the block was last stored, see
+    :py:meth:`BlockStore.modified`.  Without it the age of a block is
+    unknown and garbage collection cannot safely be run while streams
+    are being written."""
 
     def __init__(self, entity_set, **kwargs):
         super(EDMBlockStore, self).__init__(**kwargs)
         self.entity_set = entity_set
+        self.codec_property = 'codec' in entity_set.entityType
+        if self.codec is not None and not self.codec_property:
+            raise ValueError("%s has no codec property" %
+                             entity_set.entityType.name)
+        self.modified_property = 'modified' in entity_set.entityType
 
     def store(self, data):
         key = self.key(data)
         with self.entity_set.open() as blocks:
-            if key in blocks:
+            if self.modified_property:
+                blocks.set_expand(None, {'hash': None, 'modified': None})
+                try:
+                    # touch the existing block
+                    block = blocks[key]
+                    block['modified'].set_from_value(
+                        TimePoint.from_now_utc())
+                    blocks.update_entity(block)
+                    return key
+                except KeyError:
+                    pass
+            elif key in blocks:
                 return key
-            elif len(data) > self.max_block_size:
+            if len(data) > self.max_block_size:
                 raise BlockSize
             try:
+                codec, data = self.encode(data)
                 block = blocks.new_entity()
                 block['hash'].set_from_value(key)
                 block['data'].set_from_value(data)
+                if self.codec_property:
+                    block['codec'].set_from_value(codec)
+                if self.modified_property:
+                    block['modified'].set_from_value(
+                        TimePoint.from_now_utc())
                 blocks.insert_entity(block)
             except edm.ConstraintError:
                 # race condition, duplicate key
@@ -227,9 +713,12 @@ class EDMBlockStore(BlockStore):
         with self.entity_set.open() as blocks:
             try:
                 block = blocks[key]
-                return block['data'].value
             except KeyError:
                 raise BlockMissing
+            if self.codec_property:
+                return self.decode(block['codec'].value, block['data'].value)
+            else:
+                return block['data'].value
 
     def delete(self, key):
         with self.entity_set.open() as blocks:
@@ -238,6 +727,149 @@ class EDMBlockStore(BlockStore):
             except KeyError:
                 pass
 
+    def iter_blocks(self):
+        with self.entity_set.open() as blocks:
+            # don't load the data
+            blocks.set_expand(None, {'hash': None})
+            for block in blocks.itervalues():
+                yield block['hash'].value, None
+
+    def modified(self, key):
+        if not self.modified_property:
+            return None
+        with self.entity_set.open() as blocks:
+            blocks.set_expand(None, {'hash': None, 'modified': None})
+            try:
+                block = blocks[key]
+            except KeyError:
+                return None
+            if block['modified']:
+                return block['modified'].value.with_zone(
+                    zdirection=0).get_unixtime()
+            else:
+                return None
+
+
+class CachingBlockStore(BlockStore):
+
+    """Class for caching recently used blocks in memory
+
+    bs
+        The :py:class:`BlockStore` instance in which the blocks are
+        actually stored.  The max_block_size and hash_class of the
+        caching store are taken from *bs*.
+
+    cache_size
+        The maximum number of bytes of block data to keep in the cache.
+        Defaults to 64 times :py:data:`MAX_BLOCK_SIZE` (4MB).
+
+    Blocks are keyed on the hash of their content so a cached block
+    can never be out of date, a block shared by many streams is only
+    read from the underlying store once while it remains in the cache.
+    When the cache is full the least recently used blocks are
+    discarded.  Deleted blocks are removed from the cache
+    immediately."""
+
+    def __init__(self, bs, cache_size=64 * MAX_BLOCK_SIZE):
+        super(CachingBlockStore, self).__init__(
+            max_block_size=bs.max_block_size, hash_class=bs.hash_class)
+        self.bs = bs
+        #: the maximum number of bytes to keep in the cache
+        self.cache_size = cache_size
+        # maps key on to a (data, tick) tuple
+        self.cache = {}
+        # (key, tick) tuples in order of use, entries for which tick no
+        # longer matches the cache are stale and are skipped
+        self.cache_order = collections.deque()
+        self.cache_tick = 0
+        self.cache_bytes = 0
+        self.cache_lock = threading.Lock()
+        self.cache_generation = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def store(self, data):
+        return self.bs.store(data)
+
+    def retrieve(self, key):
+        with self.cache_lock:
+            entry = self.cache.get(key, None)
+            if entry is not None:
+                # mark as the most recently used block
+                self._use(key, entry[0])
+                self.cache_hits += 1
+                return entry[0]
+            self.cache_misses += 1
+            generation = self.cache_generation
+        data = self.bs.retrieve(key)
+        if isinstance(data, bytearray):
+            data = bytes(data)
+        self._add(key, data, generation)
+        return data
+
+    def _use(self, key, data):
+        # called with the cache lock held
+        self.cache_tick += 1
+        self.cache[key] = (data, self.cache_tick)
+        self.cache_order.append((key, self.cache_tick))
+        if len(self.cache_order) > 2 * len(self.cache) + 64:
+            # too many stale entries, rebuild the order
+            self.cache_order = collections.deque(
+                sorted(((k, e[1]) for k, e in dict_items(self.cache)),
+                       key=lambda x: x[1]))
+
+    def _add(self, key, data, generation):
+        size = len(data)
+        if size > self.cache_size:
+            return
+        with self.cache_lock:
+            if generation != self.cache_generation or key in self.cache:
+                # a block was deleted while we were reading from the
+                # underlying store, don't risk caching a deleted block
+                return
+            while self.cache and self.cache_bytes + size > self.cache_size:
+                old_key, tick = self.cache_order.popleft()
+                entry = self.cache.get(old_key, None)
+                if entry is not None and entry[1] == tick:
+                    # the least recently used block
+                    del self.cache[old_key]
+                    self.cache_bytes -= len(entry[0])
+            self._use(key, data)
+            self.cache_bytes += size
+
+    def delete(self, key):
+        with self.cache_lock:
+            self.cache_generation += 1
+            entry = self.cache.pop(key, None)
+            if entry is not None:
+                self.cache_bytes -= len(entry[0])
+        self.bs.delete(key)
+
+    def iter_blocks(self):
+        return self.bs.iter_blocks()
+
+    def modified(self, key):
+        return self.bs.modified(key)
+
+    def clear_cache(self):
+        """Removes all blocks from the cache"""
+        with self.cache_lock:
+            self.cache_generation += 1
+            self.cache.clear()
+            self.cache_order.clear()
+            self.cache_bytes = 0
+
+    def cache_stats(self):
+        """Return information about the cache
+
+        The return result is a tuple of four integers, indicating the
+        number of blocks in the cache, the total size of the cached
+        blocks in bytes, the number of cache hits and the number of
+        cache misses."""
+        with self.cache_lock:
+            return (len(self.cache), self.cache_bytes, self.cache_hits,
+                    self.cache_misses)
+
 
 class LockStoreContext(object):
 
@@ -282,12 +914,42 @@ class LockStore(object):
     field named *created* for storing the UTC timestamp when each lock
     is created. The created property is used for optimistic concurrency
     control during updates and must be identified as having fixed
-    concurrency mode in the entity type's definition."""
+    concurrency mode in the entity type's definition.
+
+    Locks are shared by all processes using the same entity set, for
+    single-process use see :py:class:`MemoryLockStore`."""
 
     def __init__(self, entity_set, lock_timeout=180):
         self.entity_set = entity_set
         self.lock_timeout = lock_timeout
         self.magic = _magic()
+        self._stats_lock = threading.Lock()
+        self._stats = [0, 0, 0, 0, 0.0]
+
+    def _record(self, contended, timeout, stale, wait_time):
+        with self._stats_lock:
+            if not timeout:
+                self._stats[0] += 1
+            if contended:
+                self._stats[1] += 1
+            if timeout:
+                self._stats[2] += 1
+            if stale:
+                self._stats[3] += 1
+            self._stats[4] += wait_time
+
+    def lock_stats(self):
+        """Return contention metrics for this lock store
+
+        The return result is a tuple of (locks, contended, timeouts,
+        stale, wait_time).  The first four values are integers
+        indicating the number of locks acquired, the number of calls to
+        :py:meth:`lock` that could not acquire the lock immediately, the
+        number of calls that timed out and the number of stale locks
+        that were reused.  wait_time is the total time in seconds spent
+        waiting for contended locks."""
+        with self._stats_lock:
+            return tuple(self._stats)
 
     def lock(self, hash_key, timeout=60):
         """Acquires the lock on hash_key or raises LockError
@@ -301,9 +963,10 @@ class LockStore(object):
         lock still cannot be obtained :py:class:`LockError` is raised."""
         owner = "%s_%i" % (self.magic, threading.current_thread().ident)
         with self.entity_set.open() as locks:
-            tnow = time.time()
+            tnow = tstart = time.time()
             tstop = tnow + timeout
             twait = 0
+            contended = False
             while tnow < tstop:
                 time.sleep(twait)
                 lock = locks.new_entity()
@@ -312,9 +975,11 @@ class LockStore(object):
                 lock['created'].set_from_value(TimePoint.from_now_utc())
                 try:
                     locks.insert_entity(lock)
+                    self._record(contended, False, False,
+                                 time.time() - tstart if contended else 0)
                     return LockStoreContext(self, hash_key)
                 except edm.ConstraintError:
-                    pass
+                    contended = True
                 try:
                     lock = locks[hash_key]
                 except KeyError:
@@ -331,6 +996,7 @@ class LockStore(object):
                         locks.update_entity(lock)
                         logging.warning("LockingBlockStore removed stale lock "
                                         "on %s", hash_key)
+                        self._record(True, False, True, time.time() - tstart)
                         return LockStoreContext(self, hash_key)
                     except KeyError:
                         twait = 0
@@ -341,6 +1007,7 @@ class LockStore(object):
                 twait = random.randint(0, timeout // 5)
                 tnow = time.time()
         logging.warning("LockingBlockStore: timeout locking %s", hash_key)
+        self._record(True, True, False, time.time() - tstart)
         raise LockError
 
     def unlock(self, hash_key):
@@ -400,6 +1067,200 @@ class LockStore(object):
                                 "on busy hash %s", hash_key)
 
 
+class MemoryLockStore(LockStore):
+
+    """Class for storing simple locks in memory
+
+    lock_timeout
+        As for :py:class:`LockStore`, defaults to 180s (3 minutes).
+
+    stripes
+        The number of underlying thread conditions used to manage the
+        locks, hash keys are distributed amongst them.  Defaults to 64.
+
+    A drop-in replacement for :py:class:`LockStore` that keeps the
+    locks in a process-local table, avoiding a database write on every
+    lock and unlock and waiting on a condition rather than polling.
+    The locks are not visible to other processes so this class must
+    only be used when a single process has access to the block
+    store."""
+
+    def __init__(self, lock_timeout=180, stripes=64):
+        super(MemoryLockStore, self).__init__(None, lock_timeout)
+        self._stripes = [(threading.Condition(threading.Lock()), {})
+                         for i in range3(stripes)]
+
+    def _stripe(self, hash_key):
+        return self._stripes[hash(hash_key) % len(self._stripes)]
+
+    def lock(self, hash_key, timeout=60):
+        owner = threading.current_thread().ident
+        cv, held = self._stripe(hash_key)
+        with cv:
+            tnow = tstart = time.time()
+            tstop = tnow + timeout
+            contended = stale = False
+            while hash_key in held:
+                lock_owner, locktime = held[hash_key]
+                if locktime + self.lock_timeout < tnow:
+                    logging.warning("MemoryLockStore removed stale lock "
+                                    "on %s", hash_key)
+                    stale = True
+                    break
+                contended = True
+                if tnow >= tstop:
+                    logging.warning("MemoryLockStore: timeout locking %s",
+                                    hash_key)
+                    self._record(True, True, False, tnow - tstart)
+                    raise LockError
+                cv.wait(min(tstop, locktime + self.lock_timeout) - tnow)
+                tnow = time.time()
+            held[hash_key] = (owner, tnow)
+        self._record(contended or stale, False, stale,
+                     tnow - tstart if contended else 0)
+        return LockStoreContext(self, hash_key)
+
+    def unlock(self, hash_key):
+        owner = threading.current_thread().ident
+        cv, held = self._stripe(hash_key)
+        with cv:
+            lock = held.get(hash_key, None)
+            if lock is None:
+                logging.warning("MemoryLockStore: stale lock detected "
+                                "on hash %s", hash_key)
+            elif lock[0] != owner:
+                logging.warning("MemoryLockStore: stale lock reused "
+                                "on busy hash %s", hash_key)
+            else:
+                del held[hash_key]
+                cv.notify_all()
+
+
+class BlockRequest(object):
+
+    """Represents a request to retrieve a block in the background
+
+    Created by :py:meth:`BlockWorkerPool.submit`."""
+
+    def __init__(self, block, verify=False):
+        self.block = block          #: the block entity to retrieve
+        self.verify = verify        #: True if the block is verified
+        self.data = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self, ss):
+        """Called by a worker thread to process the request"""
+        self.data = ss.retrieve_block(self.block, self.verify, buffer=True)
+
+    def result(self):
+        """Waits for the request to complete and returns the data
+
+        If an error occurred while processing the request it is raised
+        instead."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.data
+
+
+class StoreRequest(BlockRequest):
+
+    """Represents a request to store data in the background
+
+    Created by :py:meth:`BlockWorkerPool.submit_store`, the result is
+    the hash key of the stored data."""
+
+    def __init__(self, data):
+        super(StoreRequest, self).__init__(None)
+        self.data = data
+
+    def run(self, ss):
+        self.data = ss.store_data(self.data)
+
+
+class BlockWorkerPool(object):
+
+    """A small pool of threads that retrieve and store blocks
+
+    ss
+        The :py:class:`StreamStore` from which blocks are retrieved.
+
+    max_threads
+        The maximum number of threads used, defaults to 2.
+
+    idle_timeout
+        The number of seconds an idle thread waits for a new request
+        before exiting, defaults to 10.
+
+    Threads are started on demand when requests are submitted and are
+    reused for subsequent requests, they only exit once they have been
+    idle for idle_timeout seconds.  Each thread that accesses a
+    database-backed store uses its own database connection."""
+
+    def __init__(self, ss, max_threads=2, idle_timeout=10):
+        self.ss = ss
+        self.max_threads = max_threads
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Condition()
+        self.queue = collections.deque()
+        self.nthreads = 0
+        self.nbusy = 0
+
+    def submit(self, block, verify=False):
+        """Submits a request to retrieve *block*
+
+        Returns a :py:class:`BlockRequest` instance that can be used to
+        obtain the data when it is required."""
+        return self.submit_request(BlockRequest(block, verify))
+
+    def submit_store(self, data):
+        """Submits a request to store *data*
+
+        Returns a :py:class:`StoreRequest` instance, the result of the
+        request is the hash key of the data, see
+        :py:meth:`StreamStore.store_data`."""
+        return self.submit_request(StoreRequest(data))
+
+    def submit_request(self, request):
+        """Submits a request for processing by a worker thread
+
+        request
+            A :py:class:`BlockRequest` instance."""
+        with self.lock:
+            self.queue.append(request)
+            if (len(self.queue) > self.nthreads - self.nbusy and
+                    self.nthreads < self.max_threads):
+                self.nthreads += 1
+                t = threading.Thread(target=self._run)
+                t.daemon = True
+                t.start()
+            else:
+                # wake an idle thread
+                self.lock.notify()
+        return request
+
+    def _run(self):
+        while True:
+            with self.lock:
+                tidle = time.time() + self.idle_timeout
+                while not self.queue:
+                    twait = tidle - time.time()
+                    if twait <= 0:
+                        self.nthreads -= 1
+                        return
+                    self.lock.wait(twait)
+                request = self.queue.popleft()
+                self.nbusy += 1
+            try:
+                request.run(self.ss)
+            except Exception as err:
+                request.error = err
+            with self.lock:
+                self.nbusy -= 1
+            request.done.set()
+
+
 class StreamStore(object):
 
     """Class for storing stream objects
@@ -469,13 +1330,42 @@ class StreamStore(object):
             A block sequence integer
 
         hash
-            The hash key of the block in the block store"""
-
-    def __init__(self, bs, ls, entity_set):
+            The hash key of the block in the block store
+
+    read_ahead (optional)
+        The default number of blocks to retrieve in advance when
+        reading a stream sequentially, see :py:class:`BlockStream`.
+        Defaults to 0, no read-ahead.
+
+    write_buffer (optional)
+        The maximum number of new blocks each :py:class:`BlockStream`
+        may be storing in the background when writing, defaults to 0,
+        blocks are stored immediately.  In either case the list of new
+        blocks is only committed when the stream is flushed or closed.
+
+        Background stores are done by worker threads that need their
+        own connections to any database used by the block and lock
+        stores.  Don't use them with a database that only supports a
+        single connection (such as an in-memory SQLite database) or if
+        the caller holds a connection to the same database while
+        writing: the workers may never obtain a connection.
+
+    worker_threads (optional)
+        The maximum number of threads used to retrieve and store blocks
+        in the background, defaults to 2."""
+
+    def __init__(self, bs, ls, entity_set, read_ahead=0, write_buffer=0,
+                 worker_threads=2):
         self.bs = bs
         self.ls = ls
         self.stream_set = entity_set
         self.block_set = entity_set.get_target('Blocks')
+        #: the default read-ahead window for new streams
+        self.read_ahead = read_ahead
+        #: the maximum number of blocks stored in the background
+        self.write_buffer = write_buffer
+        #: the :py:class:`BlockWorkerPool` used for background operations
+        self.workers = BlockWorkerPool(self, worker_threads)
 
     def new_stream(self,
                    mimetype=params.MediaType('application', 'octet-stream'),
@@ -518,7 +1408,7 @@ class StreamStore(object):
             stream = streams[stream_id]
         return stream
 
-    def open_stream(self, stream, mode="r"):
+    def open_stream(self, stream, mode="r", verify=False, read_ahead=None):
         """Returns a file-like object for a stream.
 
         Returns an object derived from io.RawIOBase.
@@ -530,12 +1420,22 @@ class StreamStore(object):
             Files are always opened in binary mode.  The characters "r",
             "w" and "+" and "a" are honoured.
 
-        Warning: read and write methods of the resulting objects do not
-        always return all requested bytes.  In particular, read or write
-        operations never cross block boundaries in a single call."""
+        verify
+            If True, each block read from the stream is checked against
+            its hash key, see :py:meth:`retrieve_block`.
+
+        read_ahead
+            The number of blocks to retrieve in advance when reading,
+            defaults to :py:attr:`read_ahead`.
+
+        Warning: write methods of the resulting objects do not always
+        write all the bytes passed.  In particular, write operations
+        never cross block boundaries in a single call."""
         if stream is None:
             raise ValueError
-        return BlockStream(self, stream, mode)
+        if read_ahead is None:
+            read_ahead = self.read_ahead
+        return BlockStream(self, stream, mode, verify, read_ahead)
 
     def delete_stream(self, stream):
         """Deletes a stream from the store.
@@ -559,6 +1459,43 @@ class StreamStore(object):
                 self.bs.store(data)
             return block
 
+    def store_data(self, data):
+        """Stores the data for a block in the block store
+
+        data
+            A binary string not exceeding the maximum block size
+
+        The hash key is locked while the data is stored.  Returns the
+        hash key of the data."""
+        hash_key = self.bs.key(data)
+        with self.ls.lock(hash_key):
+            self.bs.store(data)
+        return hash_key
+
+    def store_blocklist(self, stream, blocks):
+        """Adds a list of new blocks to a stream
+
+        stream
+            A stream entity
+
+        blocks
+            A list of new block entities created from the stream's
+            Blocks navigation property with their num and hash
+            properties set.  The data must already have been stored (see
+            :py:meth:`store_data`).
+
+        The blocks are inserted using the collection's insert_entities
+        method allowing the entire list to be added in a single batch
+        where the underlying data service supports it.
+
+        Unlike :py:meth:`store_block` the hash keys are not locked
+        while the blocks are inserted, block data removed by a
+        concurrent deletion of an identical block in the interval
+        between storing the data and committing the block list will be
+        reported as missing when the block is read."""
+        with stream['Blocks'].open() as coll:
+            coll.insert_entities(blocks)
+
     def update_block(self, block, data):
         hash_key = block['hash'].value
         new_hash = self.bs.key(data)
@@ -589,8 +1526,31 @@ class StreamStore(object):
             for block in blocks.itervalues():
                 yield block
 
-    def retrieve_block(self, block):
-        return self.bs.retrieve(block['hash'].value)
+    def retrieve_block(self, block, verify=False, buffer=False):
+        """Returns the data for a block
+
+        block
+            A block entity from :py:meth:`retrieve_blocklist`
+
+        verify
+            If True, the key of the data is calculated and compared with
+            the block's hash, :py:class:`BlockCorrupt` is raised if they
+            differ.  This allows the integrity of any part of a stream
+            to be checked without reading the whole stream.
+
+        buffer
+            If True, the data is returned using the block store's
+            retrieve_buffer method, avoiding a copy of the data where
+            possible.  The result may be a memoryview rather than a
+            binary string."""
+        hash_key = block['hash'].value
+        if buffer:
+            data = self.bs.retrieve_buffer(hash_key)
+        else:
+            data = self.bs.retrieve(hash_key)
+        if verify and self.bs.key(data) != hash_key:
+            raise BlockCorrupt(hash_key)
+        return data
 
     def delete_blocks(self, stream, from_num=0):
         blocks = list(self.retrieve_blocklist(stream))
@@ -613,6 +1573,115 @@ class StreamStore(object):
                         # remove orphan block from block store
                         self.bs.delete(hash_key)
 
+    def collect_garbage(self, dry_run=False, batch_size=1000, grace=3600):
+        """Removes orphaned blocks from the block store
+
+        dry_run
+            If True, orphaned blocks are reported but not removed.
+
+        batch_size
+            The number of block list entries loaded in each query, at
+            most 100 hash keys are checked in each query during the
+            sweep.
+
+        grace
+            The minimum age, in seconds, of a block that can be removed.
+            Defaults to 1 hour.
+
+        Orphaned blocks are blocks of data in the block store that are
+        not referenced by any stream.  They can be left behind if a
+        process fails while writing or deleting a stream.  The contents
+        of the block store are listed first, then all hash keys
+        referenced by the block list are loaded, page by page, and
+        finally the unreferenced blocks are removed.  Before removal,
+        the block list is checked again for references to each batch of
+        unreferenced blocks (using a single query per batch) so blocks
+        added to a stream during the collection are not removed.
+
+        A stream that is open for writing stores its new blocks before
+        adding them to the block list so blocks that were stored less
+        than *grace* seconds ago are never removed, see
+        :py:meth:`BlockStore.modified`.  Blocks of unknown age are
+        treated as being older than *grace*.  Writers that take longer
+        than *grace* seconds to commit their blocks are not protected.
+
+        Returns a tuple of (blocks, nbytes): the number of orphaned
+        blocks found and the number of bytes they occupy in the block
+        store (the bytes reclaimed unless dry_run is True).  Blocks of
+        unknown size, see :py:meth:`BlockStore.iter_blocks`, are not
+        included in nbytes."""
+        candidates = dict(self.bs.iter_blocks())
+        # mark phase: remove everything that is referenced
+        with self.block_set.open() as coll:
+            coll.set_expand(None, {'hash': None})
+            coll.set_page(batch_size)
+            while candidates:
+                page = list(coll.iterpage(set_next=True))
+                if not page:
+                    break
+                for block in page:
+                    candidates.pop(block['hash'].value, None)
+        nblocks = nbytes = 0
+        tlimit = time.time() - grace
+
+        def expired(hash_key):
+            modified = self.bs.modified(hash_key)
+            return modified is None or modified < tlimit
+
+        if dry_run:
+            for hash_key, size in dict_items(candidates):
+                if not expired(hash_key):
+                    continue
+                logging.info("StreamStore: orphaned block %s (%s bytes)",
+                             hash_key, str(size))
+                nblocks += 1
+                nbytes += size or 0
+            return nblocks, nbytes
+        # sweep phase
+        hash_keys = list(candidates)
+        chunk_size = min(batch_size, 100)
+        with self.block_set.open() as base_coll:
+            base_coll.set_expand(None, {'hash': None})
+            for i in range3(0, len(hash_keys), chunk_size):
+                chunk = hash_keys[i:i + chunk_size]
+                # remove any keys referenced since the mark phase
+                base_coll.set_filter(self._hash_filter(chunk))
+                referenced = set(
+                    block['hash'].value for block in base_coll.itervalues())
+                for hash_key in chunk:
+                    if hash_key in referenced:
+                        continue
+                    size = candidates[hash_key]
+                    # writers store (or touch) blocks while holding the
+                    # lock, so check the age again before removal
+                    with self.ls.lock(hash_key):
+                        if not expired(hash_key):
+                            continue
+                        logging.info("StreamStore: removing orphaned block "
+                                     "%s (%s bytes)", hash_key, str(size))
+                        self.bs.delete(hash_key)
+                        nblocks += 1
+                        nbytes += size or 0
+        return nblocks, nbytes
+
+    def _hash_filter(self, hash_keys):
+        # returns a filter: hash eq <key> or hash eq <key> or ...
+        filter = None
+        for hash_key in hash_keys:
+            eq = core.BinaryExpression(core.Operator.eq)
+            eq.add_operand(core.PropertyExpression('hash'))
+            hash_value = edm.EDMValue.from_type(edm.SimpleType.String)
+            hash_value.set_from_value(hash_key)
+            eq.add_operand(core.LiteralExpression(hash_value))
+            if filter is None:
+                filter = eq
+            else:
+                new_filter = core.BinaryExpression(core.Operator.boolOr)
+                new_filter.add_operand(filter)
+                new_filter.add_operand(eq)
+                filter = new_filter
+        return filter
+
 
 class BlockStream(io.RawIOBase):
 
@@ -622,11 +1691,31 @@ class BlockStream(io.RawIOBase):
     binary mode.  They are seekable but lack efficiency if random access
     is used across block boundaries.  The main design criteria is to
     ensure that no more than one block is kept in memory at any one
-    time."""
-
-    def __init__(self, ss, stream, mode="r"):
+    time, unless a read-ahead window is used.
+
+    read_ahead
+        The number of blocks following the current block to retrieve in
+        advance using the stream store's
+        :py:class:`BlockWorkerPool`.  At most read_ahead+1 blocks are
+        kept in memory.  Read-ahead only applies to streams opened for
+        reading only, defaults to 0 (no read-ahead).
+
+    When writing, the data for new blocks may be stored in the
+    background using the same pool of worker threads (if the stream
+    store's write_buffer is non-zero) and the new blocks are only
+    added to the stream's block list, in a single batch, when the
+    stream is flushed or closed.  The stream's size, md5 and modified time are
+    updated at the same time."""
+
+    def __init__(self, ss, stream, mode="r", verify=False, read_ahead=0):
         self.ss = ss
         self.stream = stream
+        self.verify = verify
+        self.read_ahead = read_ahead
+        self._prefetch = {}
+        self._new_blocks = {}
+        self._stores = collections.deque()
+        self._smodified = False
         self.r = "r" in mode or "+" in mode
         self.w = "w" in mode or "+" in mode
         self.size = stream['size'].value
@@ -653,6 +1742,9 @@ class BlockStream(io.RawIOBase):
     def close(self):
         super(BlockStream, self).close()
         self.blocks = None
+        # release the current block, which may be a memory-mapped file
+        self._bdata = None
+        self._prefetch = {}
         self.r = self.w = False
 
     def readable(self):
@@ -675,7 +1767,7 @@ class BlockStream(io.RawIOBase):
             raise IOError("bad value for whence in seek")
         new_bnum = self.pos // self.block_size
         if new_bnum != self._bnum:
-            self.flush()
+            self._flush_block()
             self._bdata = None
             self._bnum = new_bnum
         self._bpos = self.pos % self.block_size
@@ -689,21 +1781,54 @@ class BlockStream(io.RawIOBase):
             self._btop = self.block_size
 
     def flush(self):
+        self._flush_block()
+        self._commit_blocks()
+
+    def _flush_block(self):
         if self._bdirty:
             # the current block is dirty, write it out
-            data = self._bdata[:self._btop]
+            data = bytes(self._bdata[:self._btop])
             if data:
                 block = self.blocks[self._bnum]
                 if block.exists:
-                    self.ss.update_block(block, bytes(data))
+                    self.ss.update_block(block, data)
                 else:
-                    self.blocks[self._bnum] = self.ss.store_block(
-                        self.stream, self._bnum, data)
+                    self._store_new_block(block, data)
                 if self._md5 is not None and self._bnum == self._md5num:
-                    self._md5.update(bytes(data))
+                    self._md5.update(data)
                     self._md5num += 1
                 else:
                     self._md5 = None
+            self._bdirty = False
+            self._smodified = True
+
+    def _store_new_block(self, block, data, bnum=None):
+        if bnum is None:
+            bnum = self._bnum
+        if self.ss.write_buffer:
+            while len(self._stores) >= self.ss.write_buffer:
+                self._wait_store()
+            self._stores.append((block, self.ss.workers.submit_store(data)))
+        else:
+            block['hash'].set_from_value(self.ss.store_data(data))
+        self._new_blocks[bnum] = block
+
+    def _wait_store(self):
+        block, request = self._stores.popleft()
+        block['hash'].set_from_value(request.result())
+
+    def _wait_stores(self):
+        while self._stores:
+            self._wait_store()
+
+    def _commit_blocks(self):
+        if self._smodified:
+            self._wait_stores()
+            if self._new_blocks:
+                new_blocks = [self._new_blocks[n] for n in
+                              sorted(self._new_blocks)]
+                self._new_blocks = {}
+                self.ss.store_blocklist(self.stream, new_blocks)
             if self.size != self.stream['size'].value:
                 self.stream['size'].set_from_value(self.size)
             now = TimePoint.from_now_utc()
@@ -713,32 +1838,92 @@ class BlockStream(io.RawIOBase):
             else:
                 self.stream['md5'].set_null()
             self.stream.commit()
-            self._bdirty = False
+            self._smodified = False
 
     def tell(self):
         return self.pos
 
     def readinto(self, b):
+        """Reads data into *b*
+
+        Unlike the default RawIOBase behaviour we continue reading
+        across block boundaries until *b* is full or the end of the
+        stream is reached."""
+        if not self.r:
+            raise IOError("stream not open for reading")
+        total = 0
+        blen = len(b)
+        while total < blen:
+            nbytes = self._btop - self._bpos
+            if nbytes <= 0:
+                # we must be at the file size limit
+                break
+            if self._bdata is None:
+                self._load_block()
+            if nbytes > blen - total:
+                nbytes = blen - total
+            b[total:total + nbytes] = \
+                self._bdata[self._bpos:self._bpos + nbytes]
+            total += nbytes
+            self.seek(nbytes, io.SEEK_CUR)
+        return total
+
+    def readview(self, size=-1):
+        """Reads up to *size* bytes from the current block
+
+        Returns a memoryview of the data without copying it, where the
+        underlying block store supports it the view refers directly to
+        a memory-mapped block file.  At most one block is returned in
+        each call (even if *size* is negative), an empty view indicates
+        the end of the stream.
+
+        If the stream is also open for writing the view refers to the
+        current block's write buffer and may change as a result of
+        subsequent writes."""
         if not self.r:
             raise IOError("stream not open for reading")
         nbytes = self._btop - self._bpos
         if nbytes <= 0:
-            # we must be at the file size limit
-            return 0
+            return memoryview(b'')
         if self._bdata is None:
-            # load the data
-            if self.w:
-                # create a full size block in case we also write
-                self._bdata = bytearray(self.block_size)
-                data = self.ss.retrieve_block(self.blocks[self._bnum])
-                self._bdata[:len(data)] = data
-            else:
-                self._bdata = self.ss.retrieve_block(self.blocks[self._bnum])
-        if nbytes > len(b):
-            nbytes = len(b)
-        b[:nbytes] = self._bdata[self._bpos:self._bpos + nbytes]
+            self._load_block()
+        if size >= 0 and nbytes > size:
+            nbytes = size
+        view = memoryview(self._bdata)[self._bpos:self._bpos + nbytes]
         self.seek(nbytes, io.SEEK_CUR)
-        return nbytes
+        return view
+
+    def _load_block(self):
+        if self.w:
+            # create a full size block in case we also write
+            self._bdata = bytearray(self.block_size)
+            self._wait_stores()
+            data = self.ss.retrieve_block(self.blocks[self._bnum],
+                                          self.verify, buffer=True)
+            self._bdata[:len(data)] = data
+        else:
+            self._bdata = self._retrieve_block()
+
+    def _retrieve_block(self):
+        bnum = self._bnum
+        if not self.read_ahead:
+            return self.ss.retrieve_block(self.blocks[bnum], self.verify,
+                                          buffer=True)
+        request = self._prefetch.pop(bnum, None)
+        # discard blocks outside the new window
+        for n in list(self._prefetch):
+            if n < bnum or n > bnum + self.read_ahead:
+                del self._prefetch[n]
+        for n in range3(bnum + 1,
+                        min(bnum + self.read_ahead + 1, len(self.blocks))):
+            if n not in self._prefetch:
+                self._prefetch[n] = self.ss.workers.submit(
+                    self.blocks[n], self.verify)
+        if request is None:
+            return self.ss.retrieve_block(self.blocks[bnum], self.verify,
+                                          buffer=True)
+        else:
+            return request.result()
 
     def write(self, b):
         if not self.w:
@@ -747,28 +1932,33 @@ class BlockStream(io.RawIOBase):
         nbytes = self.block_size - self._bpos
         if self._bdata is None:
             if self._btop <= 0:
-                # add a new empty blocks first
-                last_block = len(self.blocks)
-                while last_block < self._bnum:
-                    self.blocks.append(self.ss.store_block(
-                        self.stream, last_block, bytearray(self.block_size)))
-                    last_block += 1
-                    self.size = last_block * self.block_size
-                # force the new size to be written
-                self._bdata = bytearray(self.block_size)
-                self._bdirty = True
-                self.flush()
-                # finally add the last block, but don't store it yet
                 with self.stream['Blocks'].open() as blist:
+                    # add a new empty blocks first
+                    last_block = len(self.blocks)
+                    while last_block < self._bnum:
+                        new_block = blist.new_entity()
+                        new_block['num'].set_from_value(last_block)
+                        self.blocks.append(new_block)
+                        self._store_new_block(
+                            new_block, bytes(bytearray(self.block_size)),
+                            last_block)
+                        self._md5 = None
+                        last_block += 1
+                        self.size = last_block * self.block_size
+                    # finally add the last block, but don't store it yet
                     new_block = blist.new_entity()
                     new_block['num'].set_from_value(self._bnum)
                     self.blocks.append(new_block)
+                # force the new size to be written
+                self._bdata = bytearray(self.block_size)
+                self._smodified = True
                 self.size = self.pos
                 self._set_btop()
                 if self._bpos:
                     self._bdirty = True
             else:
                 self._bdata = bytearray(self.block_size)
+                self._wait_stores()
                 data = self.ss.retrieve_block(self.blocks[self._bnum])
                 self._bdata[:len(data)] = data
         if nbytes > len(b):
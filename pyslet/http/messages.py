@@ -1743,6 +1743,31 @@ class Request(Message):
             raise TypeError
         self.set_header("Accept-Encoding", str(accept_value))
 
+    def get_range(self):
+        """Returns a :py:class:`Range` instance or None if no "Range"
+        header is present."""
+        field_value = self.get_header("Range")
+        if field_value is not None:
+            return Range.from_str(field_value)
+        else:
+            return None
+
+    def set_range(self, range):
+        """Sets the "Range" header, replacing any existing value.
+
+        range
+            A :py:class:`Range` instance or a string that one can be
+            parsed from.  If range is None the Range header is
+            removed."""
+        if range is None:
+            self.set_header("Range", None)
+            return
+        if is_string(range):
+            range = Range.from_str(range)
+        if not isinstance(range, Range):
+            raise TypeError
+        self.set_header("Range", str(range))
+
     def get_cookie(self):
         """Reads the 'Cookie' header(s)
 
@@ -2756,6 +2781,76 @@ class ContentRange(object):
                 (self.total_len is None or self.last_byte < self.total_len))
 
 
+class Range(object):
+
+    """Represents the value of a Range request header
+
+    unit
+        The range unit, defaults to "bytes".
+
+    ranges
+        A list of (first_byte, last_byte) tuples.  first_byte is None
+        for a suffix range in which case last_byte is the number of
+        bytes requested from the end of the entity.  last_byte is None
+        if the range extends to the end of the entity.
+
+    The built-in str function can be used to format instances according
+    to the grammar defined in the specification.
+
+    Instances are immutable."""
+
+    def __init__(self, unit="bytes", ranges=()):
+        self.unit = unit                #: the range unit
+        self.ranges = tuple(ranges)     #: the tuple of byte ranges
+
+    @classmethod
+    def from_str(cls, source):
+        """Creates a Range instance from a *source* string."""
+        p = HeaderParser(source)
+        r = p.require_range()
+        p.parse_sp()
+        p.require_end("Range specification")
+        return r
+
+    def __str__(self):
+        result = []
+        for first_byte, last_byte in self.ranges:
+            if first_byte is None:
+                result.append("-%i" % last_byte)
+            elif last_byte is None:
+                result.append("%i-" % first_byte)
+            else:
+                result.append("%i-%i" % (first_byte, last_byte))
+        return "%s=%s" % (self.unit, ','.join(result))
+
+    def get_content_ranges(self, total_len):
+        """Returns the byte ranges that apply to an entity
+
+        total_len
+            The total length of the entity
+
+        Returns a list of :py:class:`ContentRange` instances, one for
+        each satisfiable range in the order requested.  If there are no
+        satisfiable ranges the list is empty.  If the unit is not bytes
+        then None is returned, indicating that the header should be
+        ignored."""
+        if self.unit.lower() != "bytes":
+            return None
+        result = []
+        for first_byte, last_byte in self.ranges:
+            if first_byte is None:
+                # suffix range
+                if not last_byte:
+                    continue
+                first_byte = max(total_len - last_byte, 0)
+                last_byte = total_len - 1
+            elif last_byte is None or last_byte >= total_len:
+                last_byte = total_len - 1
+            if first_byte < total_len:
+                result.append(ContentRange(first_byte, last_byte, total_len))
+        return result
+
+
 class HeaderParser(params.ParameterParser):
 
     """A special parser for parsing HTTP headers from TEXT
@@ -2911,6 +3006,35 @@ class HeaderParser(params.ParameterParser):
                 "Expected digits or * for instance-length")
         return ContentRange(first_byte, last_byte, total_len)
 
+    def require_range(self):
+        """Parses a :py:class:`Range` instance."""
+        self.parse_sp()
+        unit = self.require_token("range unit").decode('ascii')
+        self.parse_sp()
+        self.require_separator(EQUALS_SIGN, "ranges-specifier")
+        ranges = []
+        while True:
+            self.parse_sp()
+            spec = self.require_token("byte-range-spec").split(b'-')
+            if len(spec) != 2 or not (spec[0] or spec[1]):
+                raise grammar.BadSyntax("Expected byte-range-spec")
+            for digits in spec:
+                if digits and not grammar.is_digits(digits):
+                    raise grammar.BadSyntax(
+                        "Expected digits in byte-range-spec")
+            first_byte = int(spec[0]) if spec[0] else None
+            last_byte = int(spec[1]) if spec[1] else None
+            if first_byte is not None and last_byte is not None and \
+                    last_byte < first_byte:
+                raise grammar.BadSyntax(
+                    "Invalid byte-range-spec: %i-%i" %
+                    (first_byte, last_byte))
+            ranges.append((first_byte, last_byte))
+            self.parse_sp()
+            if not self.parse_separator(COMMA):
+                break
+        return Range(unit, ranges)
+
     def require_product_token_list(self):
         """Parses a list of product tokens
 
@@ -64,10 +64,10 @@ class MySQLEntityContainer(sqlds.SQLEntityContainer):
         self.passwd = passwd
         self.mysql_options = mysql_options
 
-#     def get_collection_class(self):
-#         """Overridden to return :py:class:`MySQLEntityCollection`"""
-#         return MySQLEntityCollection
-#
+    def get_collection_class(self):
+        """Overridden to return :py:class:`MySQLEntityCollection`"""
+        return MySQLEntityCollection
+
 #     def get_symmetric_navigation_class(self):
 #         """Overridden to return :py:class:`MySQLAssociationCollection`"""
 #         return MySQLAssociationCollection
@@ -88,6 +88,43 @@ class MySQLEntityContainer(sqlds.SQLEntityContainer):
             **self.mysql_options)
         return dbc
 
+    def new_cursor(self, connection, streaming=False):
+        """Uses SSCursor for streaming
+
+        The default cursor class stores the entire result set in client
+        memory.  Rows from an SSCursor are read from the server on
+        demand."""
+        if streaming:
+            return connection.cursor(dbapi.cursors.SSCursor)
+        else:
+            return connection.cursor()
+
+    def ping_connection(self, connection):
+        """Uses the connection's ping method"""
+        try:
+            connection.ping()
+            return True
+        except dbapi.Error as err:
+            logging.warning("MySQL connection failed ping: %s", str(err))
+            return False
+
+    def estimate_count(self, transaction, table_name):
+        """Uses the TABLE_ROWS value from information_schema.TABLES
+
+        For InnoDB tables this value is only an approximation."""
+        if table_name.startswith('`') and table_name.endswith('`'):
+            table_name = table_name[1:-1]
+        params = self.ParamsClass()
+        query = "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE " \
+            "TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s" % \
+            params.add_param(table_name)
+        logging.info("%s; %s", query, str(params.params))
+        transaction.execute(query, params)
+        row = transaction.cursor.fetchone()
+        if row is None or row[0] is None:
+            return None
+        return int(row[0])
+
     def mangle_name(self, source_path):
         """Incorporates the table name prefix"""
         if len(source_path) == 1 and self.prefix:
@@ -220,15 +257,51 @@ class MySQLEntityContainer(sqlds.SQLEntityContainer):
                 self).prepare_sql_value(simple_value)
 
     def limit_clause(self, skip, top):
+        """Overridden to use MySQL's LIMIT and OFFSET syntax
+
+        MySQL does not allow OFFSET without LIMIT so the largest
+        possible limit is used when top is None, as recommended by the
+        MySQL documentation."""
         clause = []
         if top:
             clause.append('LIMIT %i ' % top)
+        elif skip:
+            clause.append('LIMIT 18446744073709551615 ')
         if skip:
             clause.append('OFFSET %i ' % skip)
             skip = 0
         return skip, ''.join(clause)
 
 
+class MySQLEntityCollection(sqlds.SQLEntityCollection):
+
+    """MySQL-specific collection for entity sets"""
+
+    def _auto_key_name(self):
+        if len(self.entity_set.keys) != 1:
+            raise NotImplementedError(
+                "Automatic keys require a single key property")
+        return self.container.mangled_names[
+            (self.entity_set.name, self.entity_set.keys[0])]
+
+    def where_last(self, entity, params):
+        """Uses LAST_INSERT_ID() to find the AUTO_INCREMENT key"""
+        return ' WHERE %s = LAST_INSERT_ID()' % self._auto_key_name()
+
+    def where_last_batch(self, entities, params):
+        """Uses LAST_INSERT_ID() and the number of rows inserted
+
+        The database module rewrites executemany on an INSERT statement
+        as a single multi-row INSERT and, for such statements, MySQL
+        returns the key of the *first* row inserted from LAST_INSERT_ID()
+        and allocates the keys consecutively (unless the server has been
+        configured with innodb_autoinc_lock_mode=2)."""
+        kname = self._auto_key_name()
+        return (' WHERE %s >= LAST_INSERT_ID() AND '
+                '%s < LAST_INSERT_ID() + %i ORDER BY %s' %
+                (kname, kname, len(entities), kname))
+
+
 class MySQLStreamStore(blockstore.StreamStore):
 
     """A stream store backed by a MySQL database.
@@ -2994,7 +2994,7 @@ class EntityCollection(edm.EntityCollection):
             raise ExpectedMediaLinkCollection
         raise NotImplementedError
 
-    def read_stream(self, key, out=None):
+    def read_stream(self, key, out=None, byte_range=None):
         """Reads a media resource.
 
         key
@@ -3005,18 +3005,30 @@ class EntityCollection(edm.EntityCollection):
             be written. If no output file is provided then no data is
             written.
 
+        byte_range
+            An optional tuple of (first_byte, last_byte) restricting the
+            data written to *out* to a range of bytes within the stream,
+            both values are inclusive and must be within the size of the
+            stream.
+
         The return result is the :py:class:`StreamInfo` class describing
-        the stream."""
+        the stream.  The information always describes the *whole*
+        stream, even if a byte range is requested."""
         if not self.is_medialink_collection():
             raise ExpectedMediaLinkCollection
         raise NotImplementedError
 
-    def read_stream_close(self, key):
+    def read_stream_close(self, key, byte_range=None):
         """Creates a generator for a media resource.
 
         key
             The key associated with the stream being read.
 
+        byte_range
+            An optional tuple of (first_byte, last_byte), see
+            :py:meth:`read_stream` for details.  If given, the generator
+            yields only the data in the range.
+
         The return result is a tuple of the :py:class:`StreamInfo` class
         describing the stream and a generator that yields the stream's
         data.
@@ -3194,6 +3194,18 @@ class EntityCollection(DictionaryLike, PEP8Compatibility):
         create two entities with duplicate keys)."""
         raise NotImplementedError
 
+    def insert_entities(self, entities):
+        """Inserts multiple entities into this entity set.
+
+        entities
+            An iterable of entities to insert
+
+        The default implementation simply calls :py:meth:`insert_entity`
+        for each entity.  Data providers may override this method to
+        provide a more efficient implementation."""
+        for entity in entities:
+            self.insert_entity(entity)
+
     def update_entity(self, entity, merge=True):
         """Updates *entity* which must already be in the entity set.
 
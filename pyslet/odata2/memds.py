@@ -624,8 +624,10 @@ class EntityCollection(odata.EntityCollection):
                 self.update_entity(e)
             self.entity_store.update_entity_stream(key, data, sinfo)
 
-    def read_stream(self, key, out=None):
+    def read_stream(self, key, out=None, byte_range=None):
         data, sinfo = self.entity_store.read_stream(key)
+        if byte_range is not None:
+            data = data[byte_range[0]:byte_range[1] + 1]
         if out is not None:
             nbytes = 0
             while nbytes < len(data):
@@ -636,8 +638,10 @@ class EntityCollection(odata.EntityCollection):
                     break
         return sinfo
 
-    def read_stream_close(self, key):
+    def read_stream_close(self, key, byte_range=None):
         data, sinfo = self.entity_store.read_stream(key)
+        if byte_range is not None:
+            data = data[byte_range[0]:byte_range[1] + 1]
         return sinfo, self._stream_gen(data)
 
     def _stream_gen(self, data):
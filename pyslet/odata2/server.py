@@ -3,10 +3,17 @@
 
 import base64
 import codecs
+import hashlib
+import io
+import itertools
 import json
 import logging
+import re
 import sys
+import threading
 import traceback
+import uuid
+import zlib
 
 from . import metadata as edmx
 from . import core as core
@@ -22,7 +29,9 @@ from ..http import params
 from ..pep8 import old_method
 from ..py2 import (
     byte_value,
+    dict_items,
     force_ascii,
+    range3,
     to_text)
 from ..unicode5 import detect_encoding
 from ..xml import structures as xml
@@ -48,6 +57,34 @@ class WSGIWrapper(object):
         return self.start_response(status, response_headers, exc_info)
 
 
+class CachedResponse(object):
+
+    """A pre-generated response body
+
+    data
+        The (binary) body of the response
+
+    gzip
+        True if a gzip encoded copy of the body should also be created
+
+    The ETag is a strong validator calculated from *data*, the gzip
+    encoded copy has its own ETag as required by RFC7232."""
+
+    def __init__(self, data, gzip=False):
+        #: the identity encoded body
+        self.data = data
+        #: the ETag of the identity encoded body
+        self.etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        #: the gzip encoded body or None
+        self.gzip_data = None
+        #: the ETag of the gzip encoded body or None
+        self.gzip_etag = None
+        if gzip:
+            encoder = zlib.compressobj(6, zlib.DEFLATED, 31)
+            self.gzip_data = encoder.compress(data) + encoder.flush()
+            self.gzip_etag = '"%s-gzip"' % self.etag[1:-1]
+
+
 class Server(app.Server):
 
     """Extends py:class:`pyselt.rfc5023.Server` to provide an OData
@@ -170,6 +207,32 @@ class Server(app.Server):
         self.model = None
         #: the maximum number of entities to return per request
         self.topmax = 100
+        #: the approximate size of the chunks used when streaming
+        #: collections, see :py:meth:`return_chunks`
+        self.chunk_size = io.DEFAULT_BUFFER_SIZE
+        #: the maximum number of threads used to execute adjacent
+        #: query operations in a batch request, see
+        #: :py:meth:`handle_batch`
+        self.batch_threads = 4
+        #: True if gzip encoded copies of the cached metadata and
+        #: service documents should be created, see
+        #: :py:meth:`cache_model`
+        self.cache_gzip = True
+        #: True if responses may be compressed using a content-coding
+        #: negotiated with the Accept-Encoding header, set to False to
+        #: disable all compression (including the cached gzip
+        #: responses)
+        self.compression = True
+        #: the minimum size, in bytes, of a response that will be
+        #: compressed.  Streamed responses are always compressed.
+        self.compress_threshold = 1024
+        #: a :py:class:`CachedResponse` containing the metadata document
+        self.metadata_cache = None
+        #: a dictionary of :py:class:`CachedResponse` instances
+        #: containing the service document keyed on format ('xml' or
+        #: 'json')
+        self.service_cache = {}
+        self.cache_model()
 
     @old_method('SetModel')
     def set_model(self, model):
@@ -207,6 +270,34 @@ class Server(app.Server):
                     # update the locations following SetBase above
                     es.set_location()
         self.model = model
+        self.cache_model()
+
+    def cache_model(self):
+        """Generates the cached metadata and service documents
+
+        The metadata document and the service document (in each of the
+        supported formats) are serialised once and the resulting
+        responses are stored in :py:attr:`metadata_cache` and
+        :py:attr:`service_cache` along with their ETags and, if
+        :py:attr:`cache_gzip` is True, a gzip encoded copy.
+
+        This method is called automatically by :py:meth:`set_model`,
+        if you modify the model in place you must call it again to
+        refresh the cached responses.  The documents do not depend on
+        the negotiated protocol version so there is one response per
+        format."""
+        if self.model is None:
+            self.metadata_cache = None
+        else:
+            self.metadata_cache = CachedResponse(
+                str(self.model.get_document()).encode('utf-8'),
+                self.cache_gzip)
+        data = str('{"d":%s}' % json.dumps(
+            {'EntitySets': [x.href for x in self.ws.Collection]}))
+        self.service_cache = {
+            'xml': CachedResponse(
+                to_text(self.serviceDoc).encode('utf-8'), self.cache_gzip),
+            'json': CachedResponse(data.encode('utf-8'), self.cache_gzip)}
 
     @classmethod
     def encode_pathinfo(cls, pathinfo):
@@ -276,6 +367,111 @@ class Server(app.Server):
 
     def __call__(self, environ, start_response):
         """wsgi interface for the server."""
+        if (self.compression and self.BATCH_KEY not in environ and
+                environ["REQUEST_METHOD"].upper() != "HEAD"):
+            encoding = self.select_encoding(
+                environ, self.ContentCodings + ["identity"])
+            if encoding in self.ContentCodings:
+                return self.compress_response(
+                    environ, start_response, encoding)
+        return self.handle_wsgi(environ, start_response)
+
+    #: the content-codings that may be used to compress responses, in
+    #: order of preference
+    ContentCodings = ["gzip", "deflate"]
+
+    #: the zlib wbits values that select each content-coding
+    CodingWBits = {"gzip": 31, "deflate": 15}
+
+    def compress_response(self, environ, start_response, encoding):
+        """Returns a compressed response
+
+        encoding
+            The content-coding to use, one of :py:attr:`ContentCodings`
+
+        The request is handled by :py:meth:`handle_wsgi` and the
+        response is compressed if it is compressible, see
+        :py:meth:`is_compressible`.  Compressed responses are streamed
+        as they are generated, they have no Content-Length and any
+        Content-MD5 header is removed as it describes the identity
+        encoded body.  Strong ETags are converted to weak ETags as the
+        compressed body is not byte-for-byte identical to the identity
+        encoded one (RFC7232), weak comparison of ETags in conditional
+        requests is unaffected.  HEAD requests are never compressed."""
+        response = []
+
+        def start_response_wrapper(status, response_headers, exc_info=None):
+            response[:] = [status, response_headers, exc_info]
+        data = self.handle_wsgi(environ, start_response_wrapper)
+        status, response_headers, exc_info = response
+        if self.is_compressible(status, response_headers):
+            new_headers = []
+            for name, value in response_headers:
+                lname = name.lower()
+                if lname in ("content-length", "content-md5"):
+                    continue
+                elif lname == "etag" and not value.startswith("W/"):
+                    value = "W/" + value
+                new_headers.append((name, value))
+            response_headers = new_headers
+            response_headers.append(("Content-Encoding", encoding))
+            response_headers.append(("Vary", "Accept-Encoding"))
+            data = self._generate_compressed(data, encoding)
+        start_response(status, response_headers, exc_info)
+        return data
+
+    def is_compressible(self, status, response_headers):
+        """Returns True if a response should be compressed
+
+        Successful responses with a textual content type (text, XML or
+        JSON) are compressed unless they already have a content-coding
+        or their Content-Length is less than
+        :py:attr:`compress_threshold`.  Partial content responses and
+        responses that support byte ranges (i.e., media streams) are
+        never compressed as the ranges refer to the identity encoded
+        body."""
+        code = int(status.split()[0])
+        if code < 200 or code >= 300 or code in (204, 206):
+            return False
+        mtype = None
+        for name, value in response_headers:
+            name = name.lower()
+            if name in ("content-encoding", "accept-ranges",
+                        "content-range"):
+                return False
+            elif name == "content-length":
+                if int(value) < self.compress_threshold:
+                    return False
+            elif name == "content-type":
+                try:
+                    mtype = params.MediaType.from_str(value)
+                except grammar.BadSyntax:
+                    return False
+        if mtype is None:
+            return False
+        type = mtype.type.lower()
+        subtype = mtype.subtype.lower()
+        return (type == "text" or subtype in ("json", "xml", "mixed") or
+                subtype.endswith("+xml"))
+
+    def _generate_compressed(self, data, encoding):
+        encoder = zlib.compressobj(
+            6, zlib.DEFLATED, self.CodingWBits[encoding])
+        try:
+            for chunk in data:
+                # flush each chunk so that streamed responses are not
+                # held back by the encoder
+                chunk = encoder.compress(chunk) + \
+                    encoder.flush(zlib.Z_SYNC_FLUSH)
+                if chunk:
+                    yield chunk
+            yield encoder.flush()
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+
+    def handle_wsgi(self, environ, start_response):
+        """Handles a wsgi request without compression"""
         response_headers = []
         try:
             version = self.check_capability_negotiation(
@@ -534,10 +730,88 @@ class Server(app.Server):
         return resource, parent_entity
 
     def set_etag(self, entity, response_headers):
+        etag = self.get_etag(entity)
+        if etag is not None:
+            response_headers.append(("ETag", etag))
+
+    def get_etag(self, entity):
+        """Returns the formatted ETag of *entity* or None"""
         etag = entity.etag()
         if etag is not None:
             etag = entity.format_etag(etag, entity.etag_is_strong())
-            response_headers.append(("ETag", etag))
+        return etag
+
+    def not_modified(self, environ, etag=None, modified=None):
+        """Evaluates the conditional headers of a GET or HEAD request
+
+        etag
+            The formatted ETag of the current representation of the
+            resource or None if there is no ETag.
+
+        modified
+            A :py:class:`pyslet.iso8601.TimePoint` instance containing
+            the last modified time of the resource or None if it is not
+            known.
+
+        Returns True if a 304 (Not Modified) response should be
+        returned instead of the representation.  If-None-Match is
+        evaluated using the weak comparison function and, if present,
+        the If-Modified-Since header is ignored as per RFC7232.  Badly
+        formed headers are ignored."""
+        if environ["REQUEST_METHOD"].upper() not in ("GET", "HEAD"):
+            return False
+        if "HTTP_IF_NONE_MATCH" in environ:
+            if etag is None:
+                return False
+            match = environ["HTTP_IF_NONE_MATCH"].strip()
+            if match == "*":
+                return True
+            try:
+                tag = params.EntityTag.from_str(etag).tag
+                p = params.ParameterParser(match)
+                while True:
+                    if p.require_entity_tag().tag == tag:
+                        return True
+                    if not p.parse_separator(grammar.COMMA):
+                        break
+            except grammar.BadSyntax:
+                pass
+            return False
+        if "HTTP_IF_MODIFIED_SINCE" in environ and modified is not None:
+            try:
+                since = params.FullDate.from_http_str(
+                    environ["HTTP_IF_MODIFIED_SINCE"])
+            except grammar.BadSyntax:
+                return False
+            # HTTP dates are only accurate to the second
+            modified = params.FullDate.from_http_str(
+                str(params.FullDate(src=modified)))
+            return not modified > since
+        return False
+
+    def return_not_modified(self, start_response, response_headers):
+        """Returns a 304 response
+
+        The response_headers should contain any validators (ETag,
+        Last-Modified) that would have been sent with a 200 response."""
+        start_response("%i %s" % (304, "Not Modified"), response_headers)
+        return []
+
+    def feed_etag(self, data, atom=False):
+        """Returns a weak ETag for a serialised feed
+
+        data
+            The complete (binary) response
+
+        atom
+            True if the feed is an Atom feed, in which case the
+            generated atom:updated values are ignored as they reflect
+            the time the feed was generated rather than the data."""
+        if atom:
+            data = self.UpdatedPattern.sub(b"", data)
+        return 'W/"%s"' % hashlib.sha1(data).hexdigest()
+
+    UpdatedPattern = re.compile(br"<updated>[^<]*</updated>")
 
     @old_method('HandleRequest')
     def handle_request(self, request, environ, start_response,
@@ -554,9 +828,8 @@ class Server(app.Server):
                 return self.return_metadata(
                     request, environ, start_response, response_headers)
             elif request.path_option == core.PathOption.batch:
-                return self.odata_error(
-                    request, environ, start_response, "Bad Request",
-                    "Batch requests not supported", 404)
+                return self.handle_batch(
+                    request, environ, start_response, response_headers)
             elif request.path_option == core.PathOption.count:
                 if isinstance(resource, edm.Entity):
                     return self.return_count(
@@ -866,12 +1139,9 @@ class Server(app.Server):
                 else:
                     # override the default handling of service root to improve
                     # content negotiation
-                    data = to_text(self.serviceDoc).encode('utf-8')
-                    response_headers.append(
-                        ("Content-Type", str(response_type)))
-                    response_headers.append(("Content-Length", str(len(data))))
-                    start_response("200 Ok", response_headers)
-                    return [data]
+                    return self.return_cached(
+                        self.service_cache['xml'], response_type, environ,
+                        start_response, response_headers)
         except core.MissingURISegment as e:
             return self.odata_error(
                 request, environ, start_response, "Resource not found",
@@ -893,6 +1163,351 @@ class Server(app.Server):
                 request, environ, start_response, "NotImplementedError",
                 str(e), 405)
 
+    #: the environ key used to mark requests embedded in a batch
+    BATCH_KEY = 'pyslet.odata2.batch'
+
+    def handle_batch(self, request, environ, start_response,
+                     response_headers):
+        """Handles a $batch request
+
+        The request body is a multipart/mixed entity containing a
+        sequence of query operations (GET requests) and change sets.
+        Change sets are themselves multipart/mixed entities containing a
+        sequence of change requests that are executed in order and
+        applied atomically: if any of them fails a single error response
+        is returned for the whole change set.  Requests in a change set
+        may refer to entities created by earlier requests in the same
+        change set using $<Content-ID> references.
+
+        Changes are made atomic by starting a change set on every
+        container bound to the model that supports them, see
+        :py:meth:`pyslet.odata2.sqlds.SQLEntityContainer.begin_changeset`.
+        Changes to other data sources are not rolled back.
+
+        Adjacent query operations are independent of each other and are
+        executed concurrently using up to :py:attr:`batch_threads`
+        threads.  Each embedded request is executed by passing a new
+        WSGI environment to this server so it is handled exactly as if
+        it had been received directly."""
+        method = environ["REQUEST_METHOD"].upper()
+        if method != "POST":
+            raise core.InvalidMethod("%s not supported here" % method)
+        if environ.get(self.BATCH_KEY, False):
+            return self.odata_error(
+                request, environ, start_response, "Bad Request",
+                "Batch requests cannot be nested", 400)
+        boundary = self._get_boundary(environ.get('CONTENT_TYPE', None))
+        if boundary is None:
+            return self.odata_error(
+                request, environ, start_response, "Bad Request",
+                "Batch request requires a multipart/mixed entity", 400)
+        data = messages.WSGIInputWrapper(environ).read()
+        batch = []
+        try:
+            for headers, body in self._split_multipart(data, boundary):
+                cs_boundary = self._get_boundary(
+                    headers.get('content-type', None))
+                if cs_boundary is None:
+                    batch.append(self._parse_http_part(headers, body))
+                else:
+                    batch.append(
+                        [self._parse_http_part(cs_headers, cs_body) for
+                         cs_headers, cs_body in
+                         self._split_multipart(body, cs_boundary)])
+        except ValueError as e:
+            return self.odata_error(
+                request, environ, start_response, "Bad Request",
+                "Badly formed batch request: %s" % to_text(e), 400)
+        results = []
+        queries = []
+        for item in batch:
+            if isinstance(item, list):
+                if queries:
+                    results += self._batch_queries(environ, queries)
+                    queries = []
+                results.append(self._batch_changeset(environ, item))
+            else:
+                queries.append(item)
+        if queries:
+            results += self._batch_queries(environ, queries)
+        batch_boundary = "batchresponse_%s" % str(uuid.uuid4())
+        delimiter = b"--" + batch_boundary.encode('ascii')
+        data = []
+        for item in results:
+            data.append(delimiter + b"\r\n")
+            if isinstance(item, list):
+                cs_boundary = ("changesetresponse_%s" %
+                               str(uuid.uuid4())).encode('ascii')
+                data.append(b"Content-Type: multipart/mixed; boundary=" +
+                            cs_boundary + b"\r\n\r\n")
+                for part in item:
+                    data.append(b"--" + cs_boundary + b"\r\n")
+                    data.append(part)
+                    data.append(b"\r\n")
+                data.append(b"--" + cs_boundary + b"--\r\n")
+            else:
+                data.append(item)
+                data.append(b"\r\n")
+        data.append(delimiter + b"--\r\n")
+        data = b"".join(data)
+        response_headers.append(
+            ("Content-Type",
+             "multipart/mixed; boundary=%s" % batch_boundary))
+        response_headers.append(("Content-Length", str(len(data))))
+        start_response("%i %s" % (202, "Accepted"), response_headers)
+        return [data]
+
+    def _get_boundary(self, content_type):
+        # returns the boundary of a multipart/mixed content type or None
+        if content_type is None:
+            return None
+        try:
+            mtype = params.MediaType.from_str(content_type)
+        except grammar.BadSyntax:
+            return None
+        if (mtype.type.lower() != "multipart" or
+                mtype.subtype.lower() != "mixed"):
+            return None
+        return mtype.parameters.get('boundary', (None, None))[1]
+
+    def _split_multipart(self, data, boundary):
+        # returns a list of (headers, body) tuples, one for each body
+        # part of the multipart entity in data
+        delimiter = re.compile(
+            br"(?:\A|\r?\n)--" + re.escape(boundary) +
+            br"(--)?[ \t]*(?:\r?\n|\Z)")
+        parts = []
+        start = None
+        for match in delimiter.finditer(data):
+            if start is not None:
+                parts.append(self._split_headers(data[start:match.start()]))
+            if match.group(1):
+                break
+            start = match.end()
+        else:
+            raise ValueError("missing multipart close-delimiter")
+        return parts
+
+    def _split_headers(self, data):
+        # returns a tuple of (headers, body) where headers is a
+        # dictionary mapping lower-cased header names on to their values
+        # in the order they appear in data
+        match = re.search(br"\r?\n\r?\n", data)
+        if match is None:
+            header_data, body = data, b""
+        else:
+            header_data, body = data[:match.start()], data[match.end():]
+        headers = {}
+        for line in header_data.decode('iso-8859-1').splitlines():
+            if not line.strip():
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise ValueError("bad header: %s" % line)
+            headers[name.strip().lower()] = value.strip()
+        return headers, body
+
+    def _parse_http_part(self, headers, body):
+        # returns a tuple of (method, url, headers, body, content_id)
+        # representing the request embedded in a batch part
+        mtype = headers.get('content-type', None)
+        if mtype is None or not mtype.lower().startswith('application/http'):
+            raise ValueError("expected application/http, found %s" % mtype)
+        content_id = headers.get('content-id', None)
+        match = re.match(br"\s*([^\r\n]*)\r?\n", body)
+        if match is None:
+            raise ValueError("missing request line")
+        request_line = match.group(1).decode('iso-8859-1').split()
+        if len(request_line) != 3:
+            raise ValueError("bad request line: %s" % " ".join(request_line))
+        request_headers, request_body = self._split_headers(
+            body[match.end():])
+        if content_id is None:
+            content_id = request_headers.get('content-id', None)
+        if 'content-length' in request_headers:
+            request_body = request_body[
+                :int(request_headers['content-length'])]
+        return (request_line[0].upper(), request_line[1], request_headers,
+                request_body, content_id)
+
+    def _batch_request(self, environ, method, url, headers, body):
+        # executes a request embedded in a batch returning a tuple of
+        # (status, response_headers, data)
+        href = uri.URI.from_octets(url)
+        if not href.is_absolute():
+            href = href.resolve(self.service_root)
+        sub_environ = {}
+        for key, value in dict_items(environ):
+            if not key.startswith('HTTP_') and not key.startswith('CONTENT_'):
+                sub_environ[key] = value
+        if 'HTTP_HOST' in environ:
+            sub_environ['HTTP_HOST'] = environ['HTTP_HOST']
+        for name, value in dict_items(headers):
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            sub_environ[key] = value
+        sub_environ[self.BATCH_KEY] = True
+        sub_environ['REQUEST_METHOD'] = method
+        sub_environ['SCRIPT_NAME'] = ''
+        if href.abs_path:
+            sub_environ['PATH_INFO'] = uri.unescape_data(
+                href.abs_path).decode('utf-8')
+        else:
+            sub_environ['PATH_INFO'] = ''
+        sub_environ['QUERY_STRING'] = href.query or ''
+        sub_environ['CONTENT_LENGTH'] = str(len(body))
+        sub_environ['wsgi.input'] = io.BytesIO(body)
+        response = []
+
+        def start_response(status, response_headers, exc_info=None):
+            response[:] = [status, response_headers]
+        try:
+            data = b''.join(self(sub_environ, start_response))
+        except Exception as e:
+            logging.error(
+                "UnexpectedError in OData batch: %s",
+                "".join(traceback.format_exception(*sys.exc_info())))
+            data = b''.join(self.odata_error(
+                core.ODataURI('error'), sub_environ, start_response,
+                "UnexpectedError", to_text(e), 500))
+        return response[0], response[1], data
+
+    def _batch_error(self, environ, sub_code, message, code):
+        response = []
+
+        def start_response(status, response_headers, exc_info=None):
+            response[:] = [status, response_headers]
+        data = b''.join(self.odata_error(
+            core.ODataURI('error'), environ, start_response, sub_code,
+            message, code))
+        return response[0], response[1], data
+
+    def _format_http_part(self, response, content_id=None):
+        status, response_headers, data = response
+        lines = ["Content-Type: application/http",
+                 "Content-Transfer-Encoding: binary"]
+        if content_id is not None:
+            lines.append("Content-ID: %s" % content_id)
+        lines.append("")
+        lines.append("HTTP/1.1 %s" % status)
+        for name, value in response_headers:
+            lines.append("%s: %s" % (name, value))
+        lines.append("")
+        lines.append("")
+        return "\r\n".join(lines).encode('iso-8859-1') + data
+
+    def _batch_queries(self, environ, queries):
+        # executes a list of query operations, returning a list of
+        # formatted response parts in the same order
+        results = [None] * len(queries)
+
+        def run(i):
+            method, url, headers, body, content_id = queries[i]
+            if method != "GET":
+                response = self._batch_error(
+                    environ, "Bad Request",
+                    "%s requests must be part of a change set" % method, 400)
+            else:
+                response = self._batch_request(
+                    environ, method, url, headers, body)
+            results[i] = self._format_http_part(response, content_id)
+        nthreads = min(self.batch_threads, len(queries))
+        if nthreads < 2:
+            for i in range3(len(queries)):
+                run(i)
+            return results
+        todo = iter(range3(len(queries)))
+        todo_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with todo_lock:
+                    i = next(todo, None)
+                if i is None:
+                    break
+                run(i)
+        threads = []
+        for i in range3(nthreads):
+            t = threading.Thread(target=worker)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return results
+
+    def _batch_changeset(self, environ, requests):
+        # executes a change set, returning a list of formatted response
+        # parts or, if the change set failed, a single formatted part
+        connections = self._begin_changeset()
+        content_ids = {}
+        parts = []
+        response = None
+        commit = False
+        try:
+            for method, url, headers, body, content_id in requests:
+                if method in ("GET", "HEAD"):
+                    response = self._batch_error(
+                        environ, "Bad Request",
+                        "Query operations are not allowed in change sets",
+                        400)
+                    break
+                if url.startswith('$'):
+                    ref, sep, path = url[1:].partition('/')
+                    if ref in content_ids:
+                        url = content_ids[ref] + sep + path
+                response = self._batch_request(
+                    environ, method, url, headers, body)
+                if int(response[0].split()[0]) >= 400:
+                    break
+                if content_id is not None:
+                    for name, value in response[1]:
+                        if name.lower() == "location":
+                            content_ids[content_id] = value
+                            break
+                parts.append(self._format_http_part(response, content_id))
+            else:
+                commit = True
+        finally:
+            committed = self._end_changeset(connections, commit)
+        if committed:
+            return parts
+        if commit:
+            # everything looked OK but the changes did not commit
+            response = self._batch_error(
+                environ, "ChangeSetError", "Change set was rolled back", 500)
+        return self._format_http_part(response)
+
+    def _begin_changeset(self):
+        containers = []
+        if self.model is None:
+            return containers
+        for s in self.model.DataServices.Schema:
+            for container in s.EntityContainer:
+                for es in container.EntitySet:
+                    c = es.binding[1].get('container', None)
+                    if (c is not None and hasattr(c, 'begin_changeset') and
+                            c not in containers):
+                        containers.append(c)
+        connections = []
+        try:
+            for c in containers:
+                connection = c.begin_changeset()
+                if connection is not None:
+                    connections.append((c, connection))
+        except Exception:
+            self._end_changeset(connections, False)
+            raise
+        return connections
+
+    def _end_changeset(self, connections, commit):
+        # returns True if all change sets committed
+        result = True
+        for c, connection in connections:
+            if not c.end_changeset(connection, commit and result):
+                result = False
+        return commit and result
+
     def expand_resource(self, resource, sys_query_options):
         try:
             expand = sys_query_options.get(core.SystemQueryOption.expand, None)
@@ -912,29 +1527,64 @@ class Server(app.Server):
 
     def return_json_root(self, request, environ, start_response,
                          response_headers):
-        data = str('{"d":%s}' % json.dumps(
-            {'EntitySets': [x.href for x in self.ws.Collection]}))
-        data = data.encode('utf-8')
-        response_headers.append(("Content-Type", "application/json"))
-        response_headers.append(("Content-Length", str(len(data))))
-        start_response("%i %s" % (200, "Success"), response_headers)
-        return [data]
+        return self.return_cached(
+            self.service_cache['json'], "application/json", environ,
+            start_response, response_headers)
 
     def return_metadata(self, request, environ, start_response,
                         response_headers):
-        doc = self.model.get_document()
         response_type = self.content_negotiation(
             request, environ, self.MetadataTypes)
         if response_type is None:
             return self.odata_error(
                 request, environ, start_response, "Not Acceptable",
                 'xml or plain text formats supported', 406)
-        data = str(doc).encode('utf-8')
+        return self.return_cached(
+            self.metadata_cache, response_type, environ, start_response,
+            response_headers)
+
+    def return_cached(self, cached, response_type, environ, start_response,
+                      response_headers):
+        """Returns a :py:class:`CachedResponse`
+
+        The gzip encoded copy is returned if there is one and the
+        client prefers it, conditional requests are evaluated against
+        the ETag of the selected copy.  Responses to requests in a
+        batch are never encoded."""
+        data, etag = cached.data, cached.etag
+        if (cached.gzip_data is not None and self.compression and
+                self.BATCH_KEY not in environ):
+            response_headers.append(("Vary", "Accept-Encoding"))
+            if self.select_encoding(
+                    environ, ["gzip", "identity"]) == "gzip":
+                data, etag = cached.gzip_data, cached.gzip_etag
+                response_headers.append(("Content-Encoding", "gzip"))
+        response_headers.append(("ETag", etag))
+        if self.not_modified(environ, etag):
+            return self.return_not_modified(start_response, response_headers)
         response_headers.append(("Content-Type", str(response_type)))
         response_headers.append(("Content-Length", str(len(data))))
         start_response("%i %s" % (200, "Success"), response_headers)
         return [data]
 
+    def select_encoding(self, environ, encodings):
+        """Returns the best match for the Accept-Encoding header
+
+        encodings
+            A list of content-coding tokens in order of preference
+
+        Returns "identity" if there is no Accept-Encoding header or if
+        the header is badly formed, otherwise the best match from
+        *encodings* or None if none of them are acceptable."""
+        if "HTTP_ACCEPT_ENCODING" not in environ:
+            return "identity"
+        try:
+            alist = messages.AcceptEncodingList.from_str(
+                environ["HTTP_ACCEPT_ENCODING"])
+        except grammar.BadSyntax:
+            return "identity"
+        return alist.select_token(encodings)
+
     def return_links(self, entities, request, environ, start_response,
                      response_headers):
         response_type = self.content_negotiation(
@@ -1010,21 +1660,83 @@ class Server(app.Server):
                 'xml, json or plain text formats supported', 406)
         entities.set_topmax(self.topmax)
         if response_type == "application/json":
-            data = str('{"d":%s}' % ''.join(
-                entities.generate_entity_set_in_json(request.version)))
+            data = itertools.chain(
+                ('{"d":', ),
+                entities.generate_entity_set_in_json(request.version),
+                ('}', ))
         else:
-            # Here's a challenge, we want to pull data through the feed
-            # by yielding strings just load in to memory at the moment
+            # the feed pulls entities from the collection as the
+            # document is generated
             f = core.Feed(None, entities)
             doc = core.Document(root=f)
             f.collection = entities
             f.set_base(str(self.service_root))
-            data = str(doc)
-        data = data.encode('utf-8')
+            data = doc.generate_xml(xml.escape_char_data)
         response_headers.append(("Content-Type", str(response_type)))
-        response_headers.append(("Content-Length", str(len(data))))
-        start_response("%i %s" % (200, "Success"), response_headers)
-        return [data]
+        return self.return_chunks(
+            data, start_response, response_headers, environ=environ,
+            atom=response_type != "application/json")
+
+    def return_chunks(self, data, start_response, response_headers,
+                      status=200, status_msg="Success", environ=None,
+                      atom=False):
+        """Returns a response generated from an iterable of strings
+
+        data
+            An iterable of character strings, typically a generator.
+            The strings are encoded with UTF-8 and combined into chunks
+            of (at least) :py:attr:`chunk_size` bytes.
+
+        The first chunk is read from *data* before start_response is
+        called so that errors raised when starting the underlying query
+        can still be reported to the client.  If the whole response fits
+        in the first chunk it is returned with a Content-Length header,
+        otherwise the WSGI server is left to stream the remaining chunks
+        (using chunked transfer encoding where supported) as they are
+        generated.
+
+        environ
+            If the WSGI environment is passed and the whole response
+            fits in the first chunk then the response is given a weak
+            ETag generated by :py:meth:`feed_etag` (with the optional
+            *atom* flag) and the request's conditional headers are
+            evaluated, possibly resulting in a 304 response."""
+        data = iter(data)
+        chunk, more = self._read_chunk(data)
+        if not more:
+            if environ is not None and status == 200:
+                etag = self.feed_etag(chunk, atom)
+                response_headers.append(("ETag", etag))
+                if self.not_modified(environ, etag):
+                    return self.return_not_modified(
+                        start_response, response_headers)
+            response_headers.append(("Content-Length", str(len(chunk))))
+        start_response("%i %s" % (status, status_msg), response_headers)
+        if more:
+            return self._generate_chunks(chunk, data)
+        else:
+            return [chunk]
+
+    def _read_chunk(self, data):
+        # returns a tuple of (chunk, more)
+        chunk = []
+        size = 0
+        for s in data:
+            if not isinstance(s, bytes):
+                s = s.encode('utf-8')
+            chunk.append(s)
+            size += len(s)
+            if size >= self.chunk_size:
+                return b''.join(chunk), True
+        return b''.join(chunk), False
+
+    def _generate_chunks(self, chunk, data):
+        yield chunk
+        more = True
+        while more:
+            chunk, more = self._read_chunk(data)
+            if chunk:
+                yield chunk
 
     def read_xml_or_json(self, environ):
         """Reads either an XML document or a JSON object from environ."""
@@ -1108,6 +1820,14 @@ class Server(app.Server):
             return self.odata_error(
                 request, environ, start_response, "Not Acceptable",
                 'xml, json or plain text formats supported', 406)
+        if status == 200 and core.SystemQueryOption.expand not in \
+                request.sys_query_options:
+            # the ETag does not cover expanded entities
+            etag = self.get_etag(entity)
+            if self.not_modified(environ, etag):
+                response_headers.append(("ETag", etag))
+                return self.return_not_modified(
+                    start_response, response_headers)
         # Here's a challenge, we want to pull data through the feed by
         # yielding strings just load in to memory at the moment
         if response_type == "application/json":
@@ -1128,37 +1848,129 @@ class Server(app.Server):
 
     def return_stream(self, entity, request, environ, start_response,
                       response_headers, method):
-        """Returns a media stream."""
+        """Returns a media stream.
+
+        GET requests with a Range header specifying a single, satisfiable
+        byte range return the range in a 206 (Partial Content)
+        response, see :py:meth:`get_stream_range`.  Unsatisfiable ranges
+        result in a 416 response."""
+        content_range = None
+        sgen = []
         coll = entity.entity_set.open()
         try:
-            if method == "GET":
+            if method == "GET" and "HTTP_RANGE" not in environ:
+                # one call returns the stream information and the data
                 sinfo, sgen = coll.read_stream_close(entity.key())
             else:
                 sinfo = coll.read_stream(entity.key())
-                sgen = []
+            if self.not_modified(
+                    environ, self.get_etag(entity), sinfo.modified):
+                self._close_stream(coll, sgen)
+                if sinfo.modified is not None:
+                    response_headers.append(
+                        ("Last-Modified",
+                         str(params.FullDate(src=sinfo.modified))))
+                self.set_etag(entity, response_headers)
+                return self.return_not_modified(
+                    start_response, response_headers)
+            if method != "GET":
                 coll.close()
+            elif "HTTP_RANGE" in environ:
+                content_range = self.get_stream_range(entity, sinfo, environ)
+                if content_range is None:
+                    sinfo, sgen = coll.read_stream_close(entity.key())
+                elif content_range.is_valid():
+                    sinfo, sgen = coll.read_stream_close(
+                        entity.key(),
+                        (content_range.first_byte, content_range.last_byte))
+                else:
+                    coll.close()
         except Exception:
-            coll.close()
+            self._close_stream(coll, sgen)
             raise
+        if content_range is not None and not content_range.is_valid():
+            response_headers.append(("Content-Range", str(content_range)))
+            response_headers.append(("Content-Length", "0"))
+            start_response("%i %s" % (416, "Requested Range Not Satisfiable"),
+                           response_headers)
+            return []
         types = [sinfo.type] + self.StreamTypes
         response_type = self.content_negotiation(request, environ, types)
         if response_type is None:
+            self._close_stream(coll, sgen)
             return self.odata_error(
                 request, environ, start_response, "Not Acceptable",
                 'media stream type refused, try application/octet-stream', 406)
         response_headers.append(("Content-Type", str(response_type)))
-        if sinfo.size is not None:
+        response_headers.append(("Accept-Ranges", "bytes"))
+        if content_range is not None:
+            response_headers.append(("Content-Range", str(content_range)))
+            response_headers.append(
+                ("Content-Length", str(len(content_range))))
+        elif sinfo.size is not None:
             response_headers.append(("Content-Length", str(sinfo.size)))
         if sinfo.modified is not None:
             response_headers.append(("Last-Modified",
                                      str(params.FullDate(src=sinfo.modified))))
-        if sinfo.md5 is not None:
+        if sinfo.md5 is not None and content_range is None:
             response_headers.append(
                 ("Content-MD5", force_ascii(base64.b64encode(sinfo.md5))))
         self.set_etag(entity, response_headers)
-        start_response("%i %s" % (200, "Success"), response_headers)
+        if content_range is not None:
+            start_response("%i %s" % (206, "Partial Content"),
+                           response_headers)
+        else:
+            start_response("%i %s" % (200, "Success"), response_headers)
         return sgen
 
+    def _close_stream(self, coll, sgen):
+        # closes a stream generator that will not be iterated
+        if hasattr(sgen, 'close'):
+            sgen.close()
+        coll.close()
+
+    def get_stream_range(self, entity, sinfo, environ):
+        """Returns the range of a media stream requested
+
+        entity
+            The media link entry
+
+        sinfo
+            The :py:class:`core.StreamInfo` describing the stream
+
+        environ
+            The WSGI environment containing the Range header
+
+        Returns a :py:class:`messages.ContentRange` instance or None if
+        the whole stream should be returned.  The Range header is
+        ignored if it is badly formed, if it specifies more than one
+        range or if an If-Range header is present that does not match
+        the current (strong) ETag or the Last-Modified date of the
+        stream.  If the range can't be satisfied an invalid
+        ContentRange is returned."""
+        if sinfo.size is None:
+            return None
+        try:
+            range = messages.Range.from_str(environ["HTTP_RANGE"])
+        except grammar.BadSyntax:
+            return None
+        if "HTTP_IF_RANGE" in environ:
+            validators = []
+            etag = entity.etag()
+            if etag is not None and entity.etag_is_strong():
+                validators.append(entity.format_etag(etag, True))
+            if sinfo.modified is not None:
+                validators.append(str(params.FullDate(src=sinfo.modified)))
+            if environ["HTTP_IF_RANGE"].strip() not in validators:
+                return None
+        ranges = range.get_content_ranges(sinfo.size)
+        if ranges is None or len(ranges) > 1:
+            return None
+        elif ranges:
+            return ranges[0]
+        else:
+            return messages.ContentRange(total_len=sinfo.size)
+
     def read_value(self, value, environ):
         input = self.read_xml_or_json(environ)
         if isinstance(input, core.Document):
@@ -1183,6 +1995,10 @@ class Server(app.Server):
             return self.odata_error(
                 request, environ, start_response, "Not Acceptable",
                 'xml, json or plain text formats supported', 406)
+        if entity is not None and self.not_modified(
+                environ, self.get_etag(entity)):
+            self.set_etag(entity, response_headers)
+            return self.return_not_modified(start_response, response_headers)
         if response_type == "application/json":
             if isinstance(value, edm.Complex):
                 if request.version == 2:
@@ -1276,6 +2092,10 @@ class Server(app.Server):
             return self.odata_error(
                 request, environ, start_response, "Not Acceptable",
                 '$value requires plain text or octet-stream formats', 406)
+        if entity is not None and self.not_modified(
+                environ, self.get_etag(entity)):
+            self.set_etag(entity, response_headers)
+            return self.return_not_modified(start_response, response_headers)
         response_headers.append(("Content-Type", str(response_type)))
         response_headers.append(("Content-Length", str(len(data))))
         if entity is not None:
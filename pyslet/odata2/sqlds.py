@@ -3,10 +3,10 @@
 
 
 import binascii
+import collections
 import decimal
 import hashlib
 import io
-import itertools
 import logging
 import math
 import os.path
@@ -40,6 +40,22 @@ logging = logging.getLogger('pyslet.odata2.sqlds')
 # : the standard timeout while waiting for a database connection, in seconds
 SQL_TIMEOUT = 90
 
+#: the namespace used for SQL-specific annotations in metadata documents
+SQL_NAMESPACE = "http://www.pyslet.org/ns/odata2/sqlds"
+
+SQL_INDEX = (SQL_NAMESPACE, "Index")
+"""Annotation used to request an index on a property
+
+Add an attribute with this name and the value "true" to a Property
+definition in the metadata document and :py:meth:`create_all_tables`
+will create an index on the corresponding column, for example::
+
+    <Schema xmlns:sql="http://www.pyslet.org/ns/odata2/sqlds" ...>
+        ...
+        <Property Name="LastName" Type="Edm.String" sql:Index="true"/>
+
+See :py:meth:`SQLEntityContainer.indexed_name` for details."""
+
 
 class SQLError(Exception):
 
@@ -239,7 +255,8 @@ def retry_decorator(tmethod):
                         self.connection.dbc = self.container.open()
                         if self.cursor is not None:
                             # create a new cursor
-                            self.cursor = self.connection.dbc.cursor()
+                            self.cursor = self.container.new_cursor(
+                                self.connection.dbc, self.streaming)
                     else:
                         raise
         return result
@@ -278,16 +295,24 @@ class SQLTransaction(object):
     begin and commit calls provided that method follows the same pattern
     as the above for the try, except and finally blocks.  The object
     keeps track of these 'nested' transactions and delays the commit or
-    rollback until the outermost method invokes them."""
+    rollback until the outermost method invokes them.
+
+    The optional *streaming* argument requests a cursor that does not
+    buffer the result set, see
+    :py:meth:`SQLEntityContainer.new_cursor` for details."""
 
-    def __init__(self, container, connection):
+    def __init__(self, container, connection, streaming=False):
         self.container = container
         self.api = container.dbapi      #: the database module
         self.connection = connection    #: the database connection
+        #: True if a streaming cursor is requested
+        self.streaming = streaming
         #: the database cursor to use for executing commands
         self.cursor = None
         self.no_commit = 0      #: used to manage nested transactions
         self.query_count = 0    #: records the number of successful commands
+        #: True if a command that may modify the database has been executed
+        self.modified = False
 
     @retry_decorator
     def begin(self):
@@ -296,7 +321,8 @@ class SQLTransaction(object):
         If a transaction is already in progress a nested transaction is
         started which has no affect on the database connection itself."""
         if self.cursor is None:
-            self.cursor = self.connection.dbc.cursor()
+            self.cursor = self.container.new_cursor(
+                self.connection.dbc, self.streaming)
         else:
             self.no_commit += 1
 
@@ -310,17 +336,49 @@ class SQLTransaction(object):
         params
                 A :py:class:`SQLParams` object containing any
                 parameterized values."""
-        self.cursor.execute(sqlcmd,
-                            params.params if params is not None else None)
+        self._check_modified(sqlcmd)
+        if params is None:
+            self.cursor.execute(sqlcmd)
+        else:
+            self.cursor.execute(sqlcmd, params.params)
         self.query_count += 1
 
+    @retry_decorator
+    def executemany(self, sqlcmd, params_list):
+        """Executes *sqlcmd* once for each set of parameters.
+
+        sqlcmd
+                A string containing the query
+
+        params_list
+                A list of :py:class:`SQLParams` objects, one for each
+                execution of the query.
+
+        The query is executed using the cursor's executemany method
+        which allows the underlying database module to optimise
+        repeated execution of the same statement."""
+        self._check_modified(sqlcmd)
+        self.cursor.executemany(sqlcmd, [p.params for p in params_list])
+        self.query_count += 1
+
+    def _check_modified(self, sqlcmd):
+        if not self.modified and \
+                sqlcmd.lstrip()[:6].upper() != "SELECT":
+            self.modified = True
+
     def commit(self):
         """Ends this transaction with a commit
 
-        Nested transactions do nothing."""
+        Nested transactions do nothing.  If the transaction executed
+        any command other than a SELECT then the container's cached
+        counts are invalidated, see
+        :py:meth:`SQLEntityContainer.invalidate_counts`."""
         if self.no_commit:
             return
-        self.connection.dbc.commit()
+        if not self.connection.changeset:
+            self.connection.dbc.commit()
+        if self.modified:
+            self.container.invalidate_counts()
 
     def rollback(self, err=None, swallow=False):
         """Calls the underlying database connection rollback method.
@@ -341,8 +399,15 @@ class SQLTransaction(object):
 
         swallow
             A flag (defaults to False) indicating that *err* should be
-            swallowed, rather than re-raised."""
+            swallowed, rather than re-raised.
+
+        If the connection is part of a change set (see
+        :py:meth:`SQLEntityContainer.begin_changeset`) then the rollback
+        also undoes any earlier work in the change set and the change
+        set is marked as failed."""
         if not self.no_commit:
+            if self.connection.changeset:
+                self.connection.changeset_failed = True
             try:
                 self.connection.dbc.rollback()
                 if err is not None:
@@ -362,6 +427,9 @@ class SQLTransaction(object):
                         logging.info(
                             "Query failed following error %s", str(err))
                 pass
+            if self.modified:
+                # not all databases support transactions
+                self.container.invalidate_counts()
         if err is not None and not swallow:
             logging.debug(
                 ' '.join(
@@ -382,6 +450,7 @@ class SQLTransaction(object):
             self.cursor.close()
             self.cursor = None
             self.query_count = 0
+            self.modified = False
 
 
 class SQLCollectionBase(core.EntityCollection):
@@ -409,6 +478,15 @@ class SQLCollectionBase(core.EntityCollection):
     values defined in the metadata model are ignored by the
     collection object."""
 
+    EXPAND_BATCH_SIZE = 100
+    """The maximum number of entities that are expanded together
+
+    When expanding navigation properties the expanded entities are
+    loaded with a single query for each batch of entities returned by
+    the collection, see :py:meth:`expand_entities`.  The size of a batch
+    is limited as the query contains a parameter for each key of each
+    entity in the batch."""
+
     def __init__(self, container, **kwargs):
         super(SQLCollectionBase, self).__init__(**kwargs)
         #: the parent container (database) for this collection
@@ -428,6 +506,17 @@ class SQLCollectionBase(core.EntityCollection):
         self.connection = None
         self._sqlLen = None
         self._sqlGen = None
+        self._param_trace = None
+        #: the number of rows to fetch at a time when iterating through
+        #: the collection, defaults to the container's fetch_size
+        self.fetch_size = self.container.fetch_size
+        #: True if :py:func:`len` may return an estimate of the size of
+        #: the collection, defaults to the container's estimate_counts
+        self.estimate_len = self.container.estimate_counts
+        #: True if the entities in the collection are read using a
+        #: streaming cursor, defaults to the container's streaming
+        #: setting
+        self.streaming = self.container.streaming
         try:
             self.connection = self.container.acquire_connection(SQL_TIMEOUT)
             if self.connection is None:
@@ -445,15 +534,19 @@ class SQLCollectionBase(core.EntityCollection):
 
     def __len__(self):
         if self._sqlLen is None:
-            query = ["SELECT COUNT(*) FROM %s" % self.table_name]
-            params = self.container.ParamsClass()
-            where = self.where_clause(None, params)
-            query.append(self.join_clause())
-            query.append(where)
-            query = ''.join(query)
+            def build(params):
+                query = ["SELECT COUNT(*) FROM %s" % self.table_name]
+                where = self.where_clause(None, params)
+                query.append(self.join_clause())
+                query.append(where)
+                return ''.join(query)
+            params, query = self.cached_query(self.query_shape('len'), build)
             self._sqlLen = (query, params)
         else:
             query, params = self._sqlLen
+        result, generation = self.container.get_cached_count(query, params)
+        if result is not None:
+            return result
         transaction = SQLTransaction(self.container, self.connection)
         try:
             transaction.begin()
@@ -464,6 +557,7 @@ class SQLCollectionBase(core.EntityCollection):
             # we haven't changed the database, but we don't want to
             # leave the connection idle in transaction
             transaction.commit()
+            self.container.set_cached_count(query, params, result, generation)
             return result
         except Exception as e:
             # we catch (almost) all exceptions and re-raise after rollback
@@ -472,49 +566,41 @@ class SQLCollectionBase(core.EntityCollection):
             transaction.close()
 
     def entity_generator(self):
-        entity, values = None, None
         if self._sqlGen is None:
-            entity = self.new_entity()
-            query = ["SELECT "]
-            params = self.container.ParamsClass()
-            column_names, values = zip(*list(self.select_fields(entity)))
-            # values is used later for the first result
-            column_names = list(column_names)
-            self.orderby_cols(column_names, params)
-            query.append(", ".join(column_names))
-            query.append(' FROM ')
-            query.append(self.table_name)
-            # we force where and orderby to be calculated before the
-            # join clause is added as they may add to the joins
-            where = self.where_clause(
-                None, params, use_filter=True, use_skip=False)
-            orderby = self.orderby_clause()
-            query.append(self.join_clause())
-            query.append(where)
-            query.append(orderby)
-            query = ''.join(query)
-            self._sqlGen = query, params
+            def build(params):
+                entity = self.new_entity()
+                self.apply_select(entity)
+                query = ["SELECT "]
+                column_names, plan = self.select_plan(entity)
+                self.orderby_cols(column_names, params)
+                query.append(", ".join(column_names))
+                query.append(' FROM ')
+                query.append(self.table_name)
+                # we force where and orderby to be calculated before the
+                # join clause is added as they may add to the joins
+                where = self.where_clause(
+                    None, params, use_filter=True, use_skip=False)
+                orderby = self.orderby_clause()
+                query.append(self.join_clause())
+                query.append(where)
+                query.append(orderby)
+                return ''.join(query), plan
+            params, (query, plan) = self.cached_query(
+                self.query_shape('gen'), build)
+            self._sqlGen = query, params, plan
         else:
-            query, params = self._sqlGen
-        transaction = SQLTransaction(self.container, self.connection)
+            query, params, plan = self._sqlGen
+        transaction = SQLTransaction(self.container, self.connection,
+                                     self.streaming_query())
         try:
             transaction.begin()
             logging.info("%s; %s", query, to_text(params.params))
             transaction.execute(query, params)
-            while True:
-                row = transaction.cursor.fetchone()
-                if row is None:
-                    break
-                if entity is None:
-                    entity = self.new_entity()
-                    values = next(
-                        itertools.islice(
-                            zip(*list(self.select_fields(entity))), 1, None))
-                for value, new_value in zip(values, row):
-                    self.container.read_sql_value(value, new_value)
+            for row in self.fetch_rows(transaction.cursor):
+                entity = self.new_entity()
+                self.read_row(entity, plan, row)
                 entity.exists = True
                 yield entity
-                entity, values = None, None
             # we haven't changed the database, but we don't want to
             # leave the connection idle in transaction
             transaction.commit()
@@ -523,10 +609,343 @@ class SQLCollectionBase(core.EntityCollection):
         finally:
             transaction.close()
 
+    def streaming_query(self):
+        """Returns True if entities should be read with a streaming cursor
+
+        The result is :py:attr:`streaming` unless there is an expand
+        rule in effect.  Expansions are loaded with further queries on
+        the same connection while the entities are being read and many
+        databases do not allow new queries to be executed on a
+        connection until the result of a streaming query has been read
+        completely."""
+        return self.streaming and not self.expand
+
+    def fetch_rows(self, cursor):
+        """Generates the rows of the result set in *cursor*
+
+        cursor
+            A DB API cursor on which a query has been executed.
+
+        Rows are fetched in batches using the cursor's fetchmany method
+        with the batch size set by :py:attr:`fetch_size`.  If fetch_size
+        is 1 (or less) we revert to calling fetchone for each row which
+        is the safest option for DB API modules with poor support for
+        fetchmany."""
+        fetch_size = self.fetch_size
+        if fetch_size > 1:
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        else:
+            while True:
+                row = cursor.fetchone()
+                if row is None:
+                    break
+                yield row
+
+    def select_plan(self, entity):
+        """Returns a tuple of column names and a plan for reading rows
+
+        entity
+            Any instance of :py:class:`~pyslet.odata2.csdl.Entity`, it
+            is used as a template for the selected fields.
+
+        The column names are generated by :py:meth:`select_fields` and
+        the plan is a list of property paths, one for each column name,
+        that can be passed to :py:meth:`read_row` to set the values of
+        other entities from the rows returned by a query. Each path is a
+        tuple of property names, e.g., ('Address', 'City') for a complex
+        property.
+
+        Computing the plan once per query saves us having to run the
+        select_fields generator again for each entity in the result."""
+        paths = self._field_paths(entity)
+        column_names = []
+        plan = []
+        for c, v in self.select_fields(entity):
+            column_names.append(c)
+            plan.append(paths[id(v)])
+        return column_names, plan
+
+    def apply_select(self, entity):
+        """Applies the select rule of this collection to *entity*
+
+        entity
+            A new entity, to be used as the template passed to
+            :py:meth:`select_plan`
+
+        The :py:attr:`select` rule is applied to *entity* using
+        :py:meth:`~pyslet.odata2.csdl.Entity.expand` (with no expand
+        rule) ensuring that unselected properties are omitted from the
+        list of columns in the query.  The values of unselected
+        properties are never read from the database, they are simply
+        left NULL.  The keys and any concurrency tokens are always
+        selected."""
+        entity.expand(None, self.select)
+        if entity.selected is not None:
+            for p_def in self.entity_set.entityType.Property:
+                if p_def.concurrencyMode == edm.ConcurrencyMode.Fixed:
+                    entity.selected.add(p_def.name)
+
+    def _field_paths(self, entity):
+        # maps the ids of all simple values in entity to property paths
+        paths = {}
+        for k, v in entity.data_items():
+            if isinstance(v, edm.SimpleValue):
+                paths[id(v)] = (k,)
+            else:
+                for sub_path, fv in self._complex_field_generator(v):
+                    paths[id(fv)] = tuple([k] + sub_path)
+        return paths
+
+    def read_row(self, entity, plan, row):
+        """Sets the values of *entity* from a row of SQL values
+
+        entity
+            The :py:class:`~pyslet.odata2.csdl.Entity` to update
+
+        plan
+            A list of property paths as returned by
+            :py:meth:`select_plan`
+
+        row
+            A sequence of values returned by the DB API, only the first
+            len(plan) values are read, any extra values (such as those
+            used for ordering) are ignored."""
+        read_sql_value = self.container.read_sql_value
+        for path, new_value in zip(plan, row):
+            value = entity[path[0]]
+            for p in path[1:]:
+                value = value[p]
+            read_sql_value(value, new_value)
+
+    def sql_param(self, simple_value, params):
+        """Adds a simple value to a set of query parameters
+
+        simple_value
+            A :py:class:`~pyslet.odata2.csdl.SimpleValue` instance
+
+        params
+            The :py:class:`SQLParams` object to add the parameter to.
+
+        Returns the string to include in the query in place of the
+        value.  Methods that generate queries should use this method to
+        add values that may change from one query to the next (literals
+        in expressions, key values, skiptoken values, etc.) rather than
+        calling add_param directly.  The values passed are traced during
+        query generation allowing the resulting query to be saved in
+        the container's SQL cache, see :py:meth:`cached_query`."""
+        if self._param_trace is not None:
+            self._param_trace.append(id(simple_value))
+        return params.add_param(self.container.prepare_sql_value(simple_value))
+
+    def query_shape(self, kind, entity=None, use_skip=False, limit=None):
+        """Returns a tuple of (key, values) describing a query
+
+        kind
+            A string identifying the type of query, e.g., 'len'
+
+        entity
+            An optional entity that is the focus of the query, only the
+            values of its keys are relevant.
+
+        use_skip
+            True if the query will be limited by the skiptoken
+
+        limit
+            Any additional hashable value that changes the generated
+            SQL.  Values that vary from request to request, such as the
+            skip and top values used in paged queries, should be added
+            to the query after the cache lookup instead, otherwise each
+            new value adds an entry to the SQL cache.
+
+        The key is a hashable value that identifies the *shape* of the
+        query.  Two queries with the same key generate the same SQL
+        but the values of the parameters may differ.  For example, the
+        filters "Price gt 1" and "Price gt 10" result in the same key.
+
+        The values are a list of the
+        :py:class:`~pyslet.odata2.csdl.SimpleValue` instances that may
+        be passed to :py:meth:`sql_param` when the query is generated,
+        in this case, the literal values 1 and 10 respectively.
+
+        Derived classes that generate queries that depend on additional
+        state should extend the key (and values) accordingly."""
+        values = []
+        key = [kind, self.__class__, self.entity_set.name]
+        if entity is not None:
+            values.extend(dict_values(entity.key_dict()))
+            key.append(True)
+        else:
+            key.append(False)
+        if self.filter is None:
+            key.append(None)
+        else:
+            key.append(self._expression_shape(self.filter, values))
+        if self.orderby is None:
+            key.append(None)
+        else:
+            key.append(tuple((self._expression_shape(e, values), d) for
+                             e, d in self.orderby))
+        if use_skip and self.skiptoken is not None:
+            values.extend(self.skiptoken)
+            key.append(len(self.skiptoken))
+        else:
+            key.append(None)
+        key.append(self._option_shape(self.select))
+        key.append(self._option_shape(self.expand))
+        key.append(limit)
+        return tuple(key), values
+
+    @classmethod
+    def _expression_shape(cls, expression, values):
+        if isinstance(expression, UnparameterizedLiteral):
+            return (UnparameterizedLiteral, to_text(expression.value))
+        elif isinstance(expression, core.LiteralExpression):
+            values.append(expression.value)
+            return (core.LiteralExpression, expression.value.type_code,
+                    not expression.value)
+        elif isinstance(expression, core.PropertyExpression):
+            return (core.PropertyExpression, expression.name)
+        elif isinstance(expression, core.CallExpression):
+            return (core.CallExpression, expression.method,
+                    tuple(cls._expression_shape(e, values) for
+                          e in expression.operands))
+        else:
+            return (expression.__class__, expression.operator,
+                    tuple(cls._expression_shape(e, values) for
+                          e in expression.operands))
+
+    @classmethod
+    def _option_shape(cls, option):
+        if option is None:
+            return None
+        return tuple(sorted((k, cls._option_shape(v)) for
+                            k, v in dict_items(option)))
+
+    def cached_query(self, shape, build):
+        """Returns a query, using the container's SQL cache if possible
+
+        shape
+            A (key, values) tuple as returned by :py:meth:`query_shape`
+
+        build
+            A callable that generates the query.  It is called with a
+            single argument, a new :py:class:`SQLParams` instance to
+            which parameters must be added, and must return the result
+            to be cached, typically the query string (or a tuple
+            containing it).
+
+        Returns a tuple of (params, result).  If a query with the same
+        key has been built previously then build is not called, instead
+        the cached result is returned with a new params object
+        populated from the values in *shape*.
+
+        A query is only added to the cache if all the parameters were
+        added using :py:meth:`sql_param` and can be traced back to the
+        values in *shape*."""
+        key, values = shape
+        params = self.container.ParamsClass()
+        entry = self.container.get_cached_sql(key)
+        if entry is not None:
+            result, slots = entry
+            for i in slots:
+                params.add_param(self.container.prepare_sql_value(values[i]))
+            return params, result
+        self._param_trace = trace = []
+        try:
+            result = build(params)
+        finally:
+            self._param_trace = None
+        if params.params is not None and len(trace) == len(params.params):
+            index = {}
+            for i, v in enumerate(values):
+                index.setdefault(id(v), i)
+            try:
+                slots = [index[vid] for vid in trace]
+                self.container.set_cached_sql(key, (result, slots))
+            except KeyError:
+                # untraceable parameter, don't cache
+                pass
+        return params, result
+
     def itervalues(self):
         return self.expand_entities(
             self.entity_generator())
 
+    def expand_entities(self, entity_iterable):
+        """Overridden to expand navigation properties in batches
+
+        The default implementation calls expand on each entity which
+        results in a separate query for each expanded navigation
+        property of each entity.  Instead, we read the entities in
+        batches of up to :py:attr:`EXPAND_BATCH_SIZE` and then expand
+        the whole batch with :py:meth:`expand_batch`."""
+        if not self.expand:
+            for e in super(SQLCollectionBase, self).expand_entities(
+                    entity_iterable):
+                yield e
+            return
+        batch = []
+        for e in entity_iterable:
+            batch.append(e)
+            if len(batch) >= self.EXPAND_BATCH_SIZE:
+                self.expand_batch(batch)
+                for e in batch:
+                    yield e
+                batch = []
+        if batch:
+            self.expand_batch(batch)
+            for e in batch:
+                yield e
+
+    def expand_batch(self, entities):
+        """Expands and selects properties of a list of entities
+
+        entities
+            A list of entities from this collection
+
+        The :py:attr:`expand` and :py:attr:`select` rules are applied to
+        each entity as per
+        :py:meth:`~pyslet.odata2.csdl.Entity.expand` but each
+        navigation property is expanded for all entities in the list at
+        the same time using
+        :py:meth:`SQLNavigationCollection.expansion_values`."""
+        select = self.select
+        for e in entities:
+            e.expand(None, select)
+        if select is None:
+            select = {}
+        keys = self.entity_set.keys
+        for name, expand in dict_items(self.expand):
+            if name in select:
+                sub_select = select[name]
+                if sub_select is None:
+                    sub_select = {'*': None}
+            else:
+                sub_select = None
+            with self.entity_set.open_navigation(
+                    name, entities[0]) as collection:
+                if not isinstance(collection, SQLNavigationCollection):
+                    for e in entities:
+                        e[name].expand_collection(expand, sub_select)
+                    continue
+                collection.set_expand(expand, sub_select)
+                values = collection.expansion_values(entities)
+            for e in entities:
+                e[name].set_expansion_values(
+                    values.get(tuple(e[k].value for k in keys), []))
+
+    def set_expand(self, expand, select=None):
+        """Overridden to reset the cached entity query
+
+        The select rule determines the columns in the query."""
+        super(SQLCollectionBase, self).set_expand(expand, select)
+        self._sqlGen = None
+
     def set_page(self, top, skip=0, skiptoken=None):
         """Sets the values for paging.
 
@@ -602,51 +1021,44 @@ class SQLCollectionBase(core.EntityCollection):
                 limit = topmax
         else:
             limit = top
-        entity = self.new_entity()
-        query = ["SELECT "]
-        skip, limit_clause = self.container.select_limit_clause(skip, limit)
-        if limit_clause:
-            query.append(limit_clause)
-        params = self.container.ParamsClass()
-        column_names, values = zip(*list(self.select_fields(entity)))
-        column_names = list(column_names)
-        self.orderby_cols(column_names, params, True)
-        query.append(", ".join(column_names))
-        query.append(' FROM ')
-        query.append(self.table_name)
-        where = self.where_clause(None, params, use_filter=True, use_skip=True)
-        orderby = self.orderby_clause()
-        query.append(self.join_clause())
-        query.append(where)
-        query.append(orderby)
+
+        def build(params):
+            # the SELECT modifier and limit clause are added later
+            entity = self.new_entity()
+            self.apply_select(entity)
+            query = []
+            column_names, plan = self.select_plan(entity)
+            self.orderby_cols(column_names, params, True)
+            query.append(", ".join(column_names))
+            query.append(' FROM ')
+            query.append(self.table_name)
+            where = self.where_clause(
+                None, params, use_filter=True, use_skip=True)
+            orderby = self.orderby_clause()
+            query.append(self.join_clause())
+            query.append(where)
+            query.append(orderby)
+            return ''.join(query), plan
+        params, (query, plan) = self.cached_query(
+            self.query_shape('page', use_skip=True), build)
+        # skip and top are not part of the cached query so that pages
+        # with different values share the same cache entry
+        skip, modifier = self.container.select_limit_clause(skip, limit)
         skip, limit_clause = self.container.limit_clause(skip, limit)
-        if limit_clause:
-            query.append(limit_clause)
-        query = ''.join(query)
-        transaction = SQLTransaction(self.container, self.connection)
+        query = ''.join(("SELECT ", modifier, query, limit_clause))
+        transaction = SQLTransaction(self.container, self.connection,
+                                     self.streaming_query())
         try:
             transaction.begin()
             logging.info("%s; %s", query, to_text(params.params))
             transaction.execute(query, params)
-            while True:
-                row = transaction.cursor.fetchone()
-                if row is None:
-                    # no more pages
-                    if set_next:
-                        self.top = self.skip = 0
-                        self.skipToken = None
-                    break
+            for row in self.fetch_rows(transaction.cursor):
                 if skip:
                     skip = skip - 1
                     continue
-                if entity is None:
-                    entity = self.new_entity()
-                    values = next(
-                        itertools.islice(
-                            zip(*list(self.select_fields(entity))), 1, None))
+                entity = self.new_entity()
                 row_values = list(row)
-                for value, new_value in zip(values, row_values):
-                    self.container.read_sql_value(value, new_value)
+                self.read_row(entity, plan, row_values)
                 entity.exists = True
                 yield entity
                 if topmax is not None:
@@ -684,7 +1096,11 @@ class SQLCollectionBase(core.EntityCollection):
                             else:
                                 self.skip = self.top
                         break
-                entity = None
+            else:
+                # no more pages
+                if set_next:
+                    self.top = self.skip = 0
+                    self.skipToken = None
             # we haven't changed the database, but we don't want to
             # leave the connection idle in transaction
             transaction.commit()
@@ -700,16 +1116,20 @@ class SQLCollectionBase(core.EntityCollection):
     def __getitem__(self, key):
         entity = self.new_entity()
         entity.set_key(key)
-        params = self.container.ParamsClass()
-        query = ["SELECT "]
-        column_names, values = zip(*list(self.select_fields(entity)))
-        query.append(", ".join(column_names))
-        query.append(' FROM ')
-        query.append(self.table_name)
-        where = self.where_clause(entity, params)
-        query.append(self.join_clause())
-        query.append(where)
-        query = ''.join(query)
+
+        def build(params):
+            self.apply_select(entity)
+            query = ["SELECT "]
+            column_names, plan = self.select_plan(entity)
+            query.append(", ".join(column_names))
+            query.append(' FROM ')
+            query.append(self.table_name)
+            where = self.where_clause(entity, params)
+            query.append(self.join_clause())
+            query.append(where)
+            return ''.join(query), plan
+        params, (query, plan) = self.cached_query(
+            self.query_shape('item', entity=entity), build)
         transaction = SQLTransaction(self.container, self.connection)
         try:
             transaction.begin()
@@ -724,8 +1144,7 @@ class SQLCollectionBase(core.EntityCollection):
                 # whoops, that was unexpected
                 raise SQLError(
                     "Integrity check failure, non-unique key: %s" % repr(key))
-            for value, new_value in zip(values, row):
-                self.container.read_sql_value(value, new_value)
+            self.read_row(entity, plan, row)
             entity.exists = True
             entity.expand(self.expand, self.select)
             transaction.commit()
@@ -739,7 +1158,14 @@ class SQLCollectionBase(core.EntityCollection):
         finally:
             transaction.close()
 
-    def read_stream(self, key, out=None):
+    def read_stream(self, key, out=None, byte_range=None):
+        """Reads a media resource
+
+        If *byte_range* is given we seek directly to the first block in
+        the range.  As the stream's MD5 checksum can't be checked when
+        only part of the stream is read, each block read is checked
+        against its hash key instead.  Otherwise the whole stream is
+        read and the MD5 checksum is checked as usual."""
         entity = self.new_entity()
         entity.set_key(key)
         svalue = self._get_streamid(key)
@@ -755,7 +1181,10 @@ class SQLCollectionBase(core.EntityCollection):
             estream = None
             sinfo.size = 0
             sinfo.md5 = hashlib.md5(b'').digest()
-        if out is not None and svalue:
+        if out is not None and svalue and byte_range is not None:
+            for data in self._read_range_gen(estream, byte_range):
+                out.write(data)
+        elif out is not None and svalue:
             with self.container.streamstore.open_stream(estream, 'r') as src:
                 actual_size, actual_md5 = self._copy_src(src, out)
             if sinfo.size is not None and sinfo.size != actual_size:
@@ -768,7 +1197,7 @@ class SQLCollectionBase(core.EntityCollection):
                                entity.get_location())
         return sinfo
 
-    def read_stream_close(self, key):
+    def read_stream_close(self, key, byte_range=None):
         entity = self.new_entity()
         entity.set_key(key)
         svalue = self._get_streamid(key)
@@ -780,11 +1209,13 @@ class SQLCollectionBase(core.EntityCollection):
             sinfo.modified = estream['modified'].value.with_zone(0)
             sinfo.size = estream['size'].value
             sinfo.md5 = estream['md5'].value
+            if byte_range is not None:
+                return sinfo, self._read_range_close(estream, byte_range)
             return sinfo, self._read_stream_gen(estream, sinfo)
         else:
             estream = None
             sinfo.size = 0
-            sinfo.md5 = hashlib.md5('').digest()
+            sinfo.md5 = hashlib.md5(b'').digest()
             self.close()
             return sinfo, []
 
@@ -794,11 +1225,12 @@ class SQLCollectionBase(core.EntityCollection):
                 h = hashlib.md5()
                 count = 0
                 while True:
-                    data = src.read(io.DEFAULT_BUFFER_SIZE)
+                    # read whole blocks avoiding intermediate copies
+                    data = src.readview()
                     if len(data):
                         count += len(data)
                         h.update(data)
-                        yield data
+                        yield data.tobytes()
                     else:
                         break
             if sinfo.size is not None and sinfo.size != count:
@@ -812,6 +1244,31 @@ class SQLCollectionBase(core.EntityCollection):
         finally:
             self.close()
 
+    def _read_range_close(self, estream, byte_range):
+        try:
+            for data in self._read_range_gen(estream, byte_range):
+                yield data
+        finally:
+            self.close()
+
+    def _read_range_gen(self, estream, byte_range):
+        first_byte, last_byte = byte_range
+        rbytes = last_byte + 1 - first_byte
+        try:
+            with self.container.streamstore.open_stream(
+                    estream, 'r', verify=True) as src:
+                src.seek(first_byte)
+                while rbytes > 0:
+                    data = src.readview(rbytes)
+                    if not len(data):
+                        raise SQLError("stream size mismatch on read [%i]" %
+                                       estream.key())
+                    rbytes -= len(data)
+                    yield data.tobytes()
+        except blockstore.BlockCorrupt:
+            raise SQLError("stream checksum mismatch on read [%i]" %
+                           estream.key())
+
     def update_stream(self, src, key, sinfo=None):
         e = self.new_entity()
         e.set_key(key)
@@ -1143,7 +1600,7 @@ class SQLCollectionBase(core.EntityCollection):
                 '%s.%s=%s' %
                 (self.table_name,
                  self.container.mangled_names[(self.entity_set.name, k)],
-                 params.add_param(self.container.prepare_sql_value(v))))
+                 self.sql_param(v, params)))
 
     def where_skiptoken_clause(self, where, params):
         """Adds the entity constraint expression to a list of SQL expressions.
@@ -1166,10 +1623,7 @@ class SQLCollectionBase(core.EntityCollection):
                 o_expression = oname
             skip_expression.append(
                 "(%s %s %s" %
-                (o_expression,
-                 op,
-                 params.add_param(
-                     self.container.prepare_sql_value(v))))
+                (o_expression, op, self.sql_param(v, params)))
             ket += 1
             i += 1
             if i < len(self.orderNames):
@@ -1179,8 +1633,7 @@ class SQLCollectionBase(core.EntityCollection):
                     o_expression = self.sql_expression(expression, params, '=')
                 skip_expression.append(
                     " OR (%s = %s AND " %
-                    (o_expression, params.add_param(
-                        self.container.prepare_sql_value(v))))
+                    (o_expression, self.sql_param(v, params)))
                 ket += 1
                 continue
             else:
@@ -1531,9 +1984,7 @@ class SQLCollectionBase(core.EntityCollection):
             return self.container.ParamsClass.escape_literal(
                 to_text(expression.value))
         elif isinstance(expression, core.LiteralExpression):
-            return params.add_param(
-                self.container.prepare_sql_value(
-                    expression.value))
+            return self.sql_param(expression.value, params)
         elif isinstance(expression, core.PropertyExpression):
             try:
                 p = self.entity_set.entityType[expression.name]
@@ -2007,6 +2458,41 @@ class SQLEntityCollection(SQLCollectionBase):
     constructing and executing queries to implement the core methods
     from :py:class:`pyslet.odata2.csdl.EntityCollection`."""
 
+    def __len__(self):
+        """Returns the number of entities in the collection
+
+        If :py:attr:`estimate_len` is True and no filter has been set
+        then we return the estimate provided by
+        :py:meth:`estimated_len` (if there is one) instead of counting
+        the rows in the table."""
+        if self.estimate_len and self.filter is None:
+            result = self.estimated_len()
+            if result is not None:
+                return result
+        return super(SQLEntityCollection, self).__len__()
+
+    def estimated_len(self):
+        """Returns an estimate of the size of this collection
+
+        The estimate is obtained from the database's own statistics
+        using :py:meth:`SQLEntityContainer.estimate_count` and ignores
+        any filter.  Returns None if no estimate is available."""
+        transaction = SQLTransaction(self.container, self.connection)
+        try:
+            transaction.begin()
+            result = self.container.estimate_count(
+                transaction, self.table_name)
+            transaction.commit()
+            return result
+        except self.container.dbapi.Error as e:
+            # statistics may not be available, fall back to COUNT
+            transaction.rollback(e, swallow=True)
+            return None
+        except Exception as e:
+            transaction.rollback(e)
+        finally:
+            transaction.close()
+
     def insert_entity(self, entity):
         """Inserts *entity* into the collection.
 
@@ -2347,6 +2833,134 @@ class SQLEntityCollection(SQLCollectionBase):
         finally:
             transaction.close()
 
+    def insert_entities(self, entities, batch_size=100, transaction=None,
+                        from_end=None, fk_values=None):
+        """Inserts multiple entities into the collection.
+
+        entities
+            An iterable of :py:class:`~pyslet.odata2.csdl.Entity`
+            instances to insert.
+
+        batch_size
+            The maximum number of entities to insert with a single call
+            to the DB API's executemany method, defaults to 100.
+
+        transaction
+            An optional transaction.  If present, the connection is left
+            uncommitted.
+
+        from_end, fk_values
+            Optional values used to link each entity as it is inserted,
+            see :py:meth:`insert_entity_sql` for details.
+
+        All entities are inserted in a single transaction so either all
+        the entities are inserted or (where transactions are supported)
+        none of them are.  If any entity violates a model constraint
+        then :py:class:`~pyslet.odata2.csdl.ConstraintError` is raised.
+
+        Entities are grouped into batches of consecutive entities that
+        generate identical INSERT statements and each batch is passed to
+        the database in a single executemany call.  Entities with
+        navigation bindings or required links, and entities with a
+        missing key that must be generated by :py:meth:`insert_entity_sql`,
+        are inserted individually (in the same transaction).
+
+        Read only fields (such as automatically generated keys) are read
+        back in bulk using :py:meth:`where_last_batch`.  If the
+        collection does not support this method then entities with read
+        only fields are inserted one at a time instead."""
+        if transaction is None:
+            transaction = SQLTransaction(self.container, self.connection)
+        try:
+            transaction.begin()
+            batch = []
+            batch_query = None
+            for entity in entities:
+                if entity.exists:
+                    raise edm.EntityExists(str(entity.get_location()))
+                if not self._is_simple_insert(entity, from_end):
+                    self._insert_batch(batch_query, batch, transaction)
+                    batch, batch_query = [], None
+                    self.insert_entity_sql(entity, from_end, fk_values,
+                                           transaction=transaction)
+                    continue
+                entity.set_concurrency_tokens()
+                query = ['INSERT INTO ', self.table_name, ' (']
+                fields = list(self.insert_fields(entity))
+                if fk_values:
+                    fields += fk_values
+                column_names, values = zip(*fields)
+                query.append(", ".join(column_names))
+                query.append(') VALUES (')
+                params = self.container.ParamsClass()
+                query.append(
+                    ", ".join(params.add_param(
+                        self.container.prepare_sql_value(x)) for x in values))
+                query.append(')')
+                query = ''.join(query)
+                if query != batch_query or len(batch) >= batch_size:
+                    self._insert_batch(batch_query, batch, transaction)
+                    batch, batch_query = [], query
+                batch.append((entity, params))
+            self._insert_batch(batch_query, batch, transaction)
+            transaction.commit()
+        except (self.container.dbapi.IntegrityError,
+                self.container.dbapi.InternalError) as e:
+            transaction.rollback(e, swallow=True)
+            raise edm.ConstraintError(
+                "insert_entities failed for %s : %s" %
+                (self.entity_set.name, str(e)))
+        except Exception as e:
+            transaction.rollback(e)
+        finally:
+            transaction.close()
+
+    def _is_simple_insert(self, entity, from_end=None):
+        # True if entity can be inserted with a simple INSERT statement
+        for link_end, nav_name in dict_items(self.entity_set.linkEnds):
+            if link_end == from_end:
+                # linked using fk_values
+                continue
+            if (link_end.otherEnd.associationEnd.multiplicity ==
+                    edm.Multiplicity.One):
+                # a required link, let insert_entity_sql deal with it
+                return False
+            if nav_name and entity[nav_name].bindings:
+                return False
+        if not self.auto_keys:
+            try:
+                entity.key()
+            except KeyError:
+                return False
+        return True
+
+    def _insert_batch(self, query, batch, transaction):
+        if not batch:
+            return
+        entities = [e for e, p in batch]
+        auto_fields = list(self.auto_fields(entities[0]))
+        if len(batch) == 1:
+            logging.info("%s; %s", query, to_text(batch[0][1].params))
+            transaction.execute(query, batch[0][1])
+            if auto_fields:
+                self.get_auto(entities[0], auto_fields, transaction)
+        else:
+            if auto_fields:
+                params = self.container.ParamsClass()
+                try:
+                    where = self.where_last_batch(entities, params)
+                except NotImplementedError:
+                    # no bulk support, insert one at a time
+                    for item in batch:
+                        self._insert_batch(query, [item], transaction)
+                    return
+            logging.info("%s; [%i rows]", query, len(batch))
+            transaction.executemany(query, [p for e, p in batch])
+            if auto_fields:
+                self.get_auto_batch(entities, params, where, transaction)
+        for entity in entities:
+            entity.exists = True
+
     def get_auto(self, entity, auto_fields, transaction):
         params = self.container.ParamsClass()
         query = ["SELECT "]
@@ -2414,9 +3028,68 @@ class SQLEntityCollection(SQLCollectionBase):
         finally:
             transaction.close()
 
+    def get_auto_batch(self, entities, params, where, transaction):
+        """Reads back the read only fields after a batch insert
+
+        entities
+            The list of entities that were inserted, in the order they
+            were inserted.
+
+        params and where
+            The parameters and WHERE clause returned by
+            :py:meth:`where_last_batch`."""
+        query = ["SELECT "]
+        paths = self._field_paths(entities[0])
+        column_names = []
+        plan = []
+        for c, v in self.auto_fields(entities[0]):
+            column_names.append(c)
+            plan.append(paths[id(v)])
+        query.append(", ".join(column_names))
+        query.append(' FROM ')
+        query.append(self.table_name)
+        query.append(where)
+        query = ''.join(query)
+        try:
+            transaction.begin()
+            logging.info("%s; %s", query, to_text(params.params))
+            transaction.execute(query, params)
+            rows = transaction.cursor.fetchall()
+            if len(rows) != len(entities):
+                raise SQLError(
+                    "Integrity check failure, expected %i rows after batch "
+                    "insert, found %i" % (len(entities), len(rows)))
+            for entity, row in zip(entities, rows):
+                self.read_row(entity, plan, row)
+                entity.expand(self.expand, self.select)
+            transaction.commit()
+        except Exception as e:
+            transaction.rollback(e)
+        finally:
+            transaction.close()
+
     def where_last(self, entity, params):
         raise NotImplementedError("Automatic keys not supported")
 
+    def where_last_batch(self, entities, params):
+        """Returns a clause selecting the rows from a batch insert
+
+        entities
+            The list of entities just inserted using a single call to
+            executemany.
+
+        params
+            The :py:class:`SQLParams` object to add parameters to.
+
+        The result is a WHERE clause (optionally followed by an ORDER BY
+        clause) that selects exactly those rows that were inserted, in
+        the order they were inserted.
+
+        The default implementation raises NotImplementedError, in which
+        case entities with read only fields are inserted one at a time
+        using :py:meth:`where_last`."""
+        raise NotImplementedError("Automatic keys not supported in batch")
+
     def update_entity(self, entity, merge=True):
         """Updates *entity*
 
@@ -3063,14 +3736,52 @@ class SQLEntityCollection(SQLCollectionBase):
         query.append(')')
         return ''.join(query), params
 
+    def create_index_queries(self):
+        """Returns a list of SQL statements for creating indexes
+
+        An index is created for each foreign key in the table, these
+        are used when navigating from the target entity back to this
+        entity set.  Indexes are also created on any properties that
+        are identified by :py:meth:`SQLEntityContainer.indexed_name`."""
+        queries = []
+        fk_mapping = self.container.fk_table[self.entity_set.name]
+        for link_end in fk_mapping:
+            aset_name = link_end.parent.name
+            target_set = link_end.otherEnd.entity_set
+            fk_names = [self.container.mangled_names[
+                (self.entity_set.name, aset_name, key_name)] for
+                key_name in target_set.keys]
+            queries.append(
+                "CREATE INDEX %s ON %s (%s)" %
+                (self.container.mangled_names[
+                    (self.entity_set.name, self.entity_set.name, aset_name,
+                     'ix')],
+                 self.table_name, ', '.join(fk_names)))
+        for source_path in self.container.source_path_generator(
+                self.entity_set):
+            if source_path not in self.container.indexed_names:
+                continue
+            queries.append(
+                "CREATE INDEX %s ON %s (%s)" %
+                (self.container.mangled_names[
+                    (self.entity_set.name, ) + source_path + ('ix', )],
+                 self.table_name, self.container.mangled_names[source_path]))
+        return queries
+
     def create_table(self):
-        """Executes the SQL statement :py:meth:`create_table_query`"""
+        """Executes the SQL statement :py:meth:`create_table_query`
+
+        The indexes returned by :py:meth:`create_index_queries` are
+        created in the same transaction."""
         query, params = self.create_table_query()
         transaction = SQLTransaction(self.container, self.connection)
         try:
             transaction.begin()
             logging.info("%s; %s", query, to_text(params.params))
             transaction.execute(query, params)
+            for query in self.create_index_queries():
+                logging.info("%s;", query)
+                transaction.execute(query)
             transaction.commit()
         except Exception as e:
             transaction.rollback(e)
@@ -3112,6 +3823,98 @@ class SQLNavigationCollection(SQLCollectionBase, core.NavigationCollection):
         self.aset_name = aset_name
         super(SQLNavigationCollection, self).__init__(**kwargs)
 
+    def query_shape(self, kind, entity=None, use_skip=False, limit=None):
+        """Overridden to add the navigation source to the key
+
+        The keys of *from_entity* are added to the values."""
+        key, values = super(SQLNavigationCollection, self).query_shape(
+            kind, entity, use_skip, limit)
+        values.extend(dict_values(self.from_entity.key_dict()))
+        return key + (self.from_end, self.name), values
+
+    def from_key_fields(self):
+        """Returns the column expressions for *from_entity*'s keys
+
+        The result is a list of tuples of (key name, column expression)
+        with one entry for each key of the source entity set, in the
+        order of the entity set's keys.  The column expressions must be
+        valid in a query that includes the :py:meth:`join_clause`.
+
+        There is no default implementation."""
+        raise NotImplementedError
+
+    def expansion_values(self, from_entities):
+        """Returns the entities linked from a list of source entities
+
+        from_entities
+            A list of entities from the same entity set as
+            *from_entity*.  The value of *from_entity* itself is
+            ignored.
+
+        Instead of querying for the entities linked from *from_entity*
+        a single query is used to load the entities linked from any of
+        *from_entities*.  The result is a dictionary that maps tuples of
+        key values (the values of the keys of each source entity) onto
+        lists of entities from this collection.  Source entities that
+        are not linked to any entities are omitted from the result.
+
+        The expand and select rules of this collection are applied to
+        the resulting entities using :py:meth:`expand_entities`."""
+        if self._joins is None:
+            self.reset_joins()
+        from_keys = self.from_key_fields()
+        entity = self.new_entity()
+        self.apply_select(entity)
+        query = ["SELECT "]
+        params = self.container.ParamsClass()
+        column_names, plan = self.select_plan(entity)
+        column_names = column_names + [c for k, c in from_keys]
+        query.append(", ".join(column_names))
+        query.append(' FROM ')
+        query.append(self.table_name)
+        query.append(self.join_clause())
+        query.append(' WHERE ')
+        if len(from_keys) == 1:
+            k, c = from_keys[0]
+            query.append("%s IN (%s)" % (c, ", ".join(
+                self.sql_param(e[k], params) for e in from_entities)))
+        else:
+            query.append("(%s)" % " OR ".join(
+                "(%s)" % " AND ".join(
+                    "%s=%s" % (c, self.sql_param(e[k], params)) for
+                    k, c in from_keys) for e in from_entities))
+        query.append(' ORDER BY ')
+        query.append(", ".join([c for k, c in from_keys] +
+                               [n for n, d in self.orderNames]))
+        query = ''.join(query)
+        from_type = self.from_entity.entity_set.entityType
+        key_values = [from_type[k]() for k, c in from_keys]
+        nplan = len(plan)
+        result = {}
+        entities = []
+        transaction = SQLTransaction(self.container, self.connection)
+        try:
+            transaction.begin()
+            logging.info("%s; %s", query, to_text(params.params))
+            transaction.execute(query, params)
+            for row in self.fetch_rows(transaction.cursor):
+                for v, new_value in zip(key_values, row[nplan:]):
+                    self.container.read_sql_value(v, new_value)
+                entity = self.new_entity()
+                self.read_row(entity, plan, row)
+                entity.exists = True
+                result.setdefault(
+                    tuple(v.value for v in key_values), []).append(entity)
+                entities.append(entity)
+            transaction.commit()
+        except Exception as e:
+            transaction.rollback(e)
+        finally:
+            transaction.close()
+        for entity in self.expand_entities(entities):
+            pass
+        return result
+
     def __setitem__(self, key, entity):
         # sanity check entity to check it can be inserted here
         if (not isinstance(entity, edm.Entity) or
@@ -3250,6 +4053,16 @@ class SQLForeignKeyCollection(SQLNavigationCollection):
         self._joins[nav_name] = (alias, join)
         self._source_alias = alias
 
+    def from_key_fields(self):
+        """Uses the alias set in the :py:meth:`join_clause`"""
+        if self._joins is None:
+            self.reset_joins()
+        from_set = self.from_entity.entity_set
+        return [(k, "%s.%s" % (self._source_alias,
+                               self.container.mangled_names[
+                                   (from_set.name, k)]))
+                for k in from_set.keys]
+
     def where_clause(self, entity, params, use_filter=True, use_skip=False):
         """Adds the constraint for entities linked from *from_entity* only.
 
@@ -3262,8 +4075,8 @@ class SQLForeignKeyCollection(SQLNavigationCollection):
             where.append(
                 "%s.%s=%s" %
                 (self._source_alias, self.container.mangled_names[
-                    (self.from_entity.entity_set.name, k)], params.add_param(
-                    self.container.prepare_sql_value(v))))
+                    (self.from_entity.entity_set.name, k)],
+                 self.sql_param(v, params)))
         if entity is not None:
             self.where_entity_clause(where, entity, params)
         if self.filter is not None and use_filter:
@@ -3370,6 +4183,12 @@ class SQLReverseKeyCollection(SQLNavigationCollection):
         super(SQLReverseKeyCollection, self).__init__(**kwargs)
         self.keyCollection = self.entity_set.open()
 
+    def from_key_fields(self):
+        """Returns the foreign key columns in the target table"""
+        return [(k, "%s.%s" % (self.table_name, self.container.mangled_names[
+                    (self.entity_set.name, self.aset_name, k)]))
+                for k in self.from_entity.entity_set.keys]
+
     def where_clause(self, entity, params, use_filter=True, use_skip=False):
         """Adds the constraint to entities linked from *from_entity* only."""
         where = []
@@ -3377,7 +4196,7 @@ class SQLReverseKeyCollection(SQLNavigationCollection):
             where.append("%s=%s" % (
                 self.container.mangled_names[
                     (self.entity_set.name, self.aset_name, k)],
-                params.add_param(self.container.prepare_sql_value(v))))
+                self.sql_param(v, params)))
         if entity is not None:
             self.where_entity_clause(where, entity, params)
         if self.filter is not None and use_filter:
@@ -3410,6 +4229,22 @@ class SQLReverseKeyCollection(SQLNavigationCollection):
         finally:
             transaction.close()
 
+    def insert_entities(self, entities, batch_size=100, transaction=None):
+        """Inserts multiple entities and links them to *from_entity*
+
+        The foreign key values are added to the INSERT statements and
+        the entities are inserted using
+        :py:meth:`SQLEntityCollection.insert_entities` so all the
+        entities are inserted and linked in a single transaction."""
+        fk_values = []
+        for k, v in dict_items(self.from_entity.key_dict()):
+            fk_values.append(
+                (self.container.mangled_names[
+                    (self.entity_set.name, self.aset_name, k)], v))
+        self.keyCollection.insert_entities(
+            entities, batch_size, transaction, self.from_end.otherEnd,
+            fk_values)
+
     def insert_link(self, entity, transaction=None):
         return self.keyCollection.update_link(
             entity,
@@ -3654,6 +4489,13 @@ class SQLAssociationCollection(SQLNavigationCollection):
         self._aliases.add(alias)
         return alias
 
+    def from_key_fields(self):
+        """Returns the *from_entity* foreign key in the auxiliary table"""
+        from_set = self.from_entity.entity_set
+        return [(k, "%s.%s" % (self.atable_name, self.container.mangled_names[
+                    (self.aset_name, from_set.name, self.from_nav_name, k)]))
+                for k in from_set.keys]
+
     def where_clause(self, entity, params, use_filter=True, use_skip=False):
         """Provides the *from_entity* constraint in the auxiliary table."""
         where = []
@@ -3666,8 +4508,7 @@ class SQLAssociationCollection(SQLNavigationCollection):
                       self.from_entity.entity_set.name,
                       self.from_nav_name,
                       k)],
-                    params.add_param(
-                     self.container.prepare_sql_value(v))))
+                 self.sql_param(v, params)))
         if entity is not None:
             for k, v in dict_items(entity.key_dict()):
                 where.append(
@@ -3678,8 +4519,7 @@ class SQLAssociationCollection(SQLNavigationCollection):
                           entity.entity_set.name,
                           self.toNavName,
                           k)],
-                        params.add_param(
-                         self.container.prepare_sql_value(v))))
+                     self.sql_param(v, params)))
         if use_filter and self.filter is not None:
             where.append("(%s)" % self.sql_expression(self.filter, params))
         if self.skiptoken is not None and use_skip:
@@ -3977,9 +4817,34 @@ class SQLAssociationCollection(SQLNavigationCollection):
         query.append(')')
         return ''.join(query), params
 
+    @classmethod
+    def create_index_queries(cls, container, aset_name):
+        """Returns a list of SQL statements to index the auxiliary table
+
+        The unique constraint that spans all columns provides an index
+        for navigation from the 'A' side of the association but the
+        reverse navigation requires an additional index on the 'B'
+        foreign key (unless it is already covered by a unique
+        constraint).  The index name is obtained by mangling::
+
+            ( association set name, association set name, 'ixB')"""
+        entitySetA, nameA, entitySetB, nameB, uniqueKeys = container.aux_table[
+            aset_name]
+        if uniqueKeys:
+            return []
+        fk_names = [container.mangled_names[
+            (aset_name, entitySetB.name, nameB, key_name)] for
+            key_name in entitySetB.keys]
+        return ["CREATE INDEX %s ON %s (%s)" % (
+            container.mangled_names[(aset_name, aset_name, "ixB")],
+            container.mangled_names[(aset_name,)], ', '.join(fk_names))]
+
     @classmethod
     def create_table(cls, container, aset_name):
-        """Executes the SQL statement :py:meth:`create_table_query`"""
+        """Executes the SQL statement :py:meth:`create_table_query`
+
+        The indexes returned by :py:meth:`create_index_queries` are
+        created in the same transaction."""
         connection = container.acquire_connection(
             SQL_TIMEOUT)        #: a connection to the database
         if connection is None:
@@ -3991,6 +4856,9 @@ class SQLAssociationCollection(SQLNavigationCollection):
             query, params = cls.create_table_query(container, aset_name)
             logging.info("%s; %s", query, to_text(params.params))
             transaction.execute(query, params)
+            for query in cls.create_index_queries(container, aset_name):
+                logging.info("%s;", query)
+                transaction.execute(query)
             transaction.commit()
         except Exception as e:
             transaction.rollback(e)
@@ -4053,7 +4921,9 @@ class SQLConnection(object):
 
     Used in the connection pools to keep track of which thread owns the
     connections, the depth of the lock and when the connection was last
-    modified (acquired or released)."""
+    modified (acquired or released).  The changeset attributes are
+    used to group transactions together, see
+    :py:meth:`SQLEntityContainer.begin_changeset`."""
 
     def __init__(self):
         self.thread = None
@@ -4061,6 +4931,8 @@ class SQLConnection(object):
         self.locked = 0
         self.last_seen = 0
         self.dbc = None
+        self.changeset = 0
+        self.changeset_failed = False
 
 
 class SQLEntityContainer(object):
@@ -4109,6 +4981,19 @@ class SQLEntityContainer(object):
         Note: all names are quoted using :py:meth:`quote_identifier`
         before appearing in SQL statements.
 
+    min_connections (optional)
+        The minimum number of connections to keep open.  Defaults to 0.
+        Connections are always opened on demand but the
+        :meth:`pool_cleaner` will not close idle connections if doing so
+        would reduce the number of open connections below this value.
+
+    ping_idle (optional)
+        The number of seconds a connection may be left unused before it
+        is checked with :meth:`ping_connection` when it is next
+        acquired.  Connections that fail the check are closed and
+        replaced with a new connection.  The default is None, meaning
+        that connections are never checked.
+
     max_idle (optional)
         The maximum number of seconds idle database connections should
         be kept open before they are cleaned by the
@@ -4121,6 +5006,63 @@ class SQLEntityContainer(object):
         of 3600 (1 hour) will result in a pool cleaner call every 12
         minutes.
 
+    fetch_size (optional)
+        The number of rows to fetch from the database in a single call
+        when iterating through the entities in a collection.  Defaults
+        to 100, the rows are read using the DB API cursor's fetchmany
+        method.  A value of 1 reverts to reading rows one at a time
+        using fetchone.  The value can also be changed for an individual
+        collection by setting its
+        :py:attr:`SQLCollectionBase.fetch_size` attribute.
+
+    sql_cache_size (optional)
+        The maximum number of generated SQL queries to cache.  Queries
+        are cached using a key that represents the *shape* of the query
+        (see :py:meth:`SQLCollectionBase.query_shape`) with literal
+        values passed as parameters, so repeated requests that differ
+        only in the values of constants do not need to be converted to
+        SQL again.  When the cache is full the least recently used
+        query is discarded.  Defaults to 256, a value of 0 disables
+        the cache.
+
+    count_cache_size (optional)
+        The maximum number of collection sizes to cache.  The result of
+        each COUNT query is cached using the query and its parameter
+        values as a key, avoiding repeated counts when paging through
+        a large collection with $inlinecount.  The entire cache is
+        invalidated whenever a transaction executed through this
+        container modifies the database, changes made by other
+        processes are not detected (see count_cache_max_age).  Defaults
+        to 0, which disables the cache.
+
+    count_cache_max_age (optional)
+        The maximum number of seconds for which a cached count can be
+        used.  Defaults to None, meaning that cached counts only expire
+        when they are invalidated.
+
+    streaming (optional)
+        A boolean, defaults to False.  If True, entities are read from
+        the database using a streaming cursor (see
+        :py:meth:`new_cursor`) that does not hold the entire result of
+        the query in memory.  Combined with fetch_size this keeps memory
+        use bounded when iterating through large tables.  The value can
+        also be changed for an individual collection by setting its
+        :py:attr:`SQLCollectionBase.streaming` attribute.
+
+        Some databases do not allow other queries to be executed on a
+        connection while a streaming query is in progress.  Connections
+        are shared by all collections opened by the same thread so
+        you must not use other collections while iterating through a
+        streaming collection.
+
+    estimate_counts (optional)
+        A boolean, defaults to False.  If True, the size of an
+        unfiltered entity set is estimated using
+        :py:meth:`estimate_count`, if the database supports it, rather
+        than by counting the rows in the table.  The value can also be
+        changed for an individual collection by setting its
+        :py:attr:`SQLCollectionBase.estimate_len` attribute.
+
     This class is designed to work with diamond inheritance and super.
     All derived classes must call __init__ through super and pass all
     unused keyword arguments.  For example::
@@ -4130,8 +5072,16 @@ class SQLEntityContainer(object):
                         super(MyDBContainer,self).__init__(**kwargs)
                         # do something with myDBConfig...."""
 
+    WAIT_HISTOGRAM = (0.001, 0.01, 0.1, 1.0, 10.0)
+    """The bucket boundaries, in seconds, of the wait-time histogram
+
+    See :meth:`connection_stats` for details."""
+
     def __init__(self, container, dbapi, streamstore=None, max_connections=10,
-                 field_name_joiner="_", max_idle=None, **kwargs):
+                 field_name_joiner="_", max_idle=None, fetch_size=100,
+                 sql_cache_size=256, min_connections=0, ping_idle=None,
+                 count_cache_size=0, count_cache_max_age=None,
+                 estimate_counts=False, streaming=False, **kwargs):
         if kwargs:
             logging.debug(
                 "Unabsorbed kwargs in SQLEntityContainer constructor")
@@ -4141,6 +5091,36 @@ class SQLEntityContainer(object):
         #: the optional :py:class:`~pyslet.blockstore.StreamStore`
         self.dbapi = dbapi
         #: the DB API compatible module
+        self.fetch_size = fetch_size
+        #: the default number of rows to fetch in each batch
+        self.sql_cache_size = sql_cache_size
+        #: the maximum number of queries in the SQL cache
+        self.sql_cache_lock = threading.Lock()
+        # maps key on to a [tick, value] list
+        self.sql_cache = {}
+        # (key, tick) tuples in order of use, entries for which tick no
+        # longer matches the cache are stale and are skipped
+        self.sql_cache_order = collections.deque()
+        self.sql_cache_tick = 0
+        self.sql_cache_hits = 0
+        self.sql_cache_misses = 0
+        self.count_cache_size = count_cache_size
+        #: the maximum number of counts in the count cache
+        self.count_cache_max_age = count_cache_max_age
+        #: the maximum age of a cached count in seconds
+        self.estimate_counts = estimate_counts
+        #: the default value of estimate_len for new collections
+        self.streaming = streaming
+        #: the default value of streaming for new collections
+        self.count_cache_lock = threading.Lock()
+        # maps key on to a [tick, count, time] list
+        self.count_cache = {}
+        # (key, tick) tuples in order of use, see sql_cache_order
+        self.count_cache_order = collections.deque()
+        self.count_cache_tick = 0
+        self.count_cache_generation = 0
+        self.count_cache_hits = 0
+        self.count_cache_misses = 0
         self.module_lock = None
         if self.dbapi.threadsafety == 0:
             # we can't even share the module, so just use one connection will
@@ -4153,11 +5133,26 @@ class SQLEntityContainer(object):
             self.module_lock = DummyLock()
             self.clocker = threading.RLock
             self.cpool_max = max_connections
-        self.cpool_lock = threading.Condition()
+        self.cpool_min = min(min_connections, self.cpool_max)
+        self.ping_idle = ping_idle
+        self.cpool_mutex = threading.RLock()
+        self.cpool_lock = threading.Condition(self.cpool_mutex)
         self.cpool_locked = {}
         self.cpool_unlocked = {}
         self.cpool_idle = []
         self.cpool_size = 0
+        # the queue of threads waiting for a connection, each waiting
+        # thread is represented by a Condition that shares cpool_mutex
+        self.cpool_waiters = collections.deque()
+        # pool metrics
+        self.cpool_acquired = 0
+        self.cpool_waited = 0
+        self.cpool_timeouts = 0
+        self.cpool_wait_time = 0.0
+        self.cpool_max_wait = 0.0
+        self.cpool_histogram = [0] * (len(self.WAIT_HISTOGRAM) + 1)
+        self.cpool_pings = 0
+        self.cpool_ping_failures = 0
         self.closing = threading.Event()
         # set up the parameter style
         if self.dbapi.paramstyle == "qmark":
@@ -4245,6 +5240,33 @@ class SQLEntityContainer(object):
                     source_path = (esName, aset_name, key_name)
                     self.mangled_names[source_path] = \
                         self.mangle_name(source_path)
+                """Indexes on foreign keys are given fake source paths
+                that combine the entity set name and the association set
+                name::
+
+                        ( "Orders", "Orders", "Orders_Customers", "ix" )"""
+                source_path = (esName, esName, aset_name, 'ix')
+                self.mangled_names[source_path] = self.mangle_name(source_path)
+        # and any additional indexes on properties
+        self.indexed_names = set()
+        """The set of property source paths that should be indexed.  The
+        set is populated on construction using the
+        :py:meth:`indexed_name` method.  The index names are mangled
+        from fake source paths with the entity set name repeated and
+        the suffix 'ix', e.g.::
+
+            ( "Customers", "Customers", "Address", "City", "ix" )"""
+        for es in self.container.EntitySet:
+            for source_path in self.type_name_generator(es.entityType):
+                if (len(source_path) == 1 and
+                        source_path[0] in es.keys):
+                    # the primary key is already indexed
+                    continue
+                source_path = tuple([es.name] + source_path)
+                if self.indexed_name(source_path):
+                    self.indexed_names.add(source_path)
+                    ix_path = (es.name, ) + source_path + ('ix', )
+                    self.mangled_names[ix_path] = self.mangle_name(ix_path)
         # and aux_table will have been populated with additional tables to
         # hold symmetric associations...
         for aSet in self.container.AssociationSet:
@@ -4267,7 +5289,7 @@ class SQLEntityContainer(object):
                 source_path = (aSet.name, esB.name, prefixB, key_name)
                 self.mangled_names[source_path] = self.mangle_name(source_path)
             """And mangle the foreign key constraint names..."""
-            for kc in ('fkA', 'fkB', "pk"):
+            for kc in ('fkA', 'fkB', "pk", "ixB"):
                 source_path = (aSet.name, aSet.name, kc)
                 self.mangled_names[source_path] = self.mangle_name(source_path)
         # start the pool cleaner thread if required
@@ -4356,6 +5378,40 @@ class SQLEntityContainer(object):
         default implementation using super."""
         return False
 
+    def indexed_name(self, source_path):
+        """Test if a source_path identifies a property to be indexed
+
+        Foreign keys are always indexed and the primary key is indexed
+        by the database itself but you may want to create indexes on
+        other properties that are commonly used in $filter or $orderby
+        expressions.
+
+        source_path
+            A tuple or list of strings describing the path to a data
+            property in the metadata model, including the entity set
+            name.  See :py:meth:`mangle_name` for more information.
+
+        The default implementation returns True if the property's
+        definition has the annotation :py:data:`SQL_INDEX` set to
+        "true".
+
+        You can override this method to add indexes to a model without
+        annotating the metadata document.  If you do you must ensure all
+        other names are passed to the default implementation using
+        super."""
+        try:
+            type_def = self.container[source_path[0]].entityType
+            p = None
+            for name in source_path[1:]:
+                p = type_def[name]
+                type_def = p.complexType
+        except KeyError:
+            return False
+        try:
+            return p is not None and p.get_attribute(SQL_INDEX) == "true"
+        except KeyError:
+            return False
+
     def source_path_generator(self, entity_set):
         """Utility generator for source path *tuples* for *entity_set*"""
         yield (entity_set.name,)
@@ -4533,6 +5589,9 @@ class SQLEntityContainer(object):
                     if params.params:
                         logging.warning("Ignoring params to CREATE TABLE: %s",
                                         to_text(params.params))
+                    for query in collection.create_index_queries():
+                        out.write(query)
+                        out.write(ul(";\n\n"))
         # we now need to go through the aux_table and create them
         for aset_name in self.aux_table:
             nav_class = self.get_symmetric_navigation_class()
@@ -4545,6 +5604,9 @@ class SQLEntityContainer(object):
                 if params.params:
                     logging.warning("Ignoring params to CREATE TABLE: %s",
                                     to_text(params.params))
+                for query in nav_class.create_index_queries(self, aset_name):
+                    out.write(query)
+                    out.write(ul(";\n\n"))
 
     def CreateAllTables(self):      # noqa
         warnings.warn("SQLEntityContainer.CreateAllTables is deprecated, "
@@ -4619,12 +5681,31 @@ class SQLEntityContainer(object):
                     out.write(ul(";\n\n"))
 
     def acquire_connection(self, timeout=None):
+        """Acquires a database connection from the pool
+
+        timeout
+            The maximum number of seconds to wait for a connection,
+            None (the default) means wait indefinitely and 0 means
+            don't wait at all.
+
+        Returns a :py:class:`SQLConnection` instance or None if no
+        connection could be acquired in the time allowed.  Connections
+        are locked to the calling thread, a thread that acquires a
+        connection it already holds simply increments the lock count.
+        Each call must be matched by a call to
+        :meth:`release_connection`.
+
+        Threads that have to wait for a connection are queued and
+        connections are handed out in the order in which the threads
+        arrived."""
         # block on the module for threadsafety==0 case
         thread = threading.current_thread()
         thread_id = thread.ident
         now = start = time.time()
         cpool_item = None
         close_flag = False
+        idle_since = None
+        waiter = None
         with self.cpool_lock:
             if self.closing.is_set():
                 # don't open connections when we are trying to close them
@@ -4636,6 +5717,7 @@ class SQLEntityContainer(object):
                     logging.warning(
                         "Thread[%i] timed out waiting for the the database "
                         "module lock", thread_id)
+                    self.cpool_timeouts += 1
                     return None
             # we have the module lock
             cpool_item = self.cpool_locked.get(thread_id, None)
@@ -4643,8 +5725,12 @@ class SQLEntityContainer(object):
                 # our thread_id is in the locked table
                 cpool_item.locked += 1
                 cpool_item.last_seen = now
+                return cpool_item
             while cpool_item is None:
-                if thread_id in self.cpool_unlocked:
+                if self.cpool_waiters and self.cpool_waiters[0] is not waiter:
+                    # other threads are queued ahead of us
+                    pass
+                elif thread_id in self.cpool_unlocked:
                     # take the connection that last belonged to us
                     cpool_item = self.cpool_unlocked[thread_id]
                     del self.cpool_unlocked[thread_id]
@@ -4673,30 +5759,60 @@ class SQLEntityContainer(object):
                         # is it ok to close a connection from a different
                         # thread?  Yes: we require it!
                         close_flag = True
-                else:
+                if cpool_item is None:
                     now = time.time()
-                    if timeout is not None and now > start + timeout:
+                    if self.closing.is_set():
+                        break
+                    if timeout is not None and now >= start + timeout:
                         logging.warning(
                             "Thread[%i] timed out waiting for a database "
                             "connection", thread_id)
+                        self.cpool_timeouts += 1
                         break
+                    if waiter is None:
+                        waiter = threading.Condition(self.cpool_mutex)
+                        self.cpool_waiters.append(waiter)
                     logging.debug(
                         "Thread[%i] forced to wait for a database connection",
                         thread_id)
-                    self.cpool_lock.wait(timeout)
+                    waiter.wait(None if timeout is None else
+                                start + timeout - now)
                     logging.debug(
                         "Thread[%i] resuming search for database connection",
                         thread_id)
                     continue
+                idle_since = cpool_item.last_seen
                 cpool_item.locked += 1
                 cpool_item.thread = thread
                 cpool_item.thread_id = thread_id
-                cpool_item.last_seen = time.time()
+                cpool_item.last_seen = now = time.time()
                 self.cpool_locked[thread_id] = cpool_item
+                self._record_wait(now - start, waiter is not None)
+            if waiter is not None:
+                self.cpool_waiters.remove(waiter)
+                # pass the baton to the next thread in the queue
+                self._notify_waiter()
         if cpool_item:
             if close_flag:
                 self.close_connection(cpool_item.dbc)
                 cpool_item.dbc = None
+            elif (cpool_item.dbc is not None and self.ping_idle is not None and
+                    now - idle_since > self.ping_idle):
+                alive = self.ping_connection(cpool_item.dbc)
+                with self.cpool_lock:
+                    self.cpool_pings += 1
+                    if not alive:
+                        self.cpool_ping_failures += 1
+                if not alive:
+                    logging.warning(
+                        "Thread[%i] replacing database connection that "
+                        "failed liveness check", thread_id)
+                    try:
+                        self.close_connection(cpool_item.dbc)
+                    except Exception as err:
+                        logging.warning("Error closing dead connection: %s",
+                                        str(err))
+                    cpool_item.dbc = None
             if cpool_item.dbc is None:
                 cpool_item.dbc = self.open()
             return cpool_item
@@ -4705,6 +5821,117 @@ class SQLEntityContainer(object):
         self.module_lock.release()
         return None
 
+    def begin_changeset(self, timeout=None):
+        """Starts a change set on the calling thread's connection
+
+        timeout
+            As for :meth:`acquire_connection`
+
+        All transactions executed by the calling thread between this
+        call and the matching call to :meth:`end_changeset` are
+        grouped into a single database transaction: their commits are
+        deferred until the change set ends and a rollback (of any of
+        them) causes the whole change set to fail.  This is used to
+        implement the atomic change sets of OData batch requests.
+
+        Returns the :py:class:`SQLConnection` that must be passed to
+        :meth:`end_changeset` or None if no connection could be
+        acquired.  Change sets may be nested, only the outermost one
+        has any effect."""
+        connection = self.acquire_connection(timeout)
+        if connection is None:
+            return None
+        if not connection.changeset:
+            connection.changeset_failed = False
+        connection.changeset += 1
+        return connection
+
+    def end_changeset(self, connection, commit=True):
+        """Ends a change set started with :meth:`begin_changeset`
+
+        connection
+            The connection returned by :meth:`begin_changeset`
+
+        commit
+            True if the change set should be committed, False if it
+            should be rolled back
+
+        Returns True if the change set was committed, False otherwise.
+        A change set in which any transaction was rolled back is never
+        committed, regardless of the value of *commit*."""
+        try:
+            connection.changeset -= 1
+            if connection.changeset:
+                return commit and not connection.changeset_failed
+            commit = commit and not connection.changeset_failed
+            connection.changeset_failed = False
+            if commit:
+                try:
+                    connection.dbc.commit()
+                except self.dbapi.Error as err:
+                    logging.error("Change set commit failed: %s", str(err))
+                    commit = False
+            if not commit:
+                try:
+                    connection.dbc.rollback()
+                except self.dbapi.NotSupportedError:
+                    logging.error(
+                        "Data Integrity Error: rollback of change set "
+                        "invoked on a connection that does not support "
+                        "transactions")
+            self.invalidate_counts()
+            return commit
+        finally:
+            self.release_connection(connection)
+
+    def _notify_waiter(self):
+        # wakes the thread at the head of the wait queue, must be
+        # called with cpool_lock held
+        if self.cpool_waiters:
+            self.cpool_waiters[0].notify()
+
+    def _record_wait(self, wait, waited):
+        # records the time taken to acquire a connection, must be
+        # called with cpool_lock held
+        self.cpool_acquired += 1
+        if waited:
+            self.cpool_waited += 1
+        self.cpool_wait_time += wait
+        if wait > self.cpool_max_wait:
+            self.cpool_max_wait = wait
+        i = 0
+        for bound in self.WAIT_HISTOGRAM:
+            if wait < bound:
+                break
+            i += 1
+        self.cpool_histogram[i] += 1
+
+    def ping_connection(self, connection):
+        """Tests if a database connection is still alive
+
+        connection
+            A connection object returned by :meth:`open`
+
+        Returns True if the connection is usable, False otherwise.  The
+        default implementation executes the query "SELECT 1" using a
+        new cursor and then rolls back the connection to ensure that it
+        is not left in a transaction.  Database specific
+        implementations may override this method with a more efficient
+        check."""
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            connection.rollback()
+            return True
+        except Exception as err:
+            logging.warning("Database connection liveness check failed: %s",
+                            str(err))
+            return False
+
     def release_connection(self, release_item):
         thread_id = threading.current_thread().ident
         close_flag = False
@@ -4720,6 +5947,7 @@ class SQLEntityContainer(object):
                         del self.cpool_locked[thread_id]
                         self.cpool_unlocked[thread_id] = cpool_item
                         self.cpool_lock.notify()
+                        self._notify_waiter()
                     return
             # it seems likely that some other thread is going to leave a
             # locked connection now, let's try and find it to correct
@@ -4738,6 +5966,7 @@ class SQLEntityContainer(object):
                     del self.cpool_locked[bad_thread]
                     self.cpool_unlocked[bad_item.thread_id] = bad_item
                     self.cpool_lock.notify()
+                    self._notify_waiter()
                     logging.error(
                         "Thread[%i] released database connection originally "
                         "acquired by Thread[%i]", thread_id, bad_thread)
@@ -4766,7 +5995,7 @@ class SQLEntityContainer(object):
         if close_flag:
             self.close_connection(release_item.dbc)
 
-    def connection_stats(self):
+    def connection_stats(self, detail=False):
         """Return information about the connection pool
 
         Returns a triple of:
@@ -4782,11 +6011,264 @@ class SQLEntityContainer(object):
 
         Connections are placed in the 'dead pool' when unexpected lock
         failures occur or if they are locked and the owning thread is
-        detected to have terminated without releasing them."""
+        detected to have terminated without releasing them.
+
+        If *detail* is True a dictionary is returned instead containing
+        the above values with the keys 'locked', 'unlocked' and 'idle'
+        and the following additional pool metrics:
+
+        size, min, max
+            the number of open (or opening) connections and the limits
+            on the size of the pool
+
+        waiting
+            the number of threads currently queued for a connection
+
+        acquired
+            the number of connections acquired, not including nested
+            acquisitions by the thread that already holds the connection
+
+        waited
+            the number of acquisitions that had to be queued
+
+        timeouts
+            the number of acquisitions that timed out
+
+        wait_time, max_wait
+            the total and maximum time (in seconds) taken to acquire a
+            connection
+
+        histogram
+            a list of (bound, count) tuples counting acquisitions by the
+            time taken, each bound is the upper limit of the bucket in
+            seconds (see :attr:`WAIT_HISTOGRAM`), the last bucket has a
+            bound of None.
+
+        pings, ping_failures
+            the number of liveness checks made and the number that
+            failed"""
         with self.cpool_lock:
             # we have exclusive use of the cpool members
-            return (len(self.cpool_locked), len(self.cpool_unlocked),
-                    len(self.cpool_idle))
+            if not detail:
+                return (len(self.cpool_locked), len(self.cpool_unlocked),
+                        len(self.cpool_idle))
+            return {
+                'locked': len(self.cpool_locked),
+                'unlocked': len(self.cpool_unlocked),
+                'idle': len(self.cpool_idle),
+                'size': self.cpool_size,
+                'min': self.cpool_min,
+                'max': self.cpool_max,
+                'waiting': len(self.cpool_waiters),
+                'acquired': self.cpool_acquired,
+                'waited': self.cpool_waited,
+                'timeouts': self.cpool_timeouts,
+                'wait_time': self.cpool_wait_time,
+                'max_wait': self.cpool_max_wait,
+                'histogram': list(zip(list(self.WAIT_HISTOGRAM) + [None],
+                                      self.cpool_histogram)),
+                'pings': self.cpool_pings,
+                'ping_failures': self.cpool_ping_failures}
+
+    def get_cached_sql(self, key):
+        """Returns a previously cached query or None
+
+        key
+            A query key as returned by
+            :py:meth:`SQLCollectionBase.query_shape`
+
+        The result is the value passed to :py:meth:`set_cached_sql`."""
+        if not self.sql_cache_size:
+            return None
+        with self.sql_cache_lock:
+            entry = self.sql_cache.get(key, None)
+            if entry is None:
+                self.sql_cache_misses += 1
+                return None
+            self.sql_cache_hits += 1
+            self._use_cached_sql(key, entry)
+            return entry[1]
+
+    def _use_cached_sql(self, key, entry):
+        # called with the sql cache lock held
+        self.sql_cache_tick += 1
+        entry[0] = self.sql_cache_tick
+        self.sql_cache_order.append((key, self.sql_cache_tick))
+        if len(self.sql_cache_order) > 2 * len(self.sql_cache) + 64:
+            # too many stale entries, rebuild the order
+            self.sql_cache_order = collections.deque(
+                sorted(((k, e[0]) for k, e in dict_items(self.sql_cache)),
+                       key=lambda x: x[1]))
+
+    def set_cached_sql(self, key, value):
+        """Adds a query to the SQL cache
+
+        key
+            A query key as returned by
+            :py:meth:`SQLCollectionBase.query_shape`
+
+        value
+            The value to cache
+
+        If the cache is full the least recently used query is
+        discarded."""
+        if not self.sql_cache_size:
+            return
+        with self.sql_cache_lock:
+            while (key not in self.sql_cache and
+                    len(self.sql_cache) >= self.sql_cache_size):
+                lru_key, tick = self.sql_cache_order.popleft()
+                entry = self.sql_cache.get(lru_key, None)
+                if entry is not None and entry[0] == tick:
+                    # the least recently used query
+                    del self.sql_cache[lru_key]
+            entry = [0, value]
+            self.sql_cache[key] = entry
+            self._use_cached_sql(key, entry)
+
+    def sql_cache_stats(self):
+        """Return information about the SQL cache
+
+        The return result is a tuple of three integers, indicating the
+        number of queries in the cache, the number of cache hits and
+        the number of cache misses."""
+        with self.sql_cache_lock:
+            return (len(self.sql_cache), self.sql_cache_hits,
+                    self.sql_cache_misses)
+
+    def _count_key(self, query, params):
+        values = params.params
+        if values is None:
+            values = ()
+        elif isinstance(values, dict):
+            values = tuple(sorted(dict_items(values)))
+        else:
+            values = tuple(values)
+        key = (query, values)
+        try:
+            hash(key)
+        except TypeError:
+            # e.g., binary parameters, don't cache
+            return None
+        return key
+
+    def get_cached_count(self, query, params):
+        """Returns a previously cached count
+
+        query
+            The COUNT query string
+
+        params
+            The :py:class:`SQLParams` object for the query
+
+        Returns a tuple of (count, generation).  count is None if there
+        is no (unexpired) count in the cache.  generation must be passed
+        to :py:meth:`set_cached_count` when the count has been
+        calculated."""
+        if not self.count_cache_size:
+            return None, None
+        key = self._count_key(query, params)
+        if key is None:
+            return None, None
+        with self.count_cache_lock:
+            generation = self.count_cache_generation
+            entry = self.count_cache.get(key, None)
+            if entry is not None:
+                if (self.count_cache_max_age is None or
+                        time.time() - entry[2] <= self.count_cache_max_age):
+                    self.count_cache_hits += 1
+                    self._use_cached_count(key, entry)
+                    return entry[1], generation
+                del self.count_cache[key]
+            self.count_cache_misses += 1
+            return None, generation
+
+    def _use_cached_count(self, key, entry):
+        # called with the count cache lock held
+        self.count_cache_tick += 1
+        entry[0] = self.count_cache_tick
+        self.count_cache_order.append((key, self.count_cache_tick))
+        if len(self.count_cache_order) > 2 * len(self.count_cache) + 64:
+            # too many stale entries, rebuild the order
+            self.count_cache_order = collections.deque(
+                sorted(((k, e[0]) for k, e in dict_items(self.count_cache)),
+                       key=lambda x: x[1]))
+
+    def set_cached_count(self, query, params, count, generation):
+        """Adds a count to the count cache
+
+        query, params
+            As passed to :py:meth:`get_cached_count`
+
+        count
+            The integer count
+
+        generation
+            The generation returned by :py:meth:`get_cached_count`
+            *before* the count was calculated.  If the cache has been
+            invalidated since then the count is discarded as it may have
+            been calculated from out of date data.
+
+        If the cache is full the least recently used count is
+        discarded."""
+        if not self.count_cache_size:
+            return
+        key = self._count_key(query, params)
+        if key is None:
+            return
+        with self.count_cache_lock:
+            if generation != self.count_cache_generation:
+                return
+            while (key not in self.count_cache and
+                    len(self.count_cache) >= self.count_cache_size):
+                old_key, tick = self.count_cache_order.popleft()
+                entry = self.count_cache.get(old_key, None)
+                if entry is not None and entry[0] == tick:
+                    # the least recently used count
+                    del self.count_cache[old_key]
+            entry = [0, count, time.time()]
+            self.count_cache[key] = entry
+            self._use_cached_count(key, entry)
+
+    def invalidate_counts(self):
+        """Discards all counts in the count cache
+
+        Called automatically when a transaction that modifies the
+        database is committed or rolled back.  You should call this
+        method yourself if you modify the database through some other
+        means."""
+        with self.count_cache_lock:
+            self.count_cache = {}
+            self.count_cache_order.clear()
+            self.count_cache_generation += 1
+
+    def count_cache_stats(self):
+        """Return information about the count cache
+
+        The return result is a tuple of three integers, indicating the
+        number of counts in the cache, the number of cache hits and the
+        number of cache misses."""
+        with self.count_cache_lock:
+            return (len(self.count_cache), self.count_cache_hits,
+                    self.count_cache_misses)
+
+    def estimate_count(self, transaction, table_name):
+        """Returns an estimate of the number of rows in a table
+
+        transaction
+            An :py:class:`SQLTransaction` that has been begun, use it to
+            execute any queries required.
+
+        table_name
+            The quoted table name, as returned by :py:meth:`mangle_name`
+
+        The default implementation returns None, indicating that no
+        estimate is available.  Database specific implementations
+        should override this method to read the estimate from the
+        database's statistics.  If the statistics are missing they
+        should return None (or raise a DB API Error), in which case
+        the rows are counted."""
+        return None
 
     def _run_pool_cleaner(self, max_idle=SQL_TIMEOUT * 10.0):
         run_time = max_idle / 5.0
@@ -4809,15 +6291,16 @@ class SQLEntityContainer(object):
         with self.cpool_lock:
             locked_list = list(dict_values(self.cpool_locked))
             for cpool_item in locked_list:
-                if not cpool_item.thread.isAlive():
+                if not cpool_item.thread.is_alive():
                     logging.error(
                         "Thread[%i] failed to release database connection "
                         "before terminating", cpool_item.thread_id)
                     del self.cpool_locked[cpool_item.thread_id]
+                    self.cpool_size -= 1
                     to_close.append(cpool_item.dbc)
             unlocked_list = list(dict_values(self.cpool_unlocked))
             for cpool_item in unlocked_list:
-                if not cpool_item.thread.isAlive():
+                if not cpool_item.thread.is_alive():
                     logging.debug(
                         "pool_cleaner moving database connection to idle "
                         "after Thread[%i] terminated",
@@ -4827,7 +6310,8 @@ class SQLEntityContainer(object):
                     cpool_item.thread = None
                     self.cpool_idle.append(cpool_item)
                 elif (cpool_item.last_seen <= old_time and
-                        self.dbapi.threadsafety <= 1):
+                        self.dbapi.threadsafety <= 1 and
+                        self.cpool_size > self.cpool_min):
                     logging.debug(
                         "pool_cleaner removing database connection "
                         "after Thread[%i] timed out",
@@ -4839,11 +6323,14 @@ class SQLEntityContainer(object):
             while i:
                 i = i - 1
                 cpool_item = self.cpool_idle[i]
-                if cpool_item.last_seen <= old_time:
+                if (cpool_item.last_seen <= old_time and
+                        self.cpool_size > self.cpool_min):
                     logging.info("pool_cleaner removed idle connection")
                     to_close.append(cpool_item.dbc)
                     del self.cpool_idle[i]
                     self.cpool_size -= 1
+            # connections may have been freed up
+            self._notify_waiter()
         for dbc in to_close:
             if dbc is not None:
                 self.close_connection(dbc)
@@ -4856,6 +6343,24 @@ class SQLEntityContainer(object):
         connecting."""
         raise NotImplementedError
 
+    def new_cursor(self, connection, streaming=False):
+        """Creates and returns a new cursor
+
+        connection
+            A connection object returned by :meth:`open`
+
+        streaming
+            A boolean, if True then a streaming cursor is requested, that
+            is, a cursor that retrieves rows from the database as they
+            are fetched rather than reading the entire result set into
+            memory when the query is executed.
+
+        The default implementation calls the connection's cursor method,
+        ignoring *streaming*.  Database specific implementations should
+        override this method if a special type of cursor is required for
+        streaming."""
+        return connection.cursor()
+
     def close_connection(self, connection):
         """Calls the underlying close method."""
         connection.close()
@@ -4904,6 +6409,9 @@ class SQLEntityContainer(object):
         to_close = []
         self.closing.set()
         with self.cpool_lock:
+            # wake any threads waiting for connections
+            for waiter in self.cpool_waiters:
+                waiter.notify()
             nlocked = None
             while True:
                 while self.cpool_idle:
@@ -4923,7 +6431,7 @@ class SQLEntityContainer(object):
                             "before closing container", cpool_item.thread_id)
                         del self.cpool_locked[cpool_item.thread_id]
                         to_close.append(cpool_item.dbc)
-                    elif not cpool_item.thread.isAlive():
+                    elif not cpool_item.thread.is_alive():
                         logging.error(
                             "Thread[%i] failed to release database connection "
                             "before terminating", cpool_item.thread_id)
@@ -5280,8 +6788,10 @@ class SQLEntityContainer(object):
             SELECT TOP 10 FROM ....
 
         More modern syntax tends to use a special limit clause at the
-        end of the query, rather than a SELECT modifier.  The default
-        implementation returns::
+        end of the query, rather than a SELECT modifier.  If you
+        override this method to return a modifier you must not also
+        override :meth:`limit_clause` to return a clause as both are
+        added to the query.  The default implementation returns::
 
             (skip, '')
 
@@ -5318,14 +6828,29 @@ class SQLEntityContainer(object):
 
             SELECT * FROM Customers LIMIT 10 OFFSET 20
 
-        More modern syntax tends to use a special limit clause at the
-        end of the query, rather than a SELECT modifier.  Such as::
+        The skip is always pushed into the query where possible,
+        returning the unused skip causes the rows to be read and
+        discarded by the collection which makes deep paging expensive.
 
-            (skip, 'FETCH FIRST %i ROWS ONLY ' % top)
+        Databases that support the OFFSET and FETCH syntax from the SQL
+        2008 standard can return::
 
-        This syntax is part of SQL 2008 standard but is not widely
-        adopted and, for compatibility with existing external database
-        implementation, the default implementation remains blank."""
+            (0, 'OFFSET %i ROWS FETCH NEXT %i ROWS ONLY ' % (skip, top))
+
+        resulting in queries such as::
+
+            SELECT * FROM Customers ORDER BY CustomerID ASC
+                OFFSET 20 ROWS FETCH NEXT 10 ROWS ONLY
+
+        Paged queries are always ordered, as required by some
+        implementations of this syntax.
+
+        This syntax is not widely adopted and, for compatibility with
+        existing external database implementations (which may use
+        :meth:`select_limit_clause` instead), the default implementation
+        remains blank, returning::
+
+            (skip, '')"""
         return (skip, '')
 
 
@@ -5352,11 +6877,77 @@ class SQLiteEntityContainer(SQLEntityContainer):
 
     ..  _sqlite3:   https://docs.python.org/2/library/sqlite3.html
 
+    journal_mode
+        The journal mode to set on each connection, for example, 'WAL'
+        to use write-ahead logging.  With WAL, readers do not block the
+        (single) writer and the writer does not block readers,
+        significantly reducing contention when the database is shared by
+        multiple threads.  Defaults to None, the database's existing
+        journal mode is used (normally 'DELETE').  WAL mode is
+        persistent and is not supported for databases on network file
+        systems.
+
+    synchronous
+        The synchronous flag to set on each connection, one of 'OFF',
+        'NORMAL', 'FULL' or 'EXTRA'.  'NORMAL' is safe, and much faster
+        than the default 'FULL', when used in WAL mode.
+
+    cache_size
+        The suggested size of the page cache for each connection as an
+        integer.  Positive values are numbers of pages, negative values
+        are multiples of 1024 bytes.
+
+    mmap_size
+        The maximum number of bytes of the database file to access
+        using memory-mapped I/O.
+
+    busy_timeout
+        The number of milliseconds a connection waits for a lock held
+        by another connection before failing with a busy error.
+
+    The above options default to None, meaning the SQLite defaults are
+    used.  They are applied using PRAGMA statements each time a new
+    connection is opened, see :py:meth:`open`.  For more information
+    see pragma_
+
+    ..  _pragma:   https://www.sqlite.org/pragma.html
+
     All other keyword arguments required to initialise the base class
     must be passed on construction except *dbapi* which is automatically
-    set to the Python sqlite3 module."""
-
-    def __init__(self, file_path, sqlite_options={}, **kwargs):
+    set to the Python sqlite3 module.
+
+    The sqlite3 module steps through the results of a query as rows are
+    fetched so the default cursor is already suitable for use with the
+    *streaming* option."""
+
+    JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+
+    SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    def __init__(self, file_path, sqlite_options={}, journal_mode=None,
+                 synchronous=None, cache_size=None, mmap_size=None,
+                 busy_timeout=None, **kwargs):
+        #: the list of PRAGMA statements executed on new connections
+        self.sqlite_pragmas = ["PRAGMA foreign_keys = ON"]
+        if journal_mode is not None:
+            journal_mode = journal_mode.upper()
+            if journal_mode not in self.JOURNAL_MODES:
+                raise ValueError("journal_mode: %s" % journal_mode)
+            self.sqlite_pragmas.append(
+                "PRAGMA journal_mode = %s" % journal_mode)
+        self.journal_mode = journal_mode
+        if synchronous is not None:
+            synchronous = synchronous.upper()
+            if synchronous not in self.SYNCHRONOUS:
+                raise ValueError("synchronous: %s" % synchronous)
+            self.sqlite_pragmas.append(
+                "PRAGMA synchronous = %s" % synchronous)
+        for name, value in (('cache_size', cache_size),
+                            ('mmap_size', mmap_size),
+                            ('busy_timeout', busy_timeout)):
+            if value is not None:
+                self.sqlite_pragmas.append(
+                    "PRAGMA %s = %i" % (name, int(value)))
         if is_text(file_path) and file_path == ":memory:":
             if (('max_connections' in kwargs and
                     kwargs['max_connections'] != 1) or
@@ -5399,13 +6990,23 @@ class SQLiteEntityContainer(SQLEntityContainer):
 
         Other connection arguments are not currently supported, you can
         derive a more complex implementation by overriding this method
-        and (optionally) the __init__ method to pass in values for ."""
+        and (optionally) the __init__ method to pass in values for .
+
+        The statements in :py:attr:`sqlite_pragmas` are executed on each
+        new connection before it is returned."""
         if self.sqlite_memdbc is not None:
             return self.sqlite_memdbc
         dbc = self.dbapi.connect(str(self.file_path), check_same_thread=False,
                                  **self.sqlite_options)
         c = dbc.cursor()
-        c.execute("PRAGMA foreign_keys = ON")
+        for pragma in self.sqlite_pragmas:
+            c.execute(pragma)
+            result = c.fetchall()
+            if (self.journal_mode is not None and
+                    pragma.startswith("PRAGMA journal_mode") and
+                    result[0][0].upper() != self.journal_mode):
+                logging.warning("SQLite journal_mode %s not supported, "
+                                "using %s", self.journal_mode, result[0][0])
         c.close()
         return dbc
 
@@ -5548,14 +7149,50 @@ class SQLiteEntityContainer(SQLEntityContainer):
                 value)
 
     def limit_clause(self, skip, top):
+        """Overridden to use SQLite's LIMIT and OFFSET syntax
+
+        SQLite does not allow OFFSET without LIMIT so a negative limit
+        (which means no limit in SQLite) is used when top is None."""
         clause = []
         if top:
             clause.append('LIMIT %i ' % top)
+        elif skip:
+            clause.append('LIMIT -1 ')
         if skip:
             clause.append('OFFSET %i ' % skip)
             skip = 0
         return skip, ''.join(clause)
 
+    def estimate_count(self, transaction, table_name):
+        """Overridden to use the sqlite_stat1 table
+
+        The statistics are only available after the ANALYZE command has
+        been run on the database.  The first integer in the stat column
+        is the approximate number of rows in the table."""
+        if table_name.startswith('"') and table_name.endswith('"'):
+            table_name = table_name[1:-1]
+        # if the database has never been analyzed there is no
+        # sqlite_stat1 table, don't trigger an error
+        transaction.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND "
+            "name='sqlite_stat1'")
+        if not transaction.cursor.fetchall():
+            return None
+        params = self.ParamsClass()
+        query = "SELECT stat FROM sqlite_stat1 WHERE tbl=%s" % \
+            params.add_param(table_name)
+        logging.info("%s; %s", query, to_text(params.params))
+        transaction.execute(query, params)
+        result = None
+        for row in transaction.cursor.fetchall():
+            try:
+                count = int(row[0].split()[0])
+            except (AttributeError, IndexError, ValueError):
+                continue
+            if result is None or count > result:
+                result = count
+        return result
+
 
 class SQLiteEntityCollectionBase(SQLCollectionBase):
 
@@ -5656,6 +7293,14 @@ class SQLiteEntityCollection(SQLiteEntityCollectionBase, SQLEntityCollection):
         """In SQLite all tables have a ROWID concept"""
         return ' WHERE ROWID = last_insert_rowid()'
 
+    def where_last_batch(self, entities, params):
+        """Uses the range of ROWIDs ending with last_insert_rowid()
+
+        Within a single transaction SQLite allocates consecutive ROWIDs
+        to the rows inserted by executemany."""
+        return ' WHERE ROWID > last_insert_rowid() - %i ORDER BY ROWID' % \
+            len(entities)
+
 
 class SQLiteAssociationCollection(
         SQLiteEntityCollectionBase,
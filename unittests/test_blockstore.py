@@ -3,6 +3,7 @@
 import hashlib
 import io
 import logging
+import mmap
 import os.path
 import random
 import threading
@@ -11,6 +12,7 @@ import unittest
 
 from pyslet import blockstore
 from pyslet.py2 import (
+    dict_items,
     range3,
     ul)
 from pyslet.http import params
@@ -28,8 +30,11 @@ def suite():
     return unittest.TestSuite((
         loader.loadTestsFromTestCase(CoreTests),
         loader.loadTestsFromTestCase(FileTests),
+        loader.loadTestsFromTestCase(PackTests),
         loader.loadTestsFromTestCase(ODataTests),
+        loader.loadTestsFromTestCase(CachingTests),
         loader.loadTestsFromTestCase(LockingTests),
+        loader.loadTestsFromTestCase(MemoryLockingTests),
         loader.loadTestsFromTestCase(StreamStoreTests),
         loader.loadTestsFromTestCase(RandomStreamTests),
     ))
@@ -76,6 +81,28 @@ class CoreTests(unittest.TestCase):
         except NotImplementedError:
             pass
 
+    def test_codec(self):
+        bs = blockstore.BlockStore()
+        self.assertTrue(bs.codec is None)
+        self.assertTrue('zlib' in blockstore.CODECS)
+        text = b"The quick brown fox jumped over the lazy dog " * 10
+        self.assertTrue(bs.encode(text) == (None, text))
+        try:
+            blockstore.BlockStore(codec='unknown')
+            self.fail("Unknown codec")
+        except ValueError:
+            pass
+        for codec in blockstore.CODECS:
+            bs = blockstore.BlockStore(codec=codec)
+            ecodec, edata = bs.encode(text)
+            self.assertTrue(ecodec == codec)
+            self.assertTrue(len(edata) < len(text))
+            self.assertTrue(bs.decode(ecodec, edata) == text)
+            # incompressible data is not compressed
+            noise = os.urandom(256)
+            self.assertTrue(bs.encode(noise) == (None, noise))
+            self.assertTrue(bs.decode(None, noise) == noise)
+
 
 class BlockStoreCommon(unittest.TestCase):
 
@@ -116,6 +143,35 @@ class BlockStoreCommon(unittest.TestCase):
         self.assertTrue(len(kfox) == 32)
         self.assertTrue(kfox == hashlib.md5(fox).hexdigest().lower())
 
+    def compressed(self, bs):
+        text = b"The quick brown fox jumped over the lazy dog " * 10
+        noise = os.urandom(256)
+        ktext = bs.store(text)
+        knoise = bs.store(noise)
+        # keys are always based on the uncompressed data
+        self.assertTrue(ktext == hashlib.sha256(text).hexdigest().lower())
+        self.assertTrue(knoise == hashlib.sha256(noise).hexdigest().lower())
+        self.assertTrue(bs.store(text) == ktext)
+        self.assertTrue(bs.retrieve(ktext) == text)
+        self.assertTrue(bs.retrieve(knoise) == noise)
+        return ktext, knoise
+
+    def modified(self, bs, backdate):
+        # backdate is a function that sets a block's modified time
+        # back by one day
+        fox = b"The quick brown fox jumped over the lazy dog"
+        self.assertTrue(bs.modified(bs.key(fox)) is None)
+        tstart = time.time()
+        kfox = bs.store(fox)
+        self.assertTrue(bs.modified(kfox) >= tstart - 1)
+        backdate(kfox)
+        self.assertTrue(bs.modified(kfox) < tstart - 3600)
+        # storing the block again touches it
+        self.assertTrue(bs.store(fox) == kfox)
+        self.assertTrue(bs.modified(kfox) >= tstart - 1)
+        bs.delete(kfox)
+        self.assertTrue(bs.modified(kfox) is None)
+
     def cafeclosed(self, bs):
         fox = b"The quick brown fox jumped over the lazy dog"
         kfox = bs.store(fox)
@@ -156,6 +212,16 @@ class FileTests(BlockStoreCommon):
         bs = blockstore.FileBlockStore(max_block_size=256)
         self.maxsize(bs)
 
+    def test_modified(self):
+        bs = blockstore.FileBlockStore(dpath=self.d)
+
+        def backdate(key):
+            t = time.time() - 86400
+            path = self.d.join(key[0:2], key[2:4], key[4:])
+            os.utime(path.path, (t, t))
+
+        self.modified(bs, backdate)
+
     def test_dpath(self):
         bs = blockstore.FileBlockStore(dpath=self.d)
         fox = b"The quick brown fox jumped over the lazy dog"
@@ -181,6 +247,174 @@ class FileTests(BlockStoreCommon):
         bs = blockstore.FileBlockStore(dpath=self.d)
         self.cafeclosed(bs)
 
+    def test_codec(self):
+        bs = blockstore.FileBlockStore(dpath=self.d, codec='zlib')
+        ktext, knoise = self.compressed(bs)
+        parent = self.d.join(ktext[0:2], ktext[2:4])
+        self.assertTrue(parent.join(ktext[4:] + '.zlib').isfile())
+        self.assertFalse(parent.join(ktext[4:]).exists())
+        parent = self.d.join(knoise[0:2], knoise[2:4])
+        self.assertTrue(parent.join(knoise[4:]).isfile())
+        # a store without a codec can read compressed blocks
+        bs = blockstore.FileBlockStore(dpath=self.d)
+        self.compressed(bs)
+        self.assertTrue(bytes(bs.retrieve_buffer(ktext)) ==
+                        b"The quick brown fox jumped over the lazy dog " * 10)
+        bs.delete(ktext)
+        self.assertFalse(
+            self.d.join(ktext[0:2], ktext[2:4], ktext[4:] + '.zlib').exists())
+
+    def test_iter_blocks(self):
+        bs = blockstore.FileBlockStore(dpath=self.d, codec='zlib')
+        text = b"The quick brown fox jumped over the lazy dog " * 10
+        ktext = bs.store(text)
+        kfox = bs.store(b"fox")
+        parent = self.d.join(ktext[0:2], ktext[2:4])
+        zsize = parent.join(ktext[4:] + '.zlib').stat().st_size
+        # simulate a race in which the block is also stored raw
+        with parent.join(ktext[4:]).open('wb') as f:
+            f.write(text)
+        blocks = sorted(bs.iter_blocks())
+        self.assertTrue(blocks == sorted([(ktext, zsize + len(text)),
+                                          (kfox, 3)]), blocks)
+        bs.delete(ktext)
+        self.assertTrue(list(bs.iter_blocks()) == [(kfox, 3)])
+
+    def test_retrieve_buffer(self):
+        bs = blockstore.FileBlockStore(dpath=self.d)
+        fox = b"The quick brown fox jumped over the lazy dog"
+        kfox = bs.store(fox)
+        data = bs.retrieve_buffer(kfox)
+        self.assertTrue(len(data) == len(fox))
+        self.assertTrue(bytes(data[4:9]) == b"quick")
+        self.assertTrue(bytes(data) == fox)
+        if hasattr(data, 'release') and isinstance(data.obj, mmap.mmap):
+            m = data.obj
+            data.release()
+            # the mapping is not held open by anything else
+            m.close()
+            self.assertTrue(m.closed)
+        kempty = bs.store(b"")
+        self.assertTrue(len(bs.retrieve_buffer(kempty)) == 0)
+        try:
+            bs.retrieve_buffer(bs.key(b"x"))
+            self.fail("Read back non-existent block")
+        except blockstore.BlockMissing:
+            pass
+
+
+class PackTests(BlockStoreCommon):
+
+    def setUp(self):  # noqa
+        self.d = FilePath.mkdtemp('.d', 'pyslet-test_blockstore-')
+
+    def tearDown(self):  # noqa
+        self.d.rmtree(True)
+
+    def test_init(self):
+        bs = blockstore.PackBlockStore(dpath=self.d)
+        self.assertTrue(
+            bs.max_block_size == blockstore.MAX_BLOCK_SIZE,
+            "default block size")
+        self.assertTrue(bs.max_pack_size == 1 << 30)
+        bs.close()
+
+    def test_store(self):
+        bs = blockstore.PackBlockStore(dpath=self.d)
+        self.fox_cafe(bs)
+        bs.close()
+
+    def test_maxsize(self):
+        bs = blockstore.PackBlockStore(dpath=self.d, max_block_size=256)
+        self.maxsize(bs)
+        bs.close()
+
+    def test_modified(self):
+        bs = blockstore.PackBlockStore(dpath=self.d)
+
+        def backdate(key):
+            bs.stored[key] = time.time() - 86400
+
+        self.modified(bs, backdate)
+        kfox = bs.store(b"fox")
+        bs.close()
+        # times are only known for blocks stored by this instance
+        bs = blockstore.PackBlockStore(dpath=self.d)
+        self.assertTrue(bs.modified(kfox) is None)
+        bs.close()
+
+    def test_delete(self):
+        bs = blockstore.PackBlockStore(dpath=self.d)
+        self.cafeclosed(bs)
+        bs.close()
+
+    def test_codec(self):
+        bs = blockstore.PackBlockStore(dpath=self.d, codec='zlib')
+        ktext, knoise = self.compressed(bs)
+        self.assertTrue(bs.index[ktext][3] == 'zlib')
+        self.assertTrue(bs.index[knoise][3] is None)
+        bs.delete(knoise)
+        self.assertTrue(bs.compact(0) == 256)
+        bs.close()
+        bs = blockstore.PackBlockStore(dpath=self.d)
+        self.assertTrue(bs.index[ktext][3] == 'zlib')
+        self.assertTrue(bs.retrieve(ktext) ==
+                        b"The quick brown fox jumped over the lazy dog " * 10)
+        bs.close()
+
+    def test_packs(self):
+        bs = blockstore.PackBlockStore(dpath=self.d, max_block_size=64,
+                                       max_pack_size=256)
+        blocks = {}
+        for i in range3(20):
+            data = (b"%02i" % i) * 20
+            blocks[bs.store(data)] = data
+        # 40 byte blocks, 6 to a pack
+        self.assertTrue(self.d.join('pack-000003.dat').isfile())
+        self.assertFalse(self.d.join('pack-000004.dat').exists())
+        for key, data in dict_items(blocks):
+            self.assertTrue(bs.retrieve(key) == data)
+        # delete the first 8 blocks
+        deleted = [bs.key((b"%02i" % i) * 20) for i in range3(8)]
+        for key in deleted:
+            bs.delete(key)
+            del blocks[key]
+        bs.close()
+        # the index is persistent
+        bs = blockstore.PackBlockStore(dpath=self.d, max_block_size=64,
+                                       max_pack_size=256)
+        for key in deleted:
+            try:
+                bs.retrieve(key)
+                self.fail("Read back deleted block")
+            except blockstore.BlockMissing:
+                pass
+        for key, data in dict_items(blocks):
+            self.assertTrue(bs.retrieve(key) == data)
+        # pack 0 is empty, pack 1 is only 1/3 deleted
+        self.assertTrue(bs.compact() == 240)
+        self.assertFalse(self.d.join('pack-000000.dat').exists())
+        self.assertTrue(self.d.join('pack-000001.dat').exists())
+        self.assertTrue(bs.compact(0) == 80)
+        self.assertFalse(self.d.join('pack-000001.dat').exists())
+        # nothing to reclaim, no new pack is started
+        pack_num = bs.pack_num
+        self.assertTrue(bs.compact(0) == 0)
+        self.assertTrue(bs.pack_num == pack_num)
+        for key, data in dict_items(blocks):
+            self.assertTrue(bs.retrieve(key) == data)
+        k = bs.store(b"new data")
+        bs.close()
+        bs = blockstore.PackBlockStore(dpath=self.d, max_block_size=64,
+                                       max_pack_size=256)
+        self.assertTrue(len(bs.index) == 13)
+        self.assertTrue(sorted(k for k, size in bs.iter_blocks()) ==
+                        sorted(list(blocks) + [k]))
+        self.assertTrue(bs.retrieve(k) == b"new data")
+        for key, data in dict_items(blocks):
+            self.assertTrue(bs.retrieve(key) == data)
+        bs.close()
+
 
 class ODataTests(BlockStoreCommon):
 
@@ -210,6 +444,26 @@ class ODataTests(BlockStoreCommon):
                                       max_block_size=256)
         self.maxsize(bs)
 
+    def test_iter_blocks(self):
+        bs = blockstore.EDMBlockStore(entity_set=self.cdef['Blocks'])
+        kfox = bs.store(b"The quick brown fox jumped over the lazy dog")
+        kcafe = bs.store(b"Cafe")
+        blocks = sorted(bs.iter_blocks())
+        self.assertTrue(blocks == sorted([(kfox, None), (kcafe, None)]))
+
+    def test_modified(self):
+        bs = blockstore.EDMBlockStore(entity_set=self.cdef['Blocks'])
+        self.assertTrue(bs.modified_property)
+
+        def backdate(key):
+            with self.cdef['Blocks'].open() as blocks:
+                block = blocks[key]
+                block['modified'].set_from_value(
+                    TimePoint.from_unix_time(time.time() - 86400))
+                blocks.update_entity(block)
+
+        self.modified(bs, backdate)
+
     def test_hash(self):
         bs = blockstore.EDMBlockStore(
             entity_set=self.cdef['Blocks'],
@@ -220,6 +474,106 @@ class ODataTests(BlockStoreCommon):
         bs = blockstore.EDMBlockStore(entity_set=self.cdef['Blocks'])
         self.cafeclosed(bs)
 
+    def test_codec(self):
+        bs = blockstore.EDMBlockStore(entity_set=self.cdef['Blocks'],
+                                      codec='zlib')
+        ktext, knoise = self.compressed(bs)
+        with self.cdef['Blocks'].open() as blocks:
+            self.assertTrue(blocks[ktext]['codec'].value == 'zlib')
+            self.assertFalse(blocks[knoise]['codec'])
+        # the codec property is required for compression, BlockLocks
+        # has no codec property
+        try:
+            blockstore.EDMBlockStore(entity_set=self.cdef['BlockLocks'],
+                                     codec='zlib')
+            self.fail("codec without codec property")
+        except ValueError:
+            pass
+
+
+class CachingTests(BlockStoreCommon):
+
+    def setUp(self):  # noqa
+        self.d = FilePath.mkdtemp('.d', 'pyslet-test_blockstore-')
+
+    def tearDown(self):  # noqa
+        self.d.rmtree(True)
+
+    def test_init(self):
+        fbs = blockstore.FileBlockStore(dpath=self.d, max_block_size=256,
+                                        hash_class=hashlib.md5)
+        bs = blockstore.CachingBlockStore(fbs)
+        self.assertTrue(bs.max_block_size == 256)
+        self.assertTrue(bs.hash_class is hashlib.md5)
+        self.assertTrue(bs.cache_size == 64 * blockstore.MAX_BLOCK_SIZE)
+        self.assertTrue(bs.cache_stats() == (0, 0, 0, 0))
+
+    def test_store(self):
+        bs = blockstore.CachingBlockStore(
+            blockstore.FileBlockStore(dpath=self.d))
+        self.fox_cafe(bs)
+
+    def test_maxsize(self):
+        bs = blockstore.CachingBlockStore(
+            blockstore.FileBlockStore(dpath=self.d, max_block_size=256))
+        self.maxsize(bs)
+
+    def test_delete(self):
+        bs = blockstore.CachingBlockStore(
+            blockstore.FileBlockStore(dpath=self.d))
+        self.cafeclosed(bs)
+
+    def test_lru(self):
+        fbs = blockstore.FileBlockStore(dpath=self.d)
+        bs = blockstore.CachingBlockStore(fbs, cache_size=100)
+        k1 = bs.store(b"1" * 40)
+        k2 = bs.store(b"2" * 40)
+        k3 = bs.store(b"3" * 40)
+        kbig = bs.store(b"X" * 101)
+        self.assertTrue(bs.retrieve(k1) == b"1" * 40)
+        self.assertTrue(bs.retrieve(k2) == b"2" * 40)
+        self.assertTrue(bs.cache_stats() == (2, 80, 0, 2))
+        # hits don't touch the underlying store
+        fbs.delete(k1)
+        self.assertTrue(bs.retrieve(k1) == b"1" * 40)
+        self.assertTrue(bs.cache_stats() == (2, 80, 1, 2))
+        # k2 is now the least recently used and is discarded
+        self.assertTrue(bs.retrieve(k3) == b"3" * 40)
+        self.assertTrue(bs.cache_stats() == (2, 80, 1, 3))
+        self.assertTrue(bs.retrieve(k1) == b"1" * 40)
+        self.assertTrue(bs.retrieve(k2) == b"2" * 40)
+        self.assertTrue(bs.cache_stats() == (2, 80, 2, 4))
+        # blocks larger than the cache are never cached
+        self.assertTrue(bs.retrieve(kbig) == b"X" * 101)
+        self.assertTrue(bs.cache_stats() == (2, 80, 2, 5))
+        # deleting a block removes it from the cache
+        bs.delete(k2)
+        self.assertTrue(bs.cache_stats()[:2] == (1, 40))
+        try:
+            bs.retrieve(k2)
+            self.fail("Read back deleted block")
+        except blockstore.BlockMissing:
+            pass
+        bs.clear_cache()
+        self.assertTrue(bs.cache_stats()[:2] == (0, 0))
+
+    def test_lru_order(self):
+        fbs = blockstore.FileBlockStore(dpath=self.d)
+        bs = blockstore.CachingBlockStore(fbs, cache_size=100)
+        k1 = bs.store(b"1" * 40)
+        k2 = bs.store(b"2" * 40)
+        k3 = bs.store(b"3" * 40)
+        bs.retrieve(k1)
+        bs.retrieve(k2)
+        # lots of hits on k1, k2 remains the least recently used
+        for i in range3(1000):
+            self.assertTrue(bs.retrieve(k1) == b"1" * 40)
+        self.assertTrue(len(bs.cache_order) < 100)
+        bs.retrieve(k3)
+        self.assertTrue(bs.cache_stats()[:2] == (2, 80))
+        self.assertTrue(k1 in bs.cache)
+        self.assertFalse(k2 in bs.cache)
+
 
 class LockingTests(unittest.TestCase):
 
@@ -258,6 +612,12 @@ class LockingTests(unittest.TestCase):
         # unlocking is benign - repeat and rinse
         ls.unlock(hash_key)
         ls.unlock(hash_key2)
+        locks, contended, timeouts, stale, wait_time = ls.lock_stats()
+        self.assertTrue(locks == 3)
+        self.assertTrue(contended == 1)
+        self.assertTrue(timeouts == 1)
+        self.assertTrue(stale == 0)
+        self.assertTrue(wait_time > 0)
 
     def test_lock2(self):
         # now turn the timeouts around, short locks, long waits
@@ -318,6 +678,84 @@ class LockingTests(unittest.TestCase):
             self.fail("Context manager failed to unlock")
 
 
+class MemoryLockingTests(unittest.TestCase):
+
+    def setUp(self):  # noqa
+        self.mt_lock = threading.Lock()
+        self.mt_count = 0
+        self.mt_held = set()
+
+    def test_init(self):
+        ls = blockstore.MemoryLockStore()
+        self.assertTrue(isinstance(ls, blockstore.LockStore))
+        self.assertTrue(ls.lock_timeout == 180, "default lock timeout")
+        self.assertTrue(ls.lock_stats() == (0, 0, 0, 0, 0))
+
+    def test_lock(self):
+        ls = blockstore.MemoryLockStore(stripes=1)
+        hash_key = hashlib.sha256(b'Lockme').hexdigest()
+        hash_key2 = hashlib.sha256(b'andme').hexdigest()
+        # locks are keyed, even in the same stripe
+        ls.lock(hash_key2)
+        ls.lock(hash_key)
+        try:
+            ls.lock(hash_key, timeout=1)
+            self.fail("Expected timeout on acquire")
+        except blockstore.LockError:
+            pass
+        ls.unlock(hash_key)
+        ls.lock(hash_key, timeout=1)
+        ls.unlock(hash_key)
+        ls.unlock(hash_key2)
+        # unlocking is benign
+        ls.unlock(hash_key)
+        ls.unlock(hash_key2)
+        locks, contended, timeouts, stale, wait_time = ls.lock_stats()
+        self.assertTrue((locks, contended, timeouts, stale) == (3, 1, 1, 0))
+        self.assertTrue(wait_time >= 1)
+
+    def test_lock2(self):
+        ls = blockstore.MemoryLockStore(lock_timeout=1)
+        hash_key = hashlib.sha256(b'Lockme').hexdigest()
+        ls.lock(hash_key)
+        # we wait long enough for the lock to become stale
+        try:
+            ls.lock(hash_key, timeout=5)
+        except blockstore.LockError:
+            self.fail("Expected timeout on lock")
+        ls.unlock(hash_key)
+        self.assertTrue(ls.lock_stats()[:4] == (2, 1, 0, 1))
+
+    def test_lock_multithread(self):
+        ls = blockstore.MemoryLockStore(stripes=4)
+        threads = []
+        for i in range3(20):
+            threads.append(threading.Thread(target=self.lock_runner,
+                                            args=(ls, i % 3)))
+        for t in threads:
+            t.start()
+        while threads:
+            t = threads.pop()
+            t.join()
+        self.assertTrue(self.mt_count == 20)
+        locks, contended, timeouts, stale, wait_time = ls.lock_stats()
+        self.assertTrue(locks == 20)
+        self.assertTrue(contended > 0)
+        self.assertTrue(timeouts == 0)
+
+    def lock_runner(self, ls, i):
+        hash_key = hashlib.sha256(b'Lockme%i' % i).hexdigest()
+        with ls.lock(hash_key, timeout=10):
+            with self.mt_lock:
+                if hash_key in self.mt_held:
+                    return
+                self.mt_held.add(hash_key)
+            time.sleep(0.05)
+            with self.mt_lock:
+                self.mt_held.remove(hash_key)
+                self.mt_count += 1
+
+
 class StreamStoreTests(unittest.TestCase):
 
     def setUp(self):  # noqa
@@ -458,6 +896,303 @@ class StreamStoreTests(unittest.TestCase):
             self.assertTrue(rdata == data, "Read back %s" % repr(rdata))
             self.assertTrue(s.tell() == nbytes)
 
+    def test_open_verify(self):
+        ss = blockstore.StreamStore(bs=self.bs, ls=self.ls,
+                                    entity_set=self.cdef['Streams'])
+        s1 = ss.new_stream("text/plain")
+        data = b"".join(b"%03i " % i for i in range3(40))
+        with ss.open_stream(s1, 'w') as s:
+            nbytes = 0
+            while nbytes < len(data):
+                nbytes += s.write(data[nbytes:])
+        with ss.open_stream(s1, 'r', verify=True) as s:
+            # seek straight to the third block
+            s.seek(130)
+            self.assertTrue(s.read(8) == data[130:138])
+        # now corrupt the second block
+        blocks = list(ss.retrieve_blocklist(s1))
+        self.assertTrue(len(blocks) == 3)
+        hash_key = blocks[1]['hash'].value
+        with self.cdef['Blocks'].open() as coll:
+            block = coll[hash_key]
+            block['data'].set_from_value(b"x" * 64)
+            coll.update_entity(block)
+        self.assertTrue(ss.retrieve_block(blocks[1]) == b"x" * 64)
+        try:
+            ss.retrieve_block(blocks[1], verify=True)
+            self.fail("Expected corrupt block")
+        except blockstore.BlockCorrupt:
+            pass
+        with ss.open_stream(s1, 'r', verify=True) as s:
+            # other blocks can still be read
+            self.assertTrue(s.read(8) == data[:8])
+            s.seek(130)
+            self.assertTrue(s.read(8) == data[130:138])
+            s.seek(64)
+            try:
+                s.read(8)
+                self.fail("Expected corrupt block")
+            except blockstore.BlockCorrupt:
+                pass
+
+    def test_memory_database(self):
+        # an in-memory database has a single connection which is held
+        # by the caller while the stream is written
+        container = BlockStoreContainer(container=self.cdef,
+                                        file_path=':memory:')
+        container.create_all_tables()
+        ss = blockstore.StreamStore(bs=self.bs, ls=self.ls,
+                                    entity_set=self.cdef['Streams'])
+        data = b"".join(b"%03i " % i for i in range3(480))
+        with self.cdef['Streams'].open():
+            s1 = ss.new_stream("text/plain")
+            with ss.open_stream(s1, 'w') as s:
+                nbytes = 0
+                while nbytes < len(data):
+                    nbytes += s.write(data[nbytes:])
+            with ss.open_stream(s1, 'r') as s:
+                self.assertTrue(s.read() == data)
+        container.close()
+
+    def test_worker_threads(self):
+        ss = blockstore.StreamStore(bs=self.bs, ls=self.ls,
+                                    entity_set=self.cdef['Streams'])
+        threads = set()
+        for i in range3(5):
+            request = blockstore.BlockRequest(None)
+            request.run = lambda ss: threads.add(
+                threading.current_thread().ident)
+            ss.workers.submit_request(request)
+            request.result()
+        # idle threads are reused rather than replaced
+        self.assertTrue(len(threads) == 1)
+        self.assertTrue(ss.workers.nthreads == 1)
+        ss.workers.idle_timeout = 0.1
+        request = blockstore.BlockRequest(None)
+        request.run = lambda ss: None
+        ss.workers.submit_request(request).result()
+        time.sleep(0.5)
+        self.assertTrue(ss.workers.nthreads == 0)
+
+    def test_read_ahead(self):
+        ss = blockstore.StreamStore(bs=self.bs, ls=self.ls,
+                                    entity_set=self.cdef['Streams'])
+        self.assertTrue(ss.read_ahead == 0)
+        s1 = ss.new_stream("text/plain")
+        data = b"".join(b"%03i " % i for i in range3(100))
+        with ss.open_stream(s1, 'w') as s:
+            nbytes = 0
+            while nbytes < len(data):
+                nbytes += s.write(data[nbytes:])
+        requests = []
+        submit = ss.workers.submit
+
+        def logging_submit(block, verify=False):
+            requests.append(block['num'].value)
+            return submit(block, verify)
+
+        ss.workers.submit = logging_submit
+        with ss.open_stream(s1, 'r') as s:
+            # reads cross block boundaries
+            b = bytearray(150)
+            self.assertTrue(s.readinto(b) == 150)
+            self.assertTrue(b == data[:150])
+            self.assertTrue(s.read() == data[150:])
+        self.assertTrue(requests == [])
+        ss.read_ahead = 2
+        with ss.open_stream(s1, 'r') as s:
+            rdata = []
+            while True:
+                chunk = s.read(10)
+                if not chunk:
+                    break
+                rdata.append(chunk)
+            self.assertTrue(b"".join(rdata) == data)
+        # 7 blocks, each block is only requested once
+        self.assertTrue(requests == [1, 2, 3, 4, 5, 6], requests)
+        del requests[:]
+        with ss.open_stream(s1, 'r', read_ahead=1) as s:
+            s.seek(200)
+            self.assertTrue(s.read(8) == data[200:208])
+            # seek back, outside the window
+            s.seek(0)
+            self.assertTrue(s.read(8) == data[:8])
+        self.assertTrue(requests == [4, 1], requests)
+        # errors are raised when the block is required
+        blocks = list(ss.retrieve_blocklist(s1))
+        with self.cdef['Blocks'].open() as coll:
+            block = coll[blocks[1]['hash'].value]
+            block['data'].set_from_value(b"x" * 64)
+            coll.update_entity(block)
+        with ss.open_stream(s1, 'r', verify=True) as s:
+            self.assertTrue(s.read(8) == data[:8])
+            try:
+                s.read()
+                self.fail("Expected corrupt block")
+            except blockstore.BlockCorrupt:
+                pass
+
+    def test_readview(self):
+        ss = blockstore.StreamStore(bs=self.bs, ls=self.ls,
+                                    entity_set=self.cdef['Streams'])
+        s1 = ss.new_stream("text/plain")
+        data = b"".join(b"%03i " % i for i in range3(40))
+        with ss.open_stream(s1, 'w') as s:
+            nbytes = 0
+            while nbytes < len(data):
+                nbytes += s.write(data[nbytes:])
+        with ss.open_stream(s1, 'r') as s:
+            view = s.readview(10)
+            self.assertTrue(isinstance(view, memoryview))
+            self.assertTrue(view.tobytes() == data[:10])
+            # never crosses a block boundary
+            view = s.readview()
+            self.assertTrue(view.tobytes() == data[10:64])
+            self.assertTrue(s.tell() == 64)
+            self.assertTrue(s.readview(1000).tobytes() == data[64:128])
+            self.assertTrue(s.read() == data[128:])
+            self.assertTrue(len(s.readview()) == 0)
+        # closing the stream releases the current block
+        self.assertTrue(s._bdata is None)
+        with ss.open_stream(s1, 'r+') as s:
+            s.seek(60)
+            self.assertTrue(s.readview().tobytes() == data[60:64])
+        with ss.open_stream(s1, 'w') as s:
+            try:
+                s.readview()
+                self.fail("readview on write-only stream")
+            except IOError:
+                pass
+
+    def test_collect_garbage(self):
+        ss = blockstore.StreamStore(bs=self.bs, ls=self.ls,
+                                    entity_set=self.cdef['Streams'])
+        # EDMBlockStore does not report block sizes
+        self.collect_garbage(ss, orphan_bytes=0)
+
+    def test_collect_garbage_sql(self):
+        d = FilePath.mkdtemp('.d', 'pyslet-test_blockstore-')
+        try:
+            container = BlockStoreContainer(
+                container=self.cdef, file_path=str(d.join('blockstore.db')))
+            container.create_all_tables()
+            bs = blockstore.FileBlockStore(dpath=d, max_block_size=64)
+            ss = blockstore.StreamStore(
+                bs=bs, ls=blockstore.MemoryLockStore(),
+                entity_set=self.cdef['Streams'])
+            self.collect_garbage(ss, batch_size=2)
+            container.close()
+        finally:
+            d.rmtree(True)
+
+    def collect_garbage(self, ss, batch_size=1000, orphan_bytes=9):
+        s1 = ss.new_stream("text/plain")
+        data = b"".join(b"%03i " % i for i in range3(40))
+        with ss.open_stream(s1, 'w') as s:
+            nbytes = 0
+            while nbytes < len(data):
+                nbytes += s.write(data[nbytes:])
+        self.assertTrue(
+            ss.collect_garbage(batch_size=batch_size, grace=0) == (0, 0))
+        # simulate a failure after storing data
+        korphan = ss.bs.store(b"orphan")
+        kfox = ss.bs.store(b"fox")
+        self.assertTrue(ss.bs.modified(korphan) is not None)
+        # recently stored blocks may belong to a stream being written
+        self.assertTrue(
+            ss.collect_garbage(dry_run=True, batch_size=batch_size) ==
+            (0, 0))
+        self.assertTrue(ss.collect_garbage(batch_size=batch_size) == (0, 0))
+        self.assertTrue(ss.bs.retrieve(korphan) == b"orphan")
+        self.assertTrue(
+            ss.collect_garbage(dry_run=True, batch_size=batch_size,
+                               grace=0) == (2, orphan_bytes))
+        # nothing is removed by a dry run
+        self.assertTrue(ss.bs.retrieve(korphan) == b"orphan")
+        self.assertTrue(
+            ss.collect_garbage(batch_size=batch_size, grace=0) ==
+            (2, orphan_bytes))
+        for k in (korphan, kfox):
+            try:
+                ss.bs.retrieve(k)
+                self.fail("orphaned block not collected")
+            except blockstore.BlockMissing:
+                pass
+        self.assertTrue(
+            ss.collect_garbage(batch_size=batch_size, grace=0) == (0, 0))
+        with ss.open_stream(s1, 'r') as s:
+            self.assertTrue(s.read() == data)
+        # a block referenced during the collection is not removed
+        korphan = ss.bs.store(b"orphan")
+        kfox = ss.bs.store(b"fox")
+        s2 = ss.new_stream("text/plain")
+        chunks = []
+        hash_filter = ss._hash_filter
+
+        def referencing_filter(hash_keys):
+            chunks.append(sorted(hash_keys))
+            if len(chunks) == 1:
+                ss.store_block(s2, 0, b"orphan")
+            return hash_filter(hash_keys)
+
+        ss._hash_filter = referencing_filter
+        self.assertTrue(
+            ss.collect_garbage(batch_size=batch_size, grace=0) ==
+            (1, 3 if orphan_bytes else 0))
+        del ss._hash_filter
+        # one query for each batch of keys
+        self.assertTrue(chunks == [sorted((korphan, kfox))], chunks)
+        self.assertTrue(ss.bs.retrieve(korphan) == b"orphan")
+        try:
+            ss.bs.retrieve(kfox)
+            self.fail("orphaned block not collected")
+        except blockstore.BlockMissing:
+            pass
+
+    def test_batched_write(self):
+        ss = blockstore.StreamStore(bs=self.bs, ls=self.ls,
+                                    entity_set=self.cdef['Streams'])
+        # background stores are optional
+        self.assertTrue(ss.write_buffer == 0)
+        data = b"".join(b"%03i " % i for i in range3(100))
+        for write_buffer in (0, 2, 8):
+            ss.write_buffer = write_buffer
+            s1 = ss.new_stream("text/plain")
+            batches = []
+            store_blocklist = ss.store_blocklist
+
+            def logging_store_blocklist(stream, blocks):
+                batches.append([b['num'].value for b in blocks])
+                return store_blocklist(stream, blocks)
+
+            ss.store_blocklist = logging_store_blocklist
+            with ss.open_stream(s1, 'w') as s:
+                nbytes = 0
+                while nbytes < len(data):
+                    nbytes += s.write(data[nbytes:])
+                # nothing is committed until we flush
+                self.assertTrue(batches == [])
+                self.assertTrue(len(list(ss.retrieve_blocklist(s1))) == 0)
+            del ss.store_blocklist
+            # all 7 blocks were added in a single batch
+            self.assertTrue(batches == [list(range3(7))], batches)
+            self.assertTrue(s1['size'].value == len(data))
+            self.assertTrue(s1['md5'].value == hashlib.md5(data).digest())
+            with ss.open_stream(s1, 'r') as s:
+                self.assertTrue(s.read() == data)
+        # read and write a stream with pending blocks
+        s1 = ss.new_stream("text/plain")
+        with ss.open_stream(s1, 'w+') as s:
+            s.write(data[:64])
+            s.write(data[64:100])
+            s.seek(0)
+            self.assertTrue(s.read(8) == data[:8])
+            s.seek(70)
+            s.write(b"XXXX")
+        with ss.open_stream(s1, 'r') as s:
+            self.assertTrue(s.read() ==
+                            data[:70] + b"XXXX" + data[74:100])
+
 
 class BlockStoreContainer(SQLiteEntityContainer):
 
@@ -892,6 +892,47 @@ class HeaderTests(unittest.TestCase):
         cr7 = ContentRange.from_str("bytes 734-1234/1234")
         self.assertFalse(cr7.is_valid())
 
+    def test_range(self):
+        r = Range.from_str("bytes=0-499")
+        self.assertTrue(r.unit == "bytes")
+        self.assertTrue(r.ranges == ((0, 499), ))
+        self.assertTrue(str(r) == "bytes=0-499")
+        r = Range.from_str("bytes = 500-999 , -500,9500-")
+        self.assertTrue(r.ranges == ((500, 999), (None, 500), (9500, None)))
+        self.assertTrue(str(r) == "bytes=500-999,-500,9500-")
+        cr = r.get_content_ranges(10000)
+        self.assertTrue(len(cr) == 3)
+        self.assertTrue(str(cr[0]) == "bytes 500-999/10000")
+        self.assertTrue(str(cr[1]) == "bytes 9500-9999/10000")
+        self.assertTrue(str(cr[2]) == "bytes 9500-9999/10000")
+        # ranges are truncated to the entity or are not satisfiable
+        cr = r.get_content_ranges(600)
+        self.assertTrue(len(cr) == 2)
+        self.assertTrue(str(cr[0]) == "bytes 500-599/600")
+        self.assertTrue(str(cr[1]) == "bytes 100-599/600")
+        cr = Range.from_str("bytes=-1000").get_content_ranges(600)
+        self.assertTrue(str(cr[0]) == "bytes 0-599/600")
+        self.assertTrue(Range.from_str("bytes=600-").get_content_ranges(
+            600) == [])
+        self.assertTrue(Range.from_str("bytes=-0").get_content_ranges(
+            600) == [])
+        self.assertTrue(Range.from_str("pages=1-2").get_content_ranges(
+            600) is None)
+        for bad in ("bytes", "bytes=", "bytes=500-499", "bytes=-",
+                    "bytes=1-2-3", "bytes=a-b", "bytes=1-2;"):
+            try:
+                Range.from_str(bad)
+                self.fail("Range.from_str(%s)" % repr(bad))
+            except grammar.BadSyntax:
+                pass
+        req = Request()
+        self.assertTrue(req.get_range() is None)
+        req.set_range("bytes=0-0,-1")
+        self.assertTrue(req.get_header('Range') == b"bytes=0-0,-1")
+        self.assertTrue(req.get_range().ranges == ((0, 0), (None, 1)))
+        req.set_range(None)
+        self.assertTrue(req.get_range() is None)
+
     def test_content_type(self):
         req = Request()
         mtype = params.MediaType('application', 'octet-stream',
@@ -5595,6 +5595,16 @@ class DataServiceRegressionTests(unittest.TestCase):
         for data in sgen:
             count += len(data)
         self.assertTrue(count == sinfo.size)
+        # byte ranges restrict the data but not the stream info
+        with streams.open() as coll:
+            fout = io.BytesIO()
+            sinfo = coll.read_stream('foxy', fout, (2, 5))
+            self.assertTrue(sinfo.size == len(cafe))
+            self.assertTrue(fout.getvalue() == cafe[2:6])
+        coll = streams.open()
+        sinfo, sgen = coll.read_stream_close('foxy', (7, len(cafe) - 1))
+        self.assertTrue(sinfo.size == len(cafe))
+        self.assertTrue(b''.join(sgen) == cafe[7:])
         # the collection should now be closed!
         with streams.open() as coll:
             # now some negative tests
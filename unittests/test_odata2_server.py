@@ -13,6 +13,7 @@ import time
 import traceback
 import uuid
 import unittest
+import zlib
 
 from threading import Thread
 
@@ -28,6 +29,7 @@ from pyslet.odata2 import memds
 from pyslet.odata2 import metadata as edmx
 from pyslet.odata2 import server
 from pyslet.py2 import (
+    dict_items,
     dict_values,
     is_unicode,
     long2,
@@ -898,21 +900,28 @@ class ODataURILiteralTests(unittest.TestCase):
 
 class MockDocumentCollection(core.EntityCollection):
 
-    def read_stream(self, key, out=None):
+    def read_stream(self, key, out=None, byte_range=None):
         if key == 1801:
             sinfo = core.StreamInfo(type="text/x-tolstoy")
             sinfo.size = len(DOCUMENT_TEXT)
             if out is not None:
-                out.write(DOCUMENT_TEXT)
+                if byte_range is None:
+                    out.write(DOCUMENT_TEXT)
+                else:
+                    out.write(
+                        DOCUMENT_TEXT[byte_range[0]:byte_range[1] + 1])
             return sinfo
         else:
             raise KeyError
 
-    def read_stream_close(self, key):
+    def read_stream_close(self, key, byte_range=None):
         if key == 1801:
             sinfo = core.StreamInfo(type="text/x-tolstoy")
             sinfo.size = len(DOCUMENT_TEXT)
-            return sinfo, [DOCUMENT_TEXT]
+            if byte_range is None:
+                return sinfo, [DOCUMENT_TEXT]
+            else:
+                return sinfo, [DOCUMENT_TEXT[byte_range[0]:byte_range[1] + 1]]
         else:
             raise KeyError
 
@@ -1091,6 +1100,10 @@ class ServerTests(unittest.TestCase):
         """With a simple OData server we set the model manually"""
         s = server.Server()
         self.assertTrue(s.model is None, "no model initially")
+        # change sets are safe without a model
+        connections = s._begin_changeset()
+        self.assertTrue(connections == [])
+        self.assertTrue(s._end_changeset(connections, True))
         # Load the model document
         doc = self.load_metadata()
         s.set_model(doc)
@@ -2637,13 +2650,14 @@ class SampleServerTests(unittest.TestCase):
         ...If a data service does not implement support for a Batch
         Request, it must return a 4xx response code in the response to
         any Batch Request sent to it."""
+        # batch requests must be POSTed
         request = MockRequest("/service.svc/$batch")
         request.send(self.svc)
-        self.assertTrue(request.responseCode == 404)
+        self.assertTrue(request.responseCode == 400)
         base_uri = "/service.svc/$batch?"
         request = MockRequest(base_uri)
         request.send(self.svc)
-        self.assertTrue(request.responseCode == 404)
+        self.assertTrue(request.responseCode == 400)
         for x in ["$expand=Orders",
                   "$filter=substringof(CompanyName,%20'bikes')",
                   "$format=xml",
@@ -3894,6 +3908,194 @@ class SampleServerTests(unittest.TestCase):
         self.assertTrue(len(doc.root.Entry) == 91,
                         "Sample server has 91 Customers")
 
+    def batch_request(self, parts, boundary="batch_1"):
+        data = []
+        for part in parts:
+            data.append(b"--" + boundary.encode('ascii') + b"\r\n")
+            data.append(part)
+            data.append(b"\r\n")
+        data.append(b"--" + boundary.encode('ascii') + b"--\r\n")
+        data = b"".join(data)
+        request = MockRequest("/service.svc/$batch", "POST")
+        request.set_header(
+            'Content-Type', "multipart/mixed; boundary=%s" % boundary)
+        request.set_header('Content-Length', str(len(data)))
+        request.rfile.write(data)
+        request.send(self.svc)
+        return request
+
+    def http_part(self, method, url, body=None, content_id=None):
+        lines = ["Content-Type: application/http",
+                 "Content-Transfer-Encoding: binary"]
+        if content_id is not None:
+            lines.append("Content-ID: %s" % content_id)
+        lines += ["", "%s %s HTTP/1.1" % (method, url),
+                  "Accept: application/json"]
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            lines.append("Content-Type: application/json")
+            lines.append("Content-Length: %i" % len(body))
+        else:
+            body = b""
+        lines += ["", ""]
+        return "\r\n".join(lines).encode('ascii') + body
+
+    def changeset_part(self, parts, boundary="changeset_1"):
+        data = ["Content-Type: multipart/mixed; boundary=%s\r\n\r\n" %
+                boundary]
+        data = [d.encode('ascii') for d in data]
+        for part in parts:
+            data.append(b"--" + boundary.encode('ascii') + b"\r\n")
+            data.append(part)
+            data.append(b"\r\n")
+        data.append(b"--" + boundary.encode('ascii') + b"--")
+        return b"".join(data)
+
+    def split_batch_response(self, data, content_type):
+        # returns a list of (status, body) or lists thereof
+        mtype = params.MediaType.from_str(content_type)
+        self.assertTrue(mtype.type == "multipart")
+        self.assertTrue(mtype.subtype == "mixed")
+        delimiter = b"\r\n--" + mtype['boundary']
+        data = b"\r\n" + data
+        self.assertTrue(data.endswith(delimiter + b"--\r\n"))
+        result = []
+        for part in data.split(delimiter)[1:-1]:
+            self.assertTrue(part.startswith(b"\r\n"))
+            headers, body = part[2:].split(b"\r\n\r\n", 1)
+            headers = headers.decode('ascii').split("\r\n")
+            if headers[0].startswith("Content-Type: multipart/mixed"):
+                result.append(self.split_batch_response(
+                    body + b"\r\n", headers[0][14:]))
+            else:
+                self.assertTrue(
+                    headers[0] == "Content-Type: application/http")
+                status, body = body.split(b"\r\n\r\n", 1)
+                status = int(status.split(b"\r\n")[0].split()[1])
+                result.append((status, body))
+        return result
+
+    def test_batch(self):
+        parts = [
+            self.http_part("GET", "Customers('ALFKI')"),
+            self.http_part("GET", "/service.svc/Orders(1)"),
+            self.http_part("GET", "http://host/service.svc/Orders(2)"),
+            self.http_part("GET", "Customers('XXXXX')"),
+            self.changeset_part([
+                self.http_part(
+                    "POST", "Customers",
+                    {"CustomerID": "STEVE", "CompanyName": "Steve's Inc",
+                     "Address": {"Street": None, "City": None}},
+                    content_id="1"),
+                self.http_part(
+                    "MERGE", "$1",
+                    {"CustomerID": "STEVE", "CompanyName": "Steve's Ltd",
+                     "Address": {"Street": None, "City": "Cambridge"}})]),
+            self.http_part("GET", "Customers('STEVE')"),
+            self.changeset_part([
+                self.http_part(
+                    "POST", "Customers",
+                    {"CustomerID": "STEVE", "CompanyName": "Steve's Inc",
+                     "Address": {"Street": None, "City": None}}),
+                self.http_part("DELETE", "Customers('ALFKI')")]),
+            self.http_part("DELETE", "Customers('ALFKI')")]
+        request = self.batch_request(parts)
+        self.assertTrue(request.responseCode == 202)
+        data = request.wfile.getvalue()
+        self.assertTrue(
+            int(request.responseHeaders['CONTENT-LENGTH']) == len(data))
+        result = self.split_batch_response(
+            data, request.responseHeaders['CONTENT-TYPE'])
+        self.assertTrue(len(result) == 8)
+        # query operations
+        self.assertTrue(result[0][0] == 200)
+        obj = json.loads(result[0][1].decode('utf-8'))
+        self.assertTrue(obj['d']['CustomerID'] == 'ALFKI')
+        self.assertTrue(result[1][0] == 200)
+        obj = json.loads(result[1][1].decode('utf-8'))
+        self.assertTrue(obj['d']['OrderID'] == 1)
+        obj = json.loads(result[2][1].decode('utf-8'))
+        self.assertTrue(obj['d']['OrderID'] == 2)
+        self.assertTrue(result[3][0] == 404)
+        # successful change set
+        self.assertTrue(isinstance(result[4], list))
+        self.assertTrue(len(result[4]) == 2)
+        self.assertTrue(result[4][0][0] == 201)
+        self.assertTrue(result[4][1][0] == 204)
+        obj = json.loads(result[5][1].decode('utf-8'))
+        self.assertTrue(obj['d']['CompanyName'] == "Steve's Ltd")
+        # failed change set returns a single response
+        self.assertFalse(isinstance(result[6], list))
+        self.assertTrue(result[6][0] >= 400)
+        # memds does not support rollback but the DELETE was not run
+        with self.ds['SampleModel.SampleEntities.Customers'].open() as \
+                customers:
+            self.assertTrue('ALFKI' in customers)
+        # change requests must be in a change set
+        self.assertTrue(result[7][0] == 400)
+        # results are the same whether or not threads are used
+        self.svc.batch_threads = 1
+        request = self.batch_request(parts[:4])
+        self.assertTrue(request.responseCode == 202)
+        tresult = self.split_batch_response(
+            request.wfile.getvalue(), request.responseHeaders['CONTENT-TYPE'])
+        self.assertTrue(tresult == result[:4])
+        # bad requests
+        request = MockRequest("/service.svc/$batch", "POST")
+        request.set_header('Content-Type', "application/http")
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 400)
+        request = self.batch_request([b"Content-Type: text/plain\r\n\r\n"])
+        self.assertTrue(request.responseCode == 400)
+        # no nested batches
+        request = self.batch_request(
+            [self.http_part("POST", "$batch", {})])
+        result = self.split_batch_response(
+            request.wfile.getvalue(), request.responseHeaders['CONTENT-TYPE'])
+        self.assertTrue(result[0][0] == 400)
+
+    def test_retrieve_entity_set_streamed(self):
+        self.assertTrue(self.svc.chunk_size == io.DEFAULT_BUFFER_SIZE)
+        for accept in ('application/atom+xml', 'application/json'):
+            # a small response is sent with a Content-Length
+            request = MockRequest('/service.svc/Customers?$top=1')
+            request.set_header('Accept', accept)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            self.assertTrue(int(request.responseHeaders['CONTENT-LENGTH']) ==
+                            len(request.wfile.getvalue()))
+            # larger responses are streamed
+            request = MockRequest('/service.svc/Customers')
+            request.set_header('Accept', accept)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            self.assertFalse('CONTENT-LENGTH' in request.responseHeaders)
+            data = request.wfile.getvalue()
+            # the response is the same whatever the chunk size
+            self.svc.chunk_size = 1
+            chunks = []
+
+            def start_response(status, response_headers, exc_info=None):
+                self.assertTrue(status.startswith('200 '))
+
+            environ = {
+                'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '',
+                'PATH_INFO': '/service.svc/Customers', 'QUERY_STRING': '',
+                'SERVER_NAME': 'host', 'SERVER_PORT': '80',
+                'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': 'host',
+                'HTTP_ACCEPT': accept, 'wsgi.url_scheme': 'http',
+                'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr}
+            for chunk in self.svc(environ, start_response):
+                self.assertTrue(isinstance(chunk, bytes))
+                chunks.append(chunk)
+            self.svc.chunk_size = io.DEFAULT_BUFFER_SIZE
+            self.assertTrue(len(chunks) > 91)
+            if accept == 'application/json':
+                self.assertTrue(b''.join(chunks) == data)
+            else:
+                # the feed's updated time may differ
+                self.assertTrue(len(b''.join(chunks)) == len(data))
+
     def test_retrieve_entity_set_json(self):
         request = MockRequest('/service.svc/Customers')
         request.set_header('Accept', 'application/json')
@@ -4370,6 +4572,361 @@ class SampleServerTests(unittest.TestCase):
             u8(b'An opening line written in a Caf\xc3\xa9'),
             "media resource characters")
 
+    def test_retrieve_media_range(self):
+        request = MockRequest("/service.svc/Documents(301)/$value")
+        request.set_header('Range', "bytes=3-9")
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 206)
+        self.assertTrue(request.responseHeaders['ACCEPT-RANGES'] == "bytes")
+        self.assertTrue(
+            request.responseHeaders['CONTENT-RANGE'] == "bytes 3-9/33")
+        self.assertTrue(request.responseHeaders['CONTENT-LENGTH'] == "7")
+        self.assertFalse("CONTENT-MD5" in request.responseHeaders)
+        self.assertTrue(request.wfile.getvalue() == b"opening")
+        request = MockRequest("/service.svc/Documents(301)/$value")
+        request.set_header('Range', "bytes=-2")
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 206)
+        self.assertTrue(request.wfile.getvalue() == b"f\xe9")
+        # unsatisfiable range
+        request = MockRequest("/service.svc/Documents(301)/$value")
+        request.set_header('Range', "bytes=33-")
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 416)
+        self.assertTrue(
+            request.responseHeaders['CONTENT-RANGE'] == "bytes */33")
+        # multiple ranges, bad syntax and If-Range mismatches are
+        # ignored
+        for range, if_range in (("bytes=0-1,3-4", None),
+                                ("bytes=4-3", None),
+                                ("bytes=3-9", '"mismatch"')):
+            request = MockRequest("/service.svc/Documents(301)/$value")
+            request.set_header('Range', range)
+            if if_range:
+                request.set_header('If-Range', if_range)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            self.assertTrue(len(request.wfile.getvalue()) == 33)
+        # If-Range matches Last-Modified, weak ETags never match
+        request = MockRequest("/service.svc/Documents(301)/$value")
+        request.send(self.svc)
+        etag = request.responseHeaders['ETAG']
+        self.assertTrue(etag.startswith('W/'))
+        modified = request.responseHeaders['LAST-MODIFIED']
+        for if_range, code in ((etag, 200), (modified, 206)):
+            request = MockRequest("/service.svc/Documents(301)/$value")
+            request.set_header('Range', "bytes=3-9")
+            request.set_header('If-Range', if_range)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == code, if_range)
+
+    def test_media_stream_reads(self):
+        calls = []
+        read_stream = memds.EntityCollection.read_stream
+        read_stream_close = memds.EntityCollection.read_stream_close
+
+        def count_read(coll, key, *args, **kwargs):
+            calls.append('read_stream')
+            return read_stream(coll, key, *args, **kwargs)
+
+        def count_read_close(coll, key, *args, **kwargs):
+            calls.append('read_stream_close')
+            return read_stream_close(coll, key, *args, **kwargs)
+
+        memds.EntityCollection.read_stream = count_read
+        memds.EntityCollection.read_stream_close = count_read_close
+        try:
+            for method, headers, code, expected in (
+                    ("GET", {}, 200, ['read_stream_close']),
+                    ("GET", {'If-None-Match': '*'}, 304,
+                     ['read_stream_close']),
+                    ("GET", {'If-None-Match': '"mismatch"'}, 200,
+                     ['read_stream_close']),
+                    ("GET", {'Range': "bytes=3-9"}, 206,
+                     ['read_stream', 'read_stream_close']),
+                    ("GET", {'Range': "bytes=33-"}, 416, ['read_stream']),
+                    ("HEAD", {}, 200, ['read_stream']),
+                    ("HEAD", {'If-None-Match': '*'}, 304,
+                     ['read_stream'])):
+                calls[:] = []
+                request = MockRequest("/service.svc/Documents(301)/$value",
+                                      method)
+                for name, value in dict_items(headers):
+                    request.set_header(name, value)
+                request.send(self.svc)
+                self.assertTrue(request.responseCode == code)
+                self.assertTrue(calls == expected, repr(calls))
+        finally:
+            memds.EntityCollection.read_stream = read_stream
+            memds.EntityCollection.read_stream_close = read_stream_close
+
+    def test_conditional_get(self):
+        for path in ("/service.svc/Employees('1')",
+                     "/service.svc/Employees('1')/EmployeeName",
+                     "/service.svc/Employees('1')/EmployeeName/$value",
+                     "/service.svc/Documents(301)/$value",
+                     "/service.svc/Orders",
+                     "/service.svc/Orders?$format=json",
+                     "/service.svc/$metadata"):
+            request = MockRequest(path)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            etag = request.responseHeaders['ETAG']
+            data = request.wfile.getvalue()
+            for match, code in ((etag, 304),
+                                ('"mismatch", ' + etag, 304),
+                                ('*', 304),
+                                ('"mismatch"', 200),
+                                ('bad etag', 200)):
+                request = MockRequest(path)
+                request.set_header('If-None-Match', match)
+                request.send(self.svc)
+                self.assertTrue(request.responseCode == code, path)
+                self.assertTrue(request.responseHeaders['ETAG'] == etag)
+                if code == 304:
+                    self.assertTrue(request.wfile.getvalue() == b"")
+                    self.assertFalse(
+                        "CONTENT-LENGTH" in request.responseHeaders)
+                else:
+                    self.assertTrue(request.wfile.getvalue() == data)
+            # weak comparison
+            if etag.startswith('W/'):
+                match = etag[2:]
+            else:
+                match = 'W/' + etag
+            request = MockRequest(path)
+            request.set_header('If-None-Match', match)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 304)
+        # the feed validator changes when the data changes
+        request = MockRequest("/service.svc/Orders")
+        request.send(self.svc)
+        etag = request.responseHeaders['ETAG']
+        self.assertTrue(etag.startswith('W/'))
+        with self.ds['SampleModel.SampleEntities.Orders'].open() as orders:
+            order = orders[1]
+            order['ShippedDate'].set_from_value(
+                iso.TimePoint.from_str('2013-08-02T11:05:00'))
+            orders.update_entity(order)
+        request = MockRequest("/service.svc/Orders")
+        request.set_header('If-None-Match', etag)
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        self.assertFalse(request.responseHeaders['ETAG'] == etag)
+        # large, streamed feeds have no validator
+        request = MockRequest("/service.svc/Customers")
+        request.send(self.svc)
+        self.assertFalse("ETAG" in request.responseHeaders)
+        # If-Modified-Since is used for media resources
+        request = MockRequest("/service.svc/Documents(301)/$value")
+        request.send(self.svc)
+        modified = request.responseHeaders['LAST-MODIFIED']
+        unix_time = params.FullDate.from_http_str(modified).get_unixtime()
+        for delta, code in ((0, 304), (1, 304), (-1, 200)):
+            request = MockRequest("/service.svc/Documents(301)/$value")
+            request.set_header('If-Modified-Since', str(
+                params.FullDate(src=iso.TimePoint.from_unix_time(
+                    unix_time + delta))))
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == code)
+        # but is ignored if If-None-Match is present
+        request = MockRequest("/service.svc/Documents(301)/$value")
+        request.set_header('If-Modified-Since', modified)
+        request.set_header('If-None-Match', '"mismatch"')
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        # conditional headers do not apply to other methods
+        request = MockRequest("/service.svc/Employees('1')", "DELETE")
+        request.set_header('If-None-Match', '*')
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 204)
+
+    def test_cached_documents(self):
+        for path, accept, cached in (
+                ("/service.svc/$metadata", "application/xml",
+                 self.svc.metadata_cache),
+                ("/service.svc/", "application/atomsvc+xml",
+                 self.svc.service_cache['xml']),
+                ("/service.svc/", "application/json",
+                 self.svc.service_cache['json'])):
+            self.assertTrue(isinstance(cached, server.CachedResponse))
+            request = MockRequest(path)
+            request.set_header('Accept', accept)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            self.assertTrue(request.wfile.getvalue() == cached.data)
+            self.assertTrue(request.responseHeaders['ETAG'] == cached.etag)
+            self.assertTrue(
+                request.responseHeaders['VARY'] == "Accept-Encoding")
+            self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+            request = MockRequest(path)
+            request.set_header('Accept', accept)
+            request.set_header('Accept-Encoding', 'gzip, deflate')
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            self.assertTrue(
+                request.responseHeaders['CONTENT-ENCODING'] == "gzip")
+            data = request.wfile.getvalue()
+            self.assertTrue(len(data) < len(cached.data))
+            self.assertTrue(
+                int(request.responseHeaders['CONTENT-LENGTH']) == len(data))
+            self.assertTrue(zlib.decompress(data, 31) == cached.data)
+            # the encoded copy has a different strong ETag
+            etag = request.responseHeaders['ETAG']
+            self.assertTrue(etag == cached.gzip_etag)
+            self.assertFalse(etag == cached.etag)
+            request = MockRequest(path)
+            request.set_header('Accept', accept)
+            request.set_header('Accept-Encoding', 'gzip')
+            request.set_header('If-None-Match', etag)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 304)
+            request = MockRequest(path)
+            request.set_header('Accept', accept)
+            request.set_header('Accept-Encoding', 'gzip;q=0')
+            request.set_header('If-None-Match', etag)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            self.assertTrue(request.wfile.getvalue() == cached.data)
+        # the cache is only refreshed when the model changes
+        metadata_cache = self.svc.metadata_cache
+        request = MockRequest("/service.svc/$metadata")
+        request.send(self.svc)
+        self.assertTrue(self.svc.metadata_cache is metadata_cache)
+        self.svc.cache_gzip = False
+        self.svc.set_model(self.ds.get_document())
+        self.assertFalse(self.svc.metadata_cache is metadata_cache)
+        self.assertTrue(self.svc.metadata_cache.gzip_data is None)
+        request = MockRequest("/service.svc/$metadata")
+        request.set_header('Accept-Encoding', 'gzip')
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 200)
+        # without a cached copy the response is compressed on the fly
+        self.assertTrue(
+            request.responseHeaders['CONTENT-ENCODING'] == "gzip")
+        self.assertTrue(
+            request.responseHeaders['VARY'] == "Accept-Encoding")
+        self.assertTrue(request.responseHeaders['ETAG'] ==
+                        'W/' + self.svc.metadata_cache.etag)
+        self.assertTrue(zlib.decompress(request.wfile.getvalue(), 31) ==
+                        metadata_cache.data)
+        # the cached gzip copy is never used in a batch
+        self.svc.cache_gzip = True
+        self.svc.set_model(self.ds.get_document())
+        self.assertFalse(self.svc.metadata_cache.gzip_data is None)
+        part = "\r\n".join([
+            "Content-Type: application/http",
+            "Content-Transfer-Encoding: binary", "",
+            "GET $metadata HTTP/1.1", "Accept-Encoding: gzip", "", ""])
+        request = self.batch_request([part.encode('ascii')])
+        self.assertTrue(request.responseCode == 202)
+        result = self.split_batch_response(
+            request.wfile.getvalue(), request.responseHeaders['CONTENT-TYPE'])
+        self.assertTrue(result[0][0] == 200)
+        self.assertTrue(result[0][1] == self.svc.metadata_cache.data)
+
+    def test_compression(self):
+        request = MockRequest("/service.svc/Customers")
+        request.set_header('Accept', 'application/json')
+        request.send(self.svc)
+        self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+        identity = request.wfile.getvalue()
+        for encoding, wbits in (('gzip', 31), ('deflate', 15)):
+            request = MockRequest("/service.svc/Customers")
+            request.set_header('Accept', 'application/json')
+            request.set_header('Accept-Encoding', encoding)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            self.assertTrue(
+                request.responseHeaders['CONTENT-ENCODING'] == encoding)
+            self.assertTrue(
+                request.responseHeaders['VARY'] == "Accept-Encoding")
+            self.assertFalse("CONTENT-LENGTH" in request.responseHeaders)
+            data = request.wfile.getvalue()
+            self.assertTrue(len(data) < len(identity) // 4)
+            self.assertTrue(zlib.decompress(data, wbits) == identity)
+        # gzip is preferred, q-values are respected
+        for accept, encoding in (('deflate, gzip', 'gzip'),
+                                 ('gzip;q=0.5, deflate', 'deflate'),
+                                 ('gzip;q=0, deflate;q=0', None),
+                                 ('compress', None),
+                                 ('bad, header, ;', None)):
+            request = MockRequest("/service.svc/Customers")
+            request.set_header('Accept-Encoding', accept)
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            self.assertTrue(request.responseHeaders.get(
+                'CONTENT-ENCODING', None) == encoding, accept)
+        # small responses are not compressed
+        request = MockRequest("/service.svc/Customers('ALFKI')")
+        request.send(self.svc)
+        length = int(request.responseHeaders['CONTENT-LENGTH'])
+        self.svc.compress_threshold = length + 1
+        request = MockRequest("/service.svc/Customers('ALFKI')")
+        request.set_header('Accept-Encoding', 'gzip')
+        request.send(self.svc)
+        self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+        self.assertTrue(len(request.wfile.getvalue()) == length)
+        self.svc.compress_threshold = length
+        request = MockRequest("/service.svc/Customers('ALFKI')")
+        request.set_header('Accept-Encoding', 'gzip')
+        request.send(self.svc)
+        self.assertTrue(
+            request.responseHeaders['CONTENT-ENCODING'] == 'gzip')
+        # the entity ETag is weak
+        etag = self.svc.get_etag(self.ds[
+            'SampleModel.SampleEntities.Customers'].open()['ALFKI'])
+        if not etag.startswith('W/'):
+            etag = 'W/' + etag
+        self.assertTrue(request.responseHeaders['ETAG'] == etag)
+        # strong ETags are weakened
+        request = MockRequest("/service.svc/$metadata")
+        request.set_header('Accept-Encoding', 'deflate')
+        request.send(self.svc)
+        self.assertTrue(
+            request.responseHeaders['CONTENT-ENCODING'] == 'deflate')
+        self.assertTrue(request.responseHeaders['ETAG'] ==
+                        'W/' + self.svc.metadata_cache.etag)
+        # HEAD requests and media resources are not compressed
+        self.svc.compress_threshold = 0
+        for path, method in (("/service.svc/Customers('ALFKI')", "HEAD"),
+                             ("/service.svc/Documents(301)/$value", "GET")):
+            request = MockRequest(path, method)
+            request.set_header('Accept-Encoding', 'gzip')
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+            self.assertTrue("CONTENT-LENGTH" in request.responseHeaders)
+        # streamed responses are flushed chunk by chunk
+        self.svc.chunk_size = 1024
+        environ = {
+            'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '',
+            'PATH_INFO': '/service.svc/Customers', 'QUERY_STRING': '',
+            'SERVER_NAME': 'host', 'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': 'host',
+            'HTTP_ACCEPT_ENCODING': 'gzip', 'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr}
+        chunks = iter(self.svc(environ, lambda s, h, e=None: None))
+        decoder = zlib.decompressobj(31)
+        self.assertTrue(len(decoder.decompress(next(chunks))) >= 1024)
+        for chunk in chunks:
+            decoder.decompress(chunk)
+        self.svc.chunk_size = io.DEFAULT_BUFFER_SIZE
+        # errors are not compressed
+        request = MockRequest("/service.svc/Customers('XXXXX')")
+        request.set_header('Accept-Encoding', 'gzip')
+        request.send(self.svc)
+        self.assertTrue(request.responseCode == 404)
+        self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+        # compression can be switched off
+        self.svc.compression = False
+        for path in ("/service.svc/Customers", "/service.svc/$metadata"):
+            request = MockRequest(path)
+            request.set_header('Accept-Encoding', 'gzip')
+            request.send(self.svc)
+            self.assertTrue(request.responseCode == 200)
+            self.assertFalse("CONTENT-ENCODING" in request.responseHeaders)
+
     def test_update_entity(self):
         customers = self.ds['SampleModel.SampleEntities.Customers']
         with customers.open() as collection:
@@ -1,10 +1,13 @@
 #! /usr/bin/env python
 
 import decimal
+import io
+import json
 import logging
 import random
 import sqlite3
 import threading
+import time
 import uuid
 import unittest
 
@@ -13,8 +16,10 @@ from pyslet.http import params
 from pyslet.odata2 import core
 from pyslet.odata2 import csdl as edm
 from pyslet.odata2 import metadata as edmx
+from pyslet.odata2 import server
 from pyslet.odata2 import sqlds
 from pyslet.py2 import (
+    is_text,
     long2,
     range3,
     ul)
@@ -99,6 +104,9 @@ class MockCursor(object):
     def execute(self, query):
         pass
 
+    def fetchall(self):
+        return []
+
     def close(self):
         pass
 
@@ -179,6 +187,13 @@ def mock_runner2(container):
         container.release_connection(connection)
 
 
+def queue_runner(container, i, order):
+    connection = container.acquire_connection(10)
+    if connection is not None:
+        order.append(i)
+        container.release_connection(connection)
+
+
 def deep_runner(container):
     depth = random.randint(1, 10)
     i = 0
@@ -260,6 +275,17 @@ class ContainerTests(unittest.TestCase):
         v.set_from_value(-3)
         self.assertTrue(container.prepare_sql_literal(v) == "-3")
 
+    def test_limit_clause(self):
+        container = MockContainer(container=self.container,
+                                  dbapi=MockAPI(0), max_connections=5)
+        # the default is blank for compatibility with containers that
+        # use select_limit_clause
+        self.assertTrue(container.select_limit_clause(20, 10) == (20, ''))
+        self.assertTrue(container.limit_clause(0, None) == (0, ''))
+        self.assertTrue(container.limit_clause(0, 10) == (0, ''))
+        self.assertTrue(container.limit_clause(20, 10) == (20, ''))
+        self.assertTrue(container.limit_clause(20, None) == (20, ''))
+
     def test_level0(self):
         # we ask for 5 connections, but should only get one due to level 0
         container = MockContainer(container=self.container,
@@ -439,6 +465,75 @@ class ContainerTests(unittest.TestCase):
         # success criteria?  that we survived
         pass
 
+    def test_pool_queue(self):
+        container = MockContainer(container=self.container, dbapi=MockAPI(1),
+                                  max_connections=1)
+        c = container.acquire_connection()
+        order = []
+        threads = []
+        for i in range3(3):
+            t = threading.Thread(target=queue_runner,
+                                 args=(container, i, order))
+            t.start()
+            threads.append(t)
+            # wait for the thread to join the queue before starting the
+            # next one
+            while container.connection_stats(True)['waiting'] < i + 1:
+                time.sleep(0.01)
+        self.assertTrue(container.connection_stats(True)['timeouts'] == 0)
+        container.release_connection(c)
+        for t in threads:
+            t.join()
+        # first come, first served
+        self.assertTrue(order == [0, 1, 2], order)
+        stats = container.connection_stats(True)
+        self.assertTrue(stats['waiting'] == 0)
+        self.assertTrue(stats['acquired'] == 4)
+        self.assertTrue(stats['waited'] == 3)
+        self.assertTrue(stats['max_wait'] > 0)
+        self.assertTrue(sum(n for b, n in stats['histogram']) == 4)
+        self.assertTrue(stats['histogram'][-1][0] is None)
+        # now check timeouts
+        c = container.acquire_connection()
+        t = threading.Thread(target=mock_runner, args=(container,))
+        container.acquired = None
+        t.start()
+        t.join()
+        self.assertTrue(container.acquired is None)
+        self.assertTrue(container.connection_stats(True)['timeouts'] == 1)
+        container.release_connection(c)
+
+    def test_pool_ping(self):
+        container = MockContainer(container=self.container, dbapi=MockAPI(1),
+                                  max_connections=2, ping_idle=0,
+                                  min_connections=1)
+        container.bad_count = 1
+        c = container.acquire_connection()
+        self.assertTrue(c.dbc.bad)
+        container.release_connection(c)
+        time.sleep(0.01)
+        # the dead connection should be replaced
+        c = container.acquire_connection()
+        self.assertFalse(c.dbc.bad)
+        container.release_connection(c)
+        stats = container.connection_stats(True)
+        self.assertTrue(stats['pings'] == 1)
+        self.assertTrue(stats['ping_failures'] == 1)
+        time.sleep(0.01)
+        c = container.acquire_connection()
+        container.release_connection(c)
+        stats = container.connection_stats(True)
+        self.assertTrue(stats['pings'] == 2)
+        self.assertTrue(stats['ping_failures'] == 1)
+        # the minimum pool size is respected by the pool cleaner
+        t = threading.Thread(target=mock_runner, args=(container,))
+        t.start()
+        t.join()
+        container.pool_cleaner(max_idle=0)
+        container.pool_cleaner(max_idle=0)
+        stats = container.connection_stats(True)
+        self.assertTrue(stats['size'] == 1, stats)
+
     def test_retry(self):
         dbapi = MockAPI(1)
         for i in range3(5):
@@ -490,6 +585,50 @@ class SQLDSTests(unittest.TestCase):
             self.assertTrue(collection.entity_set is es, "Entity set pointer")
             self.assertTrue(len(collection) == 0, "Length on load")
 
+    def test_pragmas(self):
+        dbc = self.db.open()
+        try:
+            c = dbc.cursor()
+            c.execute("PRAGMA journal_mode")
+            self.assertTrue(c.fetchone()[0].upper() == 'DELETE')
+            c.close()
+        finally:
+            self.db.close_connection(dbc)
+        self.db.close()
+        self.db = sqlds.SQLiteEntityContainer(
+            file_path=self.d.join('test.db'), container=self.container,
+            journal_mode='wal', synchronous='normal', cache_size=-4096,
+            mmap_size=1048576, busy_timeout=2500)
+        dbc = self.db.open()
+        try:
+            c = dbc.cursor()
+            for pragma, value in (('journal_mode', 'wal'),
+                                  ('synchronous', 1),
+                                  ('cache_size', -4096),
+                                  ('busy_timeout', 2500),
+                                  ('foreign_keys', 1)):
+                c.execute("PRAGMA %s" % pragma)
+                result = c.fetchone()[0]
+                if is_text(result):
+                    result = result.lower()
+                self.assertTrue(result == value, "%s: %s" % (pragma, result))
+            c.close()
+        finally:
+            self.db.close_connection(dbc)
+        # check the database works
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            collection.create_table()
+            self.assertTrue(len(collection) == 0)
+        for arg in ('journal_mode', 'synchronous'):
+            try:
+                sqlds.SQLiteEntityContainer(
+                    file_path=self.d.join('test2.db'),
+                    container=self.container, **{arg: 'unknown; DROP'})
+                self.fail("bad %s" % arg)
+            except ValueError:
+                pass
+
     def test_insert(self):
         es = self.schema['SampleEntities.Employees']
         with es.open() as collection:
@@ -524,6 +663,183 @@ class SQLDSTests(unittest.TestCase):
             except edm.ConstraintError:
                 pass
 
+    def test_changeset(self):
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            collection.create_table()
+        connection = self.db.begin_changeset()
+        self.assertTrue(isinstance(connection, sqlds.SQLConnection))
+        self.assertTrue(connection.changeset == 1)
+        with es.open() as collection:
+            self.assertTrue(collection.connection is connection)
+            new_hire = collection.new_entity()
+            new_hire.set_key('00001')
+            new_hire["EmployeeName"].set_from_value('Joe Bloggs')
+            collection.insert_entity(new_hire)
+            self.assertTrue(len(collection) == 1)
+        # roll back the change set
+        self.assertFalse(self.db.end_changeset(connection, False))
+        self.assertTrue(connection.changeset == 0)
+        with es.open() as collection:
+            self.assertTrue(len(collection) == 0)
+        connection = self.db.begin_changeset()
+        with es.open() as collection:
+            new_hire = collection.new_entity()
+            new_hire.set_key('00001')
+            new_hire["EmployeeName"].set_from_value('Joe Bloggs')
+            collection.insert_entity(new_hire)
+        self.assertTrue(self.db.end_changeset(connection))
+        with es.open() as collection:
+            self.assertTrue(len(collection) == 1)
+        # a failed transaction causes the whole change set to fail
+        connection = self.db.begin_changeset()
+        with es.open() as collection:
+            new_hire = collection.new_entity()
+            new_hire.set_key('00002')
+            new_hire["EmployeeName"].set_from_value('Jane Doe')
+            collection.insert_entity(new_hire)
+            new_hire = collection.new_entity()
+            new_hire.set_key('00001')
+            new_hire["EmployeeName"].set_from_value('Jane Doe')
+            try:
+                collection.insert_entity(new_hire)
+                self.fail("Double insert")
+            except edm.ConstraintError:
+                pass
+            self.assertTrue(connection.changeset_failed)
+        self.assertFalse(self.db.end_changeset(connection))
+        with es.open() as collection:
+            self.assertTrue(len(collection) == 1)
+            self.assertFalse('00002' in collection)
+
+    def test_batch_changeset(self):
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            collection.create_table()
+            new_hire = collection.new_entity()
+            new_hire.set_key('00001')
+            new_hire["EmployeeName"].set_from_value('Joe Bloggs')
+            collection.insert_entity(new_hire)
+        svc = server.Server('http://host/service.svc')
+        svc.set_model(self.doc)
+
+        def part(method, url, key=None):
+            lines = ["Content-Type: application/http", "",
+                     "%s %s HTTP/1.1" % (method, url)]
+            body = b""
+            if key is not None:
+                body = json.dumps(
+                    {"EmployeeID": key, "EmployeeName": "Jane Doe",
+                     "Address": {"Street": None, "City": None}})
+                body = body.encode('ascii')
+                lines.append("Content-Type: application/json")
+            lines += ["", ""]
+            return "\r\n".join(lines).encode('ascii') + body
+
+        changeset = b"".join([
+            b"Content-Type: multipart/mixed; boundary=cs\r\n\r\n--cs\r\n",
+            part("POST", "Employees", '00002'), b"\r\n--cs\r\n",
+            part("POST", "Employees", '00001'), b"\r\n--cs--"])
+        data = b"".join([
+            b"--b\r\n", part("GET", "Employees('00001')"),
+            b"\r\n--b\r\n", part("GET", "Employees('00001')"),
+            b"\r\n--b\r\n", changeset, b"\r\n--b--\r\n"])
+        response = []
+
+        def start_response(status, response_headers, exc_info=None):
+            response[:] = [status, response_headers]
+        environ = {
+            'REQUEST_METHOD': 'POST', 'SCRIPT_NAME': '',
+            'PATH_INFO': '/service.svc/$batch', 'QUERY_STRING': '',
+            'SERVER_NAME': 'host', 'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': 'host',
+            'CONTENT_TYPE': 'multipart/mixed; boundary=b',
+            'CONTENT_LENGTH': str(len(data)), 'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(data), 'wsgi.errors': io.BytesIO()}
+        result = b"".join(svc(environ, start_response))
+        self.assertTrue(response[0].startswith("202 "))
+        self.assertTrue(result.count(b"HTTP/1.1 200 ") == 2)
+        # the change set failed as a single unit
+        self.assertTrue(result.count(b"HTTP/1.1 ") == 3)
+        self.assertFalse(b"HTTP/1.1 201 " in result)
+        with es.open() as collection:
+            self.assertTrue(len(collection) == 1)
+            self.assertFalse('00002' in collection)
+
+    def test_insert_entities(self):
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            collection.create_table()
+            batch = []
+            for i in range3(25):
+                new_hire = collection.new_entity()
+                new_hire.set_key('%05X' % i)
+                new_hire["EmployeeName"].set_from_value('Talent #%i' % i)
+                new_hire["Address"]["City"].set_from_value('Chunton')
+                batch.append(new_hire)
+            collection.insert_entities(batch, batch_size=10)
+            for new_hire in batch:
+                self.assertTrue(new_hire.exists)
+                self.assertTrue(new_hire['Version'])
+            self.assertTrue(len(collection) == 25)
+            talent = collection['00010']
+            self.assertTrue(talent['EmployeeName'].value == 'Talent #16')
+            self.assertTrue(talent['Address']['City'].value == 'Chunton')
+            # a failure in one batch rolls back the whole insert
+            batch = []
+            for i in range3(30, 20, -1):
+                new_hire = collection.new_entity()
+                new_hire.set_key('%05X' % i)
+                new_hire["EmployeeName"].set_from_value('Talent #%i' % i)
+                batch.append(new_hire)
+            try:
+                collection.insert_entities(batch, batch_size=3)
+                self.fail("Duplicate key in insert_entities")
+            except edm.ConstraintError:
+                pass
+            self.assertTrue(len(collection) == 25)
+            self.assertFalse('0001E' in collection)
+            # already existing entities are rejected
+            try:
+                collection.insert_entities([talent])
+                self.fail("insert_entities with existing entity")
+            except edm.EntityExists:
+                pass
+
+    def test_insert_entities_nav(self):
+        self.db.create_all_tables()
+        customers = self.schema['SampleEntities.Customers']
+        orders = self.schema['SampleEntities.Orders']
+        with customers.open() as collection:
+            customer = collection.new_entity()
+            customer.set_key('ALFKI')
+            customer["CompanyName"].set_from_value('Widget Inc')
+            collection.insert_entity(customer)
+        with orders.open() as collection:
+            batch = []
+            for i in range3(10):
+                order = collection.new_entity()
+                order.set_key(i)
+                if i % 3 == 0:
+                    # bound orders are inserted individually
+                    order['Customer'].bind_entity(customer)
+                batch.append(order)
+            collection.insert_entities(batch, batch_size=4)
+            self.assertTrue(len(collection) == 10)
+        with customer['Orders'].open() as collection:
+            self.assertTrue(sorted(collection.keys()) == [0, 3, 6, 9])
+            # insert and link through the navigation property
+            batch = []
+            for i in range3(10, 15):
+                order = collection.new_entity()
+                order.set_key(i)
+                batch.append(order)
+            collection.insert_entities(batch)
+            for order in batch:
+                self.assertTrue(order.exists)
+            self.assertTrue(sorted(collection.keys()) ==
+                            [0, 3, 6, 9, 10, 11, 12, 13, 14])
+
     def test_update(self):
         es = self.schema['SampleEntities.Employees']
         with es.open() as collection:
@@ -620,6 +936,293 @@ class SQLDSTests(unittest.TestCase):
                 keys.add(talent['EmployeeID'].value)
             self.assertTrue(len(keys) == 10)
 
+    def test_fetch_size(self):
+        self.assertTrue(self.db.fetch_size == 100)
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            self.assertTrue(collection.fetch_size == 100)
+            collection.create_table()
+            for i in range3(25):
+                new_hire = collection.new_entity()
+                new_hire.set_key('%05X' % i)
+                new_hire["EmployeeName"].set_from_value('Talent #%i' % i)
+                new_hire["Address"]["City"].set_from_value('Chunton')
+                collection.insert_entity(new_hire)
+            collection.set_orderby(
+                core.CommonExpression.orderby_from_str("EmployeeID asc"))
+            for fetch_size in (1, 2, 7, 25, 100):
+                collection.fetch_size = fetch_size
+                talent = collection.values()
+                self.assertTrue(len(talent) == 25)
+                for i in range3(25):
+                    self.assertTrue(talent[i]['EmployeeID'].value ==
+                                    '%05X' % i)
+                    self.assertTrue(talent[i]['EmployeeName'].value ==
+                                    'Talent #%i' % i)
+                    self.assertTrue(
+                        talent[i]['Address']['City'].value == 'Chunton')
+                    self.assertFalse(talent[i]['Address']['Street'])
+                # now check that paging is unaffected
+                collection.set_topmax(10)
+                collection.set_page(None)
+                keys = []
+                while True:
+                    page = list(collection.iterpage(True))
+                    if not page:
+                        break
+                    self.assertTrue(len(page) <= 10)
+                    keys += [e['EmployeeID'].value for e in page]
+                self.assertTrue(keys == ['%05X' % i for i in range3(25)])
+                collection.set_topmax(None)
+
+    def test_limit_clause(self):
+        self.assertTrue(self.db.limit_clause(0, None) == (0, ''))
+        self.assertTrue(self.db.limit_clause(0, 10) == (0, 'LIMIT 10 '))
+        self.assertTrue(self.db.limit_clause(20, 10) ==
+                        (0, 'LIMIT 10 OFFSET 20 '))
+        self.assertTrue(self.db.limit_clause(20, None) ==
+                        (0, 'LIMIT -1 OFFSET 20 '))
+
+    def test_deep_paging(self):
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            collection.create_table()
+            for i in range3(200):
+                new_hire = collection.new_entity()
+                new_hire.set_key('%05X' % i)
+                new_hire["EmployeeName"].set_from_value('Talent #%i' % i)
+                collection.insert_entity(new_hire)
+            # count the rows that are actually read from the database
+            fetched = []
+            fetch_rows = collection.fetch_rows
+
+            def counting_fetch(cursor):
+                for row in fetch_rows(cursor):
+                    fetched.append(row)
+                    yield row
+
+            collection.fetch_rows = counting_fetch
+            for skip in (0, 10, 100, 190, 195):
+                del fetched[:]
+                collection.set_page(5, skip)
+                page = list(collection.iterpage())
+                self.assertTrue(
+                    [e['EmployeeID'].value for e in page] ==
+                    ['%05X' % i for i in range3(skip, skip + 5)])
+                # the cost of the page must not depend on skip
+                self.assertTrue(len(fetched) == 5, "%i: %i rows read" %
+                                (skip, len(fetched)))
+            # a skip with no top must still work
+            del fetched[:]
+            collection.set_page(None, 190)
+            page = list(collection.iterpage())
+            self.assertTrue(len(page) == 10)
+            self.assertTrue(len(fetched) == 10)
+            # skip beyond the end
+            collection.set_page(5, 500)
+            self.assertTrue(len(list(collection.iterpage())) == 0)
+            # skiptoken paging uses a keyset seek rather than an offset
+            collection.set_topmax(5)
+            collection.set_page(None, 100)
+            page = list(collection.iterpage(True))
+            self.assertTrue(page[0]['EmployeeID'].value == '%05X' % 100)
+            self.assertTrue(collection.skiptoken is not None)
+            del fetched[:]
+            page = list(collection.iterpage(True))
+            self.assertTrue(page[0]['EmployeeID'].value == '%05X' % 105)
+            self.assertTrue(len(fetched) == 5)
+
+    def test_sql_cache(self):
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            collection.create_table()
+            for i in range3(20):
+                new_hire = collection.new_entity()
+                new_hire.set_key('%05X' % i)
+                new_hire["EmployeeName"].set_from_value('Talent #%i' % i)
+                new_hire["Address"]["City"].set_from_value(
+                    'Chunton' if i % 2 else 'Bunton')
+                collection.insert_entity(new_hire)
+        size, hits, misses = self.db.sql_cache_stats()
+        for i in range3(20):
+            with es.open() as collection:
+                collection.set_filter(
+                    core.CommonExpression.from_str(
+                        "substringof('#%i',EmployeeName) and "
+                        "Address/City eq '%s'" %
+                        (i, 'Chunton' if i % 2 else 'Bunton')))
+                # the filter matches #1 and #10-#19 for i=1
+                names = [e['EmployeeName'].value for e in
+                         collection.itervalues()]
+                self.assertTrue('Talent #%i' % i in names)
+                for n in names:
+                    self.assertTrue(n.startswith('Talent #%i' % i))
+                self.assertTrue(len(collection) == len(names))
+                e = collection['%05X' % i]
+                self.assertTrue(e['EmployeeName'].value == 'Talent #%i' % i)
+        new_size, new_hits, new_misses = self.db.sql_cache_stats()
+        # one miss each for the len, generator and item queries
+        self.assertTrue(new_misses - misses == 3)
+        self.assertTrue(new_hits - hits == 57)
+        self.assertTrue(new_size - size == 3)
+        # a different shape is a new query
+        with es.open() as collection:
+            collection.set_filter(
+                core.CommonExpression.from_str(
+                    "Address/City eq 'Chunton' or EmployeeName eq 'x'"))
+            self.assertTrue(len(collection) == 10)
+        self.assertTrue(self.db.sql_cache_stats()[2] - new_misses == 1)
+        # skip and top are not part of the cached query
+        size, hits, misses = self.db.sql_cache_stats()
+        with es.open() as collection:
+            for skip in range3(5):
+                collection.set_page(2 + skip, skip)
+                page = list(collection.iterpage())
+                self.assertTrue(len(page) == 2 + skip)
+                self.assertTrue(page[0].key() == '%05X' % skip)
+        new_size, new_hits, new_misses = self.db.sql_cache_stats()
+        self.assertTrue(new_misses - misses == 1)
+        self.assertTrue(new_hits - hits == 4)
+        self.assertTrue(new_size - size == 1)
+        # check the LRU limit
+        self.db.sql_cache_size = 2
+        with es.open() as collection:
+            for filter in ("EmployeeName eq 'x'", "EmployeeName ne 'x'",
+                           "Address/City eq 'x'"):
+                collection.set_filter(
+                    core.CommonExpression.from_str(filter))
+                len(collection)
+        self.assertTrue(self.db.sql_cache_stats()[0] == 2)
+        # the least recently used query is discarded
+        self.db.sql_cache_size = 2
+        self.db.set_cached_sql('a', 1)
+        self.db.set_cached_sql('b', 2)
+        for i in range3(1000):
+            self.assertTrue(self.db.get_cached_sql('a') == 1)
+        self.assertTrue(len(self.db.sql_cache_order) < 100)
+        self.db.set_cached_sql('c', 3)
+        self.assertTrue(self.db.get_cached_sql('a') == 1)
+        self.assertTrue(self.db.get_cached_sql('b') is None)
+        self.assertTrue(self.db.get_cached_sql('c') == 3)
+        self.db.sql_cache_size = 0
+        with es.open() as collection:
+            self.assertTrue(len(collection) == 20)
+
+    def test_count_cache(self):
+        es = self.schema['SampleEntities.Employees']
+        self.db.count_cache_size = 2
+        with es.open() as collection:
+            collection.create_table()
+            for i in range3(20):
+                new_hire = collection.new_entity()
+                new_hire.set_key('%05X' % i)
+                new_hire["EmployeeName"].set_from_value('Talent #%i' % i)
+                new_hire["Address"]["City"].set_from_value(
+                    'Chunton' if i % 2 else 'Bunton')
+                collection.insert_entity(new_hire)
+        with es.open() as collection:
+            self.assertTrue(self.db.count_cache_stats() == (0, 0, 0))
+            self.assertTrue(len(collection) == 20)
+            self.assertTrue(self.db.count_cache_stats() == (1, 0, 1))
+            self.assertTrue(len(collection) == 20)
+            self.assertTrue(self.db.count_cache_stats() == (1, 1, 1))
+        with es.open() as collection:
+            collection.set_filter(
+                core.CommonExpression.from_str("Address/City eq 'Chunton'"))
+            self.assertTrue(len(collection) == 10)
+            self.assertTrue(len(collection) == 10)
+            self.assertTrue(self.db.count_cache_stats() == (2, 2, 2))
+            collection.set_filter(
+                core.CommonExpression.from_str("Address/City eq 'Bunton'"))
+            self.assertTrue(len(collection) == 10)
+            # cache is full, the least recently used count is discarded
+            self.assertTrue(self.db.count_cache_stats() == (2, 2, 3))
+        with es.open() as collection:
+            new_hire = collection.new_entity()
+            new_hire.set_key('00100')
+            new_hire["EmployeeName"].set_from_value('Talent #100')
+            collection.insert_entity(new_hire)
+            # the insert invalidates the cache
+            self.assertTrue(self.db.count_cache_stats()[0] == 0)
+            self.assertTrue(len(collection) == 21)
+            del collection['00100']
+            self.assertTrue(len(collection) == 20)
+        # a count calculated before invalidation is not cached
+        with es.open() as collection:
+            self.assertTrue(len(collection) == 20)
+            query, params = collection._sqlLen
+            count, generation = self.db.get_cached_count(query, params)
+            self.assertTrue(count == 20)
+            self.db.invalidate_counts()
+            self.db.set_cached_count(query, params, 19, generation)
+            self.assertTrue(len(collection) == 20)
+        # eviction is in order of use
+        params = sqlds.QMarkParams()
+        for i in range3(1000):
+            query = "SELECT COUNT(*) FROM Employees WHERE %i" % (i % 2)
+            count, generation = self.db.get_cached_count(query, params)
+            if count is None:
+                self.db.set_cached_count(query, params, i % 2, generation)
+        self.assertTrue(len(self.db.count_cache_order) < 100)
+        count, generation = self.db.get_cached_count("SELECT 0", params)
+        self.db.set_cached_count("SELECT 0", params, 0, generation)
+        self.assertTrue(self.db.count_cache_stats()[0] == 2)
+        self.assertTrue(self.db.get_cached_count(
+            "SELECT COUNT(*) FROM Employees WHERE 1", params)[0] == 1)
+        self.assertTrue(self.db.get_cached_count(
+            "SELECT COUNT(*) FROM Employees WHERE 0", params)[0] is None)
+        # expired counts are recalculated
+        self.db.count_cache_max_age = 0
+        with es.open() as collection:
+            self.assertTrue(len(collection) == 20)
+            time.sleep(0.01)
+            misses = self.db.count_cache_stats()[2]
+            self.assertTrue(len(collection) == 20)
+            self.assertTrue(self.db.count_cache_stats()[2] == misses + 1)
+        self.db.count_cache_max_age = None
+        self.db.count_cache_size = 0
+
+    def test_estimate_counts(self):
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            collection.create_table()
+            for i in range3(20):
+                new_hire = collection.new_entity()
+                new_hire.set_key('%05X' % i)
+                new_hire["EmployeeName"].set_from_value('Talent #%i' % i)
+                collection.insert_entity(new_hire)
+            # no statistics, falls back to COUNT
+            collection.estimate_len = True
+            self.assertTrue(collection.estimated_len() is None)
+            self.assertTrue(len(collection) == 20)
+            t = sqlds.SQLTransaction(self.db, collection.connection)
+            try:
+                t.begin()
+                t.execute("ANALYZE")
+                t.commit()
+            finally:
+                t.close()
+            self.assertTrue(collection.estimated_len() == 20)
+            for i in range3(20, 25):
+                new_hire = collection.new_entity()
+                new_hire.set_key('%05X' % i)
+                new_hire["EmployeeName"].set_from_value('Talent #%i' % i)
+                collection.insert_entity(new_hire)
+            # the statistics are out of date
+            self.assertTrue(len(collection) == 20)
+            collection.estimate_len = False
+            self.assertTrue(len(collection) == 25)
+        self.db.estimate_counts = True
+        with es.open() as collection:
+            self.assertTrue(collection.estimate_len)
+            self.assertTrue(len(collection) == 20)
+            # filtered collections are always counted
+            collection.set_filter(
+                core.CommonExpression.from_str(
+                    "EmployeeName ne 'Talent #0'"))
+            self.assertTrue(len(collection) == 24)
+        self.db.estimate_counts = False
+
     def test_filter(self):
         es = self.schema['SampleEntities.Employees']
         with es.open() as collection:
@@ -800,6 +1403,171 @@ class SQLDSTests(unittest.TestCase):
             self.assertTrue(len(collection) == 1)
             self.assertTrue(order.key() in collection)
 
+    def test_expand(self):
+        self.db.create_all_tables()
+        customers = self.schema['SampleEntities.Customers']
+        orders = self.schema['SampleEntities.Orders']
+        with customers.open() as collection:
+            for i in range3(5):
+                customer = collection.new_entity()
+                customer.set_key('C%04i' % i)
+                customer["CompanyName"].set_from_value('Widget #%i' % i)
+                collection.insert_entity(customer)
+        with orders.open() as collection:
+            for i in range3(12):
+                order = collection.new_entity()
+                order.set_key(i)
+                order['Customer'].bind_entity('C%04i' % (i % 4))
+                collection.insert_entity(order)
+        queries = []
+        execute = sqlds.SQLTransaction.execute
+
+        def counting_execute(transaction, sqlcmd, params=None):
+            queries.append(sqlcmd)
+            return execute(transaction, sqlcmd, params)
+
+        sqlds.SQLTransaction.execute = counting_execute
+        try:
+            with customers.open() as collection:
+                collection.set_expand({'Orders': {'Customer': None}})
+                result = collection.values()
+                # one query for customers, orders and the nested
+                # customer expansion
+                self.assertTrue(len(queries) == 3, queries)
+                self.assertTrue(len(result) == 5)
+                for customer in result:
+                    self.assertTrue(customer['Orders'].isExpanded)
+                    cid = customer['CustomerID'].value
+                    i = int(cid[1:])
+                    with customer['Orders'].open() as order_list:
+                        keys = sorted(order_list.keys())
+                        self.assertTrue(
+                            keys == (list(range3(i, 12, 4)) if i < 4 else []),
+                            keys)
+                        for order in order_list.values():
+                            with order['Customer'].open() as clist:
+                                self.assertTrue(list(clist.keys()) == [cid])
+                del queries[:]
+                collection.EXPAND_BATCH_SIZE = 2
+                result = collection.values()
+                # 3 batches of customers, the last batch has no orders
+                # so no nested customer query is required
+                self.assertTrue(len(queries) == 6, queries)
+                self.assertTrue(len(result) == 5)
+            with orders.open() as collection:
+                del queries[:]
+                collection.set_expand({'Customer': None},
+                                      {'OrderID': None,
+                                       'Customer': {'CompanyName': None}})
+                collection.set_topmax(5)
+                page = list(collection.iterpage())
+                self.assertTrue(len(queries) == 2, queries)
+                self.assertTrue(len(page) == 5)
+                for order in page:
+                    self.assertTrue(order['Customer'].isExpanded)
+                    self.assertFalse(order['ShippedDate'])
+                    customer = order['Customer'].get_entity()
+                    self.assertTrue(customer['CompanyName'].value ==
+                                    'Widget #%i' % (order.key() % 4))
+                    self.assertTrue(customer.is_selected('CompanyName'))
+                    self.assertFalse(customer.is_selected('Address'))
+        finally:
+            sqlds.SQLTransaction.execute = execute
+
+    def test_select(self):
+        es = self.schema['SampleEntities.Employees']
+        with es.open() as collection:
+            collection.create_table()
+            for i in range3(5):
+                new_hire = collection.new_entity()
+                new_hire.set_key('%05X' % i)
+                new_hire["EmployeeName"].set_from_value('Talent #%i' % i)
+                new_hire["Address"]["City"].set_from_value('Chunton')
+                new_hire["Version"].set_from_value(b'\x00' * 8)
+                collection.insert_entity(new_hire)
+        queries = []
+        execute = sqlds.SQLTransaction.execute
+
+        def logging_execute(transaction, sqlcmd, params=None):
+            queries.append(sqlcmd)
+            return execute(transaction, sqlcmd, params)
+
+        sqlds.SQLTransaction.execute = logging_execute
+        try:
+            with es.open() as collection:
+                collection.set_expand(None, {'EmployeeName': None})
+                result = collection.values()
+                e = collection['00001']
+                collection.set_topmax(2)
+                page = list(collection.iterpage())
+            self.assertTrue(len(queries) == 3, queries)
+            for q in queries:
+                # keys, selected fields and concurrency tokens only
+                self.assertTrue('"EmployeeName"' in q, q)
+                self.assertTrue('"Version"' in q, q)
+                self.assertFalse('"Address_City"' in q, q)
+            self.assertTrue(len(result) == 5)
+            self.assertTrue(len(page) == 2)
+            for e in result + page + [e]:
+                self.assertTrue(e['EmployeeID'])
+                self.assertTrue(e['EmployeeName'])
+                self.assertTrue(e.is_selected('EmployeeName'))
+                self.assertFalse(e.is_selected('Address'))
+                self.assertFalse(e['Address']['City'])
+            del queries[:]
+            with es.open() as collection:
+                collection.set_expand(None, {'EmployeeName': None})
+                collection.values()
+                # changing the select rule changes the query
+                collection.set_expand(None, {'Address': None})
+                result = collection.values()
+            self.assertTrue(len(queries) == 2, queries)
+            self.assertTrue('"Address_City"' in queries[1])
+            self.assertFalse('"EmployeeName"' in queries[1])
+            for e in result:
+                self.assertTrue(e['Address']['City'].value == 'Chunton')
+                self.assertFalse(e['EmployeeName'])
+        finally:
+            sqlds.SQLTransaction.execute = execute
+
+    def test_streaming(self):
+        self.db.create_all_tables()
+        customers = self.schema['SampleEntities.Customers']
+        with customers.open() as collection:
+            for i in range3(10):
+                customer = collection.new_entity()
+                customer.set_key('C%04i' % i)
+                customer["CompanyName"].set_from_value('Widget #%i' % i)
+                collection.insert_entity(customer)
+        cursors = []
+        new_cursor = self.db.new_cursor
+
+        def logging_cursor(connection, streaming=False):
+            cursors.append(streaming)
+            return new_cursor(connection, streaming)
+
+        self.db.new_cursor = logging_cursor
+        with customers.open() as collection:
+            self.assertFalse(collection.streaming)
+            self.assertTrue(len(collection.values()) == 10)
+            self.assertTrue(cursors == [False])
+            collection.streaming = True
+            collection.fetch_size = 3
+            del cursors[:]
+            self.assertTrue(len(collection.values()) == 10)
+            collection.set_topmax(4)
+            self.assertTrue(len(list(collection.iterpage())) == 4)
+            self.assertTrue(cursors == [True, True])
+            # expansion requires further queries, no streaming
+            del cursors[:]
+            collection.set_expand({'Orders': None})
+            self.assertTrue(len(collection.values()) == 10)
+            self.assertFalse(True in cursors)
+        self.db.streaming = True
+        with customers.open() as collection:
+            self.assertTrue(collection.streaming)
+        self.db.streaming = False
+
     def test_all_tables(self):
         self.db.create_all_tables()
         # run through each entity set and check there is no data in it
@@ -811,6 +1579,36 @@ class SQLDSTests(unittest.TestCase):
                     "No data in %s" %
                     es.name)
 
+    def test_indexes(self):
+        self.db.close()
+        employee = self.schema['Employee']
+        employee['EmployeeName'].set_attribute(sqlds.SQL_INDEX, "true")
+        self.db = sqlds.SQLiteEntityContainer(
+            file_path=self.d.join('test_ix.db'),
+            container=self.container)
+        self.assertTrue(('Employees', 'EmployeeName') in self.db.indexed_names)
+        self.assertFalse(('Employees', 'Address', 'City') in
+                         self.db.indexed_names)
+        self.db.create_all_tables()
+        with self.container['Employees'].open() as collection:
+            self.assertTrue(collection.create_index_queries() == [
+                'CREATE INDEX "Employees_EmployeeName_ix" ON "Employees" '
+                '("EmployeeName")'])
+        with self.container['Orders'].open() as collection:
+            self.assertTrue(len(collection.create_index_queries()) == 2)
+        c = sqlite3.connect(str(self.d.join('test_ix.db')))
+        try:
+            cursor = c.cursor()
+            cursor.execute("SELECT tbl_name, name FROM sqlite_master "
+                           "WHERE type='index' AND sql IS NOT NULL")
+            indexes = sorted(cursor.fetchall())
+        finally:
+            c.close()
+        self.assertTrue(indexes == [
+            ('Employees', 'Employees_EmployeeName_ix'),
+            ('Orders', 'Orders_OrderLines_Orders_ix'),
+            ('Orders', 'Orders_Orders_Customers_ix')], repr(indexes))
+
 
 class CustomisedContainer(sqlds.SQLiteEntityContainer):
 
@@ -944,6 +1742,21 @@ class AutoFieldTests(unittest.TestCase):
             self.assertFalse(ak2['data'], "auto NULL property")
             self.assertTrue(ak2['id'].value == pk, "auto key value")
             logging.info("First generated PK: %i", ak2['id'].value)
+            batch = []
+            for i in range3(10):
+                ak = auto_coll.new_entity()
+                ak['data'].set_from_value("Batch #%i" % i)
+                batch.append(ak)
+            auto_coll.insert_entities(batch, batch_size=4)
+            self.assertTrue(len(auto_coll) == 11)
+            keys = set([pk])
+            for ak in batch:
+                self.assertTrue(ak.exists)
+                self.assertTrue(ak['id'], "Auto key missing after insert")
+                self.assertFalse(ak['id'].value in keys)
+                keys.add(ak['id'].value)
+                ak2 = auto_coll[ak['id'].value]
+                self.assertTrue(ak2['data'].value == ak['data'].value)
 
 
 class RegressionTests(DataServiceRegressionTests):